@@ -0,0 +1,382 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2017 Huazhuo Xu.
+# Licensed under the GNU General Public License, Version 2
+#
+# Benchmarks of post-kp.py, so a change can be checked for making loading
+# or queries slower.
+#
+# 'gen' writes a synthetic kpstk file(the format stap and profile.ebpf
+# write, see README.md). The number of unique stacks, their depth, the
+# number of distinct functions and how skewed the samples are(Zipf) are
+# all configurable, and the same seed gives the same file.
+# >bench-kp.py gen -o zipf.kpstk --stacks 20000 --syms 2000 --skew 1.1
+#
+# 'run' loads each file with doit.loadfile, then times the queries on it:
+# ie(in, ex, ina), cc(caller, callee) and its cc_helper, instruction and,
+# with 2 files or more, getdiff and the diff mode of ie and cc. Each file is
+# benchmarked in a process of its own, so its peak RSS is its own. The
+# results go to a json file, and are compared with a baseline json if one
+# is given, any time or memory which grew more than the tolerance is
+# reported as a regression, and the exit status is 1.
+# >bench-kp.py run -o before.json
+# >bench-kp.py run -o after.json --baseline before.json
+# Without files, run generates the default suite(see suite) in --dir
+# first, or reuses it if it is already there.
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+import textwrap
+import imp
+import time
+import json
+import random
+import bisect
+import platform
+import resource
+import multiprocessing
+
+kp=imp.load_source('postkp',os.path.join(os.path.dirname(
+    os.path.abspath(__file__)),'post-kp.py'))
+
+# The default workloads of run: name -> options of gen. flat and zipf only
+# differ in skew, deep has long stacks of few functions. zipf2 is zipf with
+# another seed, the other side of the diff workload.
+suite=[
+    ('flat',dict(stacks=20000,syms=2000,depth=12,dist='uniform',skew=0.0,
+        samples=1000000,seed=1)),
+    ('zipf',dict(stacks=20000,syms=2000,depth=12,dist='uniform',skew=1.1,
+        samples=1000000,seed=1)),
+    ('zipf2',dict(stacks=20000,syms=2000,depth=12,dist='uniform',skew=1.1,
+        samples=1000000,seed=2)),
+    ('deep',dict(stacks=5000,syms=300,depth=60,dist='geometric',skew=1.0,
+        samples=1000000,seed=1)),
+]
+
+# Functions caller, callee and func are timed with, the ones with the most
+# inclusive samples.
+queryfns=5
+
+# A query is only a regression if its best time also grew by more than
+# noise seconds, timer jitter alone makes fast queries look much slower.
+noise=0.001
+
+class zipf(object):
+    """
+        Draw 0..n-1, k with a probability in proportion to 1/(k+1)**s.
+        s=0 is uniform.
+        cum: cumulative weights /list
+    """
+    def __init__(self,n,s,rnd):
+        self.rnd=rnd
+        self.cum=[]
+        w=0.0
+        for k in range(n):
+            w+=1.0/(k+1)**s
+            self.cum.append(w)
+
+    def draw(self):
+        return bisect.bisect(self.cum,self.rnd.random()*self.cum[-1])
+
+def depthof(rnd,depth,dist):
+    """
+        Depth of a stack.
+        args:
+            depth: fixed depth, or the mean of the others
+            dist: 'fixed', 'uniform'(1 .. 2*depth-1) or 'geometric'
+    """
+    if dist=='fixed':
+        return depth
+    if dist=='uniform':
+        return rnd.randint(1,2*depth-1)
+    d=1
+    while d<4*depth and rnd.random()>1.0/depth:
+        d+=1
+    return d
+
+def gen(out,stacks,syms,depth,dist,skew,samples,seed):
+    """
+        Write a synthetic kpstk file.
+        args:
+            out: file object
+            stacks: number of unique stacks
+            syms: number of distinct functions
+            depth, dist: depth of the stacks, see depthof()
+            skew: Zipf exponent of both which functions the stacks are made
+                of and how many samples each stack has
+            samples: number of samples of all stacks, roughly. Each stack
+                has at least 1
+        return: number of unique stacks written
+    """
+    rnd=random.Random(seed)
+    fns=zipf(syms,skew,rnd)
+    # a few instructions per function, so instruction level info has
+    # something to show
+    seen=set()
+    lst=[]
+    tries=0
+    while len(lst)<stacks and tries<stacks*10:
+        tries+=1
+        stk=[]
+        used=set()
+        for i in range(depthof(rnd,depth,dist)):
+            # few real stacks are recursive, so a function is drawn again
+            # if the stack has it, but not forever
+            for t in range(10):
+                fn=fns.draw()
+                if fn not in used:
+                    break
+            used.add(fn)
+            stk.append((fn,rnd.randint(0,3)*4))
+        stk=tuple(stk)
+        if stk not in seen:
+            seen.add(stk)
+            lst.append(stk)
+    w=zipf(len(lst),skew,rnd)
+    scale=float(samples)/w.cum[-1]
+    out.write('%d stacks...\n!\n' % len(lst))
+    for k,stk in enumerate(lst):
+        for fn,off in stk:
+            addr=0xffffffff81000000+fn*0x100+off
+            out.write(' 0x%x : fn_%d+0x%x/0x100 [kernel]\n' % (addr,fn,off))
+        n=w.cum[k]-(w.cum[k-1] if k else 0.0)
+        out.write('\t%d\n!\n' % max(1,int(round(n*scale))))
+    return len(lst)
+
+def genfile(path,opts):
+    """gen() to file 'path', which only shows up once complete"""
+    with open(path+'.tmp','w') as out:
+        gen(out,**opts)
+    os.rename(path+'.tmp',path)
+
+class quiet(object):
+    """Swallow what queries print while they are timed"""
+    def write(self,s):
+        pass
+
+    def flush(self):
+        pass
+
+def newkp(jobs):
+    """a doit without files"""
+    args=argparse.Namespace(files=[],lines=20,depth=1,baseline=0,
+        delta='last',noindex=True,jobs=jobs,noperiod=False,vmlinux=None,
+        sketch=0,timings=False,follow=None,filt=None,layout=None,
+        mem_budget=None)
+    return kp.doit(args)
+
+def load(d,paths):
+    """open the files and wait until they are loaded"""
+    d.openfile(paths)
+    d.wait()
+
+def timed(fn,*args):
+    """seconds 'fn' takes, with its output swallowed"""
+    out=sys.stdout
+    sys.stdout=quiet()
+    try:
+        t=time.time()
+        fn(*args)
+        return time.time()-t
+    finally:
+        sys.stdout=out
+
+def latency(secs):
+    """min, median and max of 'secs'"""
+    secs=sorted(secs)
+    return {'n':len(secs),'min':secs[0],'median':secs[len(secs)//2],
+        'max':secs[-1]}
+
+def counts(path):
+    """number of lines and of stacks of the kpstk file 'path'"""
+    lines=stacks=0
+    with open(path) as fd:
+        for line in fd:
+            lines+=1
+            if '!' in line:
+                stacks+=1
+    return lines,max(0,stacks-1)
+
+def bench(job):
+    """
+        Benchmark a workload, in a process of its own.
+        args:
+            job: (paths of its files, repeat, jobs)
+        return: the results of the workload /dict
+    """
+    paths,repeat,jobs=job
+    d=newkp(jobs)
+    res={'files':paths,'bytes':sum(os.path.getsize(p) for p in paths)}
+    lines=stacks=0
+    for p in paths:
+        n=counts(p)
+        lines+=n[0]
+        stacks+=n[1]
+    secs=timed(load,d,paths)
+    res['load']={'seconds':secs,'lines_per_s':lines/secs,
+        'stacks_per_s':stacks/secs,'lines':lines,'stacks':stacks}
+    d.activate(paths)
+    f0=d.handle[0]
+    top=sorted(d.incl[f0].iteritems(),key=lambda (k,v):-v)[:queryfns]
+    fns=[d.syms.name(k) for k,v in top]
+    q={}
+    def add(name,secs):
+        q.setdefault(name,[]).append(secs)
+    for r in range(repeat):
+        for cmd in ['in','ex','ina']:
+            d.incldiff=d.excldiff=None
+            add(cmd,timed(d.ie,cmd))
+        for fn in fns:
+            fid=d.syms.lookup(fn)
+            for cmd in ['caller','callee']:
+                d.ccmemo={}
+                add('cc_helper.'+cmd,timed(d.cc_helper,cmd,fid,f0))
+                d.ccmemo={}
+                add(cmd,timed(d.cc,cmd,fn))
+            add('func',timed(d.instruction,fn))
+        if len(d.handle)>1:
+            ins=[d.incl[f] for f in d.handle]
+            ns=[d.total[f] for f in d.handle]
+            add('getdiff',timed(d.getdiff,ins,ns))
+    res['queries']=dict((k,latency(v)) for k,v in q.iteritems())
+    res['rss_kb']=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return res
+
+def compare(new,old,tolerance):
+    """
+        Print how 'new' results changed from 'old' ones. Queries are
+        compared by their best time of the repeats, the least noisy one.
+        args:
+            tolerance: percentage a time or the peak RSS may grow by before
+                it is a regression
+        return: number of regressions
+    """
+    bad=0
+    print('%-10s %-24s %12s %12s %8s' % ('workload','metric','baseline',
+        'now','change'))
+    for name in sorted(new['workloads']):
+        if name not in old['workloads']:
+            continue
+        a,b=old['workloads'][name],new['workloads'][name]
+        rows=[('load',a['load']['seconds'],b['load']['seconds'],noise),
+              ('rss_kb',a['rss_kb'],b['rss_kb'],0)]
+        for q in sorted(b['queries']):
+            if q in a['queries']:
+                rows.append((q,a['queries'][q]['min'],
+                    b['queries'][q]['min'],noise))
+        for metric,x,y,floor in rows:
+            change=100.0*(y-x)/x if x else 0.0
+            flag=''
+            if change>tolerance and y-x>floor:
+                flag='REGRESSION'
+                bad+=1
+            print('%-10s %-24s %12.6g %12.6g %7.1f%% %s' % (name,metric,x,y,
+                change,flag))
+    return bad
+
+def main():
+    desc=textwrap.dedent('''\
+        Benchmarks of post-kp.py.
+        Examples:
+            1. bench-kp.py gen -o file.kpstk --stacks 50000 --skew 1.2
+                write a synthetic kpstk file
+            2. bench-kp.py run -o before.json
+                run the default suite, save the results
+            3. bench-kp.py run -o after.json --baseline before.json
+                run it again, and report what got slower or bigger
+            4. bench-kp.py run -o r.json file1 file2
+                benchmark file1 and file2, and both of them diffed
+        ''')
+    parser=argparse.ArgumentParser(description=desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers=parser.add_subparsers(dest='cmd')
+    sub_gen=subparsers.add_parser('gen',help="write a synthetic kpstk file")
+    sub_gen.add_argument("-o","--output", help="output file. Default the "
+                         "standard output")
+    sub_gen.add_argument("--stacks", help="number of unique stacks",
+                         type=int, default=20000)
+    sub_gen.add_argument("--syms", help="number of distinct functions",
+                         type=int, default=2000)
+    sub_gen.add_argument("--depth", help="stack depth, or its mean",
+                         type=int, default=12)
+    sub_gen.add_argument("--dist", help="distribution of stack depth",
+                         choices=['fixed','uniform','geometric'],
+                         default='uniform')
+    sub_gen.add_argument("--skew", help="Zipf exponent of functions and of "
+                         "samples per stack, 0 for uniform", type=float,
+                         default=1.0)
+    sub_gen.add_argument("--samples", help="number of samples, roughly",
+                         type=int, default=1000000)
+    sub_gen.add_argument("--seed", type=int, default=1)
+    sub_run=subparsers.add_parser('run',help="run the benchmarks")
+    sub_run.add_argument("files", nargs='*', help="kpstk file(s). Default "
+                         "the suite")
+    sub_run.add_argument("-o","--output", help="json file of the results")
+    sub_run.add_argument("--baseline", help="json file of earlier results "
+                         "to compare with")
+    sub_run.add_argument("--tolerance", help="percentage a time or peak "
+                         "RSS may grow by. Default 10", type=float,
+                         default=10.0)
+    sub_run.add_argument("-r","--repeat", help="times each query is run",
+                         type=int, default=3)
+    sub_run.add_argument("-j","--jobs", help="worker processes to load "
+                         "with, as post-kp.py -j. Default 1", type=int,
+                         default=1)
+    sub_run.add_argument("--dir", help="where the suite is generated",
+                         default='/tmp/kp-bench')
+    args=parser.parse_args()
+
+    if args.cmd=='gen':
+        out=open(args.output,'w') if args.output else sys.stdout
+        gen(out,args.stacks,args.syms,args.depth,args.dist,args.skew,
+            args.samples,args.seed)
+        out.close()
+        return 0
+
+    # workers are forked from this process, keep it small so their peak
+    # RSS is the one of the benchmark alone
+    pool=multiprocessing.Pool(1,maxtasksperchild=1)
+    files=args.files
+    diff=files[:2]
+    if not files:
+        if not os.path.isdir(args.dir):
+            os.makedirs(args.dir)
+        for name,opts in suite:
+            path=os.path.join(args.dir,'%s.kpstk' % name)
+            if not os.path.exists(path):
+                print('generating %s' % path)
+                pool.apply(genfile,(path,opts))
+            files.append(path)
+        diff=[os.path.join(args.dir,'zipf.kpstk'),
+            os.path.join(args.dir,'zipf2.kpstk')]
+    jobs=[('%s' % os.path.basename(p),[p]) for p in files]
+    if len(diff)>1:
+        jobs.append(('diff',diff))
+    results={'version':kp.version,'python':platform.python_version(),
+        'numpy':kp.numpy is not None,'time':time.strftime('%Y-%m-%d %H:%M'),
+        'workloads':{}}
+    for name,paths in jobs:
+        print('running %s' % name)
+        res=pool.apply(bench,((paths,args.repeat,args.jobs),))
+        results['workloads'][name]=res
+        q=res['queries']
+        print('  load %.2fs, %d lines/s, %d stacks/s, peak rss %d KB' % (
+            res['load']['seconds'],res['load']['lines_per_s'],
+            res['load']['stacks_per_s'],res['rss_kb']))
+        for k in sorted(q):
+            print('  %-20s median %.6fs' % (k,q[k]['median']))
+    pool.close()
+    if args.output:
+        with open(args.output,'w') as out:
+            json.dump(results,out,indent=1,sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fd:
+            old=json.load(fd)
+        if compare(results,old,args.tolerance):
+            return 1
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -23,6 +23,11 @@
 # Take perf as instance, the profiling file can be achieved in this way,
 # >perf record -a -g -F 479 sleep 30
 # >perf script |./perfconvert.pl > perf.kpstk
+# or, without perfconvert.pl, post-kp.py reads the perf script output
+# directly, from a file or from the standard input,
+# >perf script > perf.out; post-kp.py perf.out
+# >perf script | post-kp.py -
+# in which case samples are weighted by their period(--noperiod to not).
 # here,
 # -a means profiling against all cpus, if only specific cpus are
 # desired, -C cpus can be used instead.
@@ -55,149 +60,4088 @@ import os
 import argparse
 import textwrap
 import readline
+import struct
+import marshal
+import mmap
+import itertools
+import heapq
+import bisect
+import fnmatch
+import math
+import multiprocessing
+import threading
+import SocketServer
+import socket
+import stat
+import json
+import csv
+import copy
+import StringIO
+import zlib
+import gzip
+import hashlib
+import tempfile
+import subprocess
+import time
+import contextlib
+import traceback
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy=None
 
 version="version 1.0"
 
+# The index sidecar(file.kpidx) keeps the pre-parsed aggregates of a
+# profiling file, so reopening the file doesn't need to scan it again.
+# The header is magic, format version, and the size and mtime of the
+# profiling file the index was built from. Bump idxversion whenever the
+# layout of the payload changes.
+idxmagic='KPIDX\0\0\0'
+idxversion=11
+idxhdr=struct.Struct('<8sIQd')
+
+# Frame normalization: strip the address prefix and the '/len' suffix to
+# get the instruction(function+offset), then strip the '+offset' to get
+# the function.
+addrpat=re.compile(r'^.*(: |`)')
+lenpat=re.compile(r'\/.*$')
+offpat=re.compile(r'\+.*$')
+# offset of a function+offset written to pprof as the location address
+pprofoff=re.compile(r'\+0x([0-9a-fA-F]+)$')
+
+# Max number of distinct frame lines whose normalization is cached while
+# loading.
+framecache=1<<16
+
+# 'perf script' output: the header line of a sample, its comm, pid, cpu,
+# time and period(or only its time and period if the header has other
+# fields), and a frame line(addr sym+off (dso)). Identical perf stacks are
+# combined before they are added up, the combiner holds at most
+# combinermax stacks.
+perfhdr=re.compile(r'^\S.*\s\d+(/\d+)?\s+(\[\d+\]\s+)?\d+\.\d+:')
+perfsample=re.compile(r'\s*(\S.*?)\s+(\d+)(?:/\d+)?\s+(?:\[(\d+)\]\s+)?'
+    r'(\d+\.\d+):\s+(?:(\d+)\s)?')
+perftime=re.compile(r'\s(\d+\.\d+):\s+(?:(\d+)\s)?')
+perfframe=re.compile(r'^\s+([0-9A-Fa-f]+)\s+(.+)\s\(')
+# The address of a sample follows the event in the header, 'perf script -F
+# +addr'(or +phys_addr), the first one if both.
+perfaddr=re.compile(r'\s*\S+:\s+([0-9A-Fa-f]+)(?:\s+[0-9A-Fa-f]+)?\s*$')
+combinermax=1<<17
+
+# Collapsed stacks(FlameGraph's 'root;...;leaf count' lines), and gzipped
+# pprof profile.proto.
+# The '!' line before a stack may tell the comm, pid and cpu of its
+# samples, '! comm pid [cpu]', as profile.ebpf writes it.
+kpdims=re.compile(r'!\s*(\S.*?)\s+(\d+)\s+\[(\d+)\]')
+# It may end with the address of the samples, eg. '! 0xffff888012345678'.
+kpaddr=re.compile(r'!(?:.*\s)?0x([0-9A-Fa-f]+)$')
+
+foldedpat=re.compile(r'^\S.* \d+$')
+gzmagic='\x1f\x8b'
+sniffmax=64
+
+# A file is scanned by worker processes if it has at least parallelmin
+# bytes. A file is split into ranges of at most chunksize bytes.
+parallelmin=16<<20
+chunksize=64<<20
+
+# merge splits its inputs into up to mergegroups groups of about the same
+# bytes per worker. Each group is scanned by a worker into one partial
+# profile, more groups than workers so that slower ones even out.
+mergegroups=4
+
+# A file which grew since it was loaded(reload, --follow), or since its
+# index was written, has only the new bytes scanned if the tailcheck bytes
+# before where its loaded stacks end are still the same.
+tailcheck=4096
+
+# The stacks added to a stacktab are made unique once at least dedupmin of
+# them, and as many as the unique ones, are added since, see
+# stacktab.dedup().
+dedupmin=1<<16
+
+# Files are loaded by a background thread, which gives way every pauselines
+# lines to a file a subcmd is waiting for, see doit.pause().
+pauselines=4096
+
+# Samples with a timestamp are counted per time bucket of timebucket
+# seconds, see stacktab.
+timebucket=0.1
+
+# Symbols, disassembly and source lines resolved from an ELF file are
+# cached in symcachedir, keyed by the path, size and mtime of the ELF. Where
+# to look for vmlinux if annotate isn't told.
+symcachedir=os.path.expanduser('~/.cache/post-kp')
+vmlinuxpaths=['/usr/lib/debug/boot/vmlinux-%s','/boot/vmlinux-%s',
+              '/usr/lib/debug/lib/modules/%s/vmlinux',
+              '/lib/modules/%s/build/vmlinux']
+objdumppat=re.compile(r'^\s*([0-9a-f]+):\s*(.*)$')
+
+# Max number of caller/callee results memoized.
+ccmemosize=256
+
+# Items of a container memsize() looks at to estimate its size.
+memsample=64
+
+# Subcmds once files are opened, see cmdparser().
+subcmds=['quit','ls','help','open','in','ex','ina','exa','caller','callee',
+         'func','annotate','topdown','bottomup','tree','timeline','export',
+         'stats','reload','merge','jobs','fg','kill','join','pages','close',
+         'pin']
+
+# Subcmds answered by the daemon(--serve). All but the writecmds are
+# read-only and run concurrently.
+servecmds=['ls','help','open','in','ex','ina','exa','caller','callee','func',
+           'annotate','topdown','bottomup','tree','timeline','export',
+           'stats','reload','merge','join','pages','close','pin']
+
+# Subcmds which change the opened files. They run alone, and in the
+# interactive mode they can't be cancelled or run in the background.
+writecmds=['open','reload','merge','close']
+
+# Subcmds of the jobs of the interactive mode, see job.
+jobcmds=['jobs','fg','kill']
+
+# Subcmds which take a time window(--from/--to).
+windowcmds=['in','ex','ina','exa','caller','callee','timeline','export',
+            'join']
+
+# Subcmds which select samples by their cpu, pid or comm(--cpu/--pid/--comm)
+# and break them down by one of those(--by).
+dimcmds=['in','ex','ina','exa','caller','callee']
+
+# Pseudo functions used as caller/callee keys.
+BOTTOM=-1
+TOP=-2
+
+class meter(object):
+    """
+        Wall time and calls of the hot paths, and hits of the memos, for
+        stats and --timings. Shared by the threads of the daemon.
+        times: name -> [calls, seconds] /dict
+        hits: memo name -> [hits, misses] /dict
+    """
+    def __init__(self):
+        self.times={}
+        self.hits={}
+        self.lock=threading.Lock()
+
+    def add(self,name,secs):
+        with self.lock:
+            t=self.times.setdefault(name,[0,0.0])
+            t[0]+=1
+            t[1]+=secs
+
+    @contextlib.contextmanager
+    def timer(self,name):
+        """time the body of a with statement as 'name'"""
+        start=time.time()
+        try:
+            yield
+        finally:
+            self.add(name,time.time()-start)
+
+    def hit(self,name,hit):
+        """count a hit, or a miss, of memo 'name'"""
+        with self.lock:
+            self.hits.setdefault(name,[0,0])[0 if hit else 1]+=1
+
+meters=meter()
+
+class symtab(object):
+    """
+        Session wide symbol table. Function and function+offset strings are
+        interned to integer ids, so the per file data only keeps ids.
+        ids: string -> id /dict
+        names: id -> string /list
+        owner: id -> id of the function a function+offset belongs to, a
+               function owns itself /list
+        lock: files are loaded by more than one thread, new symbols are
+              added under it /threading.Lock
+        sortidx: names of the functions in name order, their ids, and the
+                 number of symbols they are of. Brought up to date when
+                 looked up, see index() /tuple
+    """
+    pseudo={BOTTOM:'bottom_of_stack!',TOP:'top_of_stack!'}
+
+    def __init__(self):
+        self.ids={}
+        self.names=[]
+        self.owner=[]
+        self.lock=threading.Lock()
+        self.sortidx=([],[],0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self,s,owner=None):
+        i=self.ids.get(s)
+        if i is None:
+            with self.lock:
+                i=self.add(s,owner)
+        return i
+
+    def add(self,s,owner):
+        """intern() with the lock held"""
+        i=self.ids.get(s)
+        if i is None:
+            i=len(self.names)
+            self.ids[s]=i
+            self.names.append(s)
+            self.owner.append(i if owner is None else owner)
+        return i
+
+    def lookup(self,s):
+        """return id of 's', or None if it is never seen"""
+        return self.ids.get(s)
+
+    def name(self,i):
+        if i<0:
+            return self.pseudo[i]
+        return self.names[i]
+
+    def index(self):
+        """
+            Functions in name order and their ids, see sortidx. Only the
+            symbols added since the last time are sorted, and merged into
+            the sorted ones.
+        """
+        names,ids,n=self.sortidx
+        # owner is appended last, so its entries are complete
+        end=len(self.owner)
+        if end==n:
+            return names,ids
+        new=sorted((self.names[i],i) for i in xrange(n,end)
+            if self.owner[i]==i)
+        if new:
+            pairs=sorted(itertools.chain(itertools.izip(names,ids),new))
+            names=[k for k,i in pairs]
+            ids=[i for k,i in pairs]
+        self.sortidx=(names,ids,end)
+        return names,ids
+
+    def prefix(self,p):
+        """names and ids of the functions starting with 'p' /list"""
+        names,ids=self.index()
+        b=bisect.bisect_left(names,p)
+        e=b
+        while e<len(names) and names[e].startswith(p):
+            e+=1
+        return zip(names[b:e],ids[b:e])
+
+    def match(self,pat):
+        """
+            Ids of the functions matching 'pat', a glob(eg. 'tcp_*') or a
+            regex between slashes(eg. '/^ext4_.*write/'), in name order.
+            Only the names starting with the part of a glob before its first
+            wildcard are looked at.
+            raise: re.error if the regex is not right
+        """
+        if pat.startswith('/'):
+            r=re.compile(pat[1:-1] if len(pat)>1 and pat.endswith('/')
+                else pat[1:])
+            names,ids=self.index()
+            return [i for k,i in itertools.izip(names,ids) if r.search(k)]
+        lit=re.match(r'[^*?[]*',pat).group(0)
+        r=re.compile(fnmatch.translate(pat))
+        return [i for k,i in self.prefix(lit) if r.match(k)]
+
+    def merge(self,names,owner):
+        """
+            Intern the symbols of another table(eg. read from an index
+            sidecar).
+            args:
+                names, owner: the 'names' and 'owner' of that table
+            return: list mapping ids of that table to ids of this one, or
+            None if they are the same ids
+        """
+        with self.lock:
+            n=len(self.names)
+            if names[:n]==self.names:
+                for i in range(n,len(names)):
+                    self.add(names[i],owner[i] if owner[i]!=i else None)
+                return None
+            m=[]
+            for i,s in enumerate(names):
+                m.append(self.add(s,m[owner[i]] if owner[i]!=i else None))
+            return m
+
+class stacktab(object):
+    """
+        Unique stacks of one profiling file. A stack is the ids of its
+        functions from the bottom(root) to the top(leaf) of the stack.
+        frames: ids of all stacks, back to back /array
+        start: offset of each stack in frames, plus the end of the last
+               /array
+        counts: number of samples of each stack /array
+        uniq: number of stacks known to be unique, the ones added since
+              may be the same as others until dedup() /int
+        hashes: hash of each of the unique stacks, None if not hashed yet.
+                Only used to find duplicates while loading /numpy array
+        post: function id -> (begin, end) of its postings in pstk/ppos
+              /dict
+        pstk, ppos: postings, ie. stack index and position in the stack of
+              each occurrence of a function. Grouped by function, and in
+              stack and position order within a function /array
+        dims: (cpu, pid, comm) of each dimension id, the dictionary the
+              dimensions of the samples are encoded with. Unknown parts
+              are None, id 0 is all unknown /list
+        dimkeys: (cpu, pid, comm) -> dimension id /dict
+        rows: dimension id<<32|stack index -> row. Only used while loading
+              /dict
+        rstk, rdim, rcnt: stack index, dimension id and number of samples
+              of each row, ie. of the samples of a stack with the same
+              dimensions. Only samples with dimensions or a timestamp have
+              a row /array
+        times: time bucket<<32|row -> number of samples. Only used while
+               loading /dict
+        tfirst: number of the first time bucket(its start time divided by
+                timebucket), None if samples have no timestamps
+        tstart: offset of each time bucket in trow/tcnt, plus the end of
+                the last. Buckets are consecutive from tfirst /array
+        trow, tcnt: row and number of samples of the rows of each time
+                bucket, grouped by bucket /array
+        tcum: number of samples before each time bucket, plus the total
+              /array
+        errs: samples the count of each stack may be over, None unless the
+              file is loaded approximately, see stacksketch /array
+        astk, aaddr, acnt: stack index, address and number of samples of
+              the samples with an address, eg. the data address of a cache
+              or TLB miss, in stack and address order once sealed. Not in
+              time buckets /array
+    """
+    def __init__(self):
+        self.frames=array('I')
+        self.start=array('L',[0])
+        self.counts=array('L')
+        self.uniq=0
+        self.hashes=None
+        self.post={}
+        self.pstk=array('I')
+        self.ppos=array('H')
+        self.dims=[(None,None,None)]
+        self.dimkeys={self.dims[0]:0}
+        self.rows={}
+        self.rstk=array('I')
+        self.rdim=array('I')
+        self.rcnt=array('L')
+        self.times={}
+        self.tfirst=None
+        self.tstart=array('L',[0])
+        self.trow=array('I')
+        self.tcnt=array('L')
+        self.tcum=array('L',[0])
+        self.errs=None
+        self.astk=array('I')
+        self.aaddr=array('L')
+        self.acnt=array('L')
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self,ids,count,bucket=None,dim=None,addr=None):
+        """
+            add 'count' samples of stack 'ids'(root first), in time bucket
+            'bucket' if they have a timestamp, of dimensions 'dim',
+            (cpu, pid, comm), and at address 'addr' if known. The stack is
+            only told from the others by dedup(), once enough are added.
+            return: index of the stack, until the next dedup()
+        """
+        if len(self.counts)-self.uniq>=max(self.uniq,dedupmin):
+            self.dedup()
+        i=len(self.counts)
+        self.frames.extend(ids)
+        self.start.append(len(self.frames))
+        self.counts.append(count)
+        if addr is not None:
+            self.astk.append(i)
+            self.aaddr.append(addr)
+            self.acnt.append(count)
+        if bucket is None and dim is None:
+            return i
+        d=0 if dim is None else self.dimkeys.get(dim)
+        if d is None:
+            d=self.dimid(dim)
+        r=self.rows.get(d<<32|i)
+        if r is None:
+            r=self.row(i,d)
+        self.rcnt[r]+=count
+        if bucket is not None:
+            t=bucket<<32|r
+            self.times[t]=self.times.get(t,0)+count
+        return i
+
+    def dimid(self,dim):
+        """id of dimensions 'dim', (cpu, pid, comm)"""
+        d=self.dimkeys.get(dim)
+        if d is None:
+            d=self.dimkeys[dim]=len(self.dims)
+            self.dims.append(dim)
+        return d
+
+    def row(self,i,d):
+        """row of the samples of stack i with dimension id d"""
+        key=d<<32|i
+        r=self.rows.get(key)
+        if r is None:
+            r=self.rows[key]=len(self.rstk)
+            self.rstk.append(i)
+            self.rdim.append(d)
+            self.rcnt.append(0)
+        return r
+
+    def hashstacks(self,b):
+        """
+            Hashes of the stacks from index b on, by their frames and
+            depth, see dedup().
+            return: numpy array
+        """
+        u64=numpy.uint64
+        start=numpy.frombuffer(self.start,u64)[b:].astype(numpy.int64)
+        lens=numpy.diff(start)
+        frames=numpy.frombuffer(self.frames,numpy.uint32)[start[0]:]
+        rel=start[:-1]-start[0]
+        # a multiplier per position in the stack, so the order counts
+        pos=(numpy.arange(len(frames))-numpy.repeat(rel,lens)).astype(u64)
+        mix=(pos+u64(1))*u64(0x9e3779b97f4a7c15)
+        mix^=mix>>u64(29)
+        mix*=u64(0xbf58476d1ce4e5b9)
+        h=numpy.zeros(len(lens),u64)
+        full=lens>0
+        if len(frames):
+            h[full]=numpy.add.reduceat((frames.astype(u64)+u64(1))*(mix|
+                u64(1)),rel[full])
+        return h*u64(0x94d049bb133111eb)+lens.astype(u64)
+
+    def dupmap(self):
+        """
+            dedup() of the stacks from uniq on. Stacks with the same hash
+            are grouped by a stable sort, and each is checked against the
+            first one of its group frame by frame. Without numpy, or if two
+            stacks have the same hash, they are told apart by their packed
+            frames instead.
+            return: index of the first stack the same as each stack, and
+            the number of unique stacks /array
+        """
+        n=len(self.counts)
+        if numpy is not None:
+            if self.hashes is None:
+                self.hashes=numpy.zeros(0,numpy.uint64)
+            h=numpy.concatenate((self.hashes,self.hashstacks(
+                len(self.hashes))))
+            o=numpy.argsort(h,kind='mergesort')
+            first=numpy.ones(n,bool)
+            first[1:]=h[o][1:]!=h[o][:-1]
+            m=numpy.empty(n,numpy.int64)
+            m[o]=o[first][numpy.cumsum(first)-1]
+            dup=numpy.flatnonzero(m!=numpy.arange(n))
+            start=numpy.frombuffer(self.start,numpy.uint64).astype(
+                numpy.int64)
+            lens=numpy.diff(start)
+            same=(lens[dup]==lens[m[dup]]).all()
+            if same and len(dup):
+                l=lens[dup]
+                at=numpy.arange(l.sum())-numpy.repeat(numpy.cumsum(l)-l,l)
+                frames=numpy.frombuffer(self.frames,numpy.uint32)
+                same=(frames[numpy.repeat(start[dup],l)+at]==frames[
+                    numpy.repeat(start[m[dup]],l)+at]).all()
+            if same:
+                isfirst=m==numpy.arange(n)
+                self.hashes=h[isfirst]
+                m=(numpy.cumsum(isfirst)-1)[m]
+                return array('L',m.astype(numpy.uint64).tostring()),int(
+                    isfirst.sum())
+            self.hashes=None
+        keys={}
+        m=array('L')
+        for i in xrange(n):
+            m.append(keys.setdefault(self.stack(i).tostring(),len(keys)))
+        return m,len(keys)
+
+    def dedup(self):
+        """
+            Make the stacks added since the last time unique. The samples,
+            rows and addresses of a stack seen before go to the first one,
+            and the frames of the others are dropped, so the stacks keep
+            the order they are first added in. The duplicates are found by
+            sorting, see dupmap(), not by a dictionary keyed by a second
+            copy of every stack.
+        """
+        n=len(self.counts)
+        if n==self.uniq:
+            return
+        m,nu=self.dupmap()
+        self.uniq=nu
+        if nu==n:
+            return
+        if numpy is not None:
+            mm=numpy.frombuffer(m,numpy.uint64).astype(numpy.int64)
+            isfirst=numpy.zeros(n,bool)
+            isfirst[numpy.unique(mm,return_index=True)[1]]=True
+            lens=numpy.diff(numpy.frombuffer(self.start,numpy.uint64).astype(
+                numpy.int64))
+            frames=numpy.frombuffer(self.frames,numpy.uint32)[
+                numpy.repeat(isfirst,lens)]
+            self.frames=array('I',frames.tostring())
+            start=numpy.zeros(nu+1,numpy.uint64)
+            numpy.cumsum(lens[isfirst],out=start[1:])
+            self.start=array('L',start.tostring())
+            counts=numpy.zeros(nu,numpy.uint64)
+            numpy.add.at(counts,mm,numpy.frombuffer(self.counts,numpy.uint64))
+            self.counts=array('L',counts.tostring())
+        else:
+            frames=array('I')
+            start=array('L',[0])
+            counts=array('L',[0])*nu
+            for i in xrange(n):
+                j=m[i]
+                if j==len(start)-1:
+                    frames.extend(self.stack(i))
+                    start.append(len(frames))
+                counts[j]+=self.counts[i]
+            self.frames,self.start,self.counts=frames,start,counts
+        self.astk=array('I',[m[i] for i in self.astk])
+        if not len(self.rstk):
+            return
+        rows={}
+        rmap=array('L')
+        rstk,rdim,rcnt=array('I'),array('I'),array('L')
+        for r in xrange(len(self.rstk)):
+            i,d=m[self.rstk[r]],self.rdim[r]
+            j=rows.get(d<<32|i)
+            if j is None:
+                j=rows[d<<32|i]=len(rstk)
+                rstk.append(i)
+                rdim.append(d)
+                rcnt.append(0)
+            rcnt[j]+=self.rcnt[r]
+            rmap.append(j)
+        self.rows=rows
+        self.rstk,self.rdim,self.rcnt=rstk,rdim,rcnt
+        times={}
+        for t,c in self.times.iteritems():
+            t=t>>32<<32|rmap[t&0xffffffff]
+            times[t]=times.get(t,0)+c
+        self.times=times
+
+    def merge(self,part):
+        """
+            add all samples of stacktab 'part', which has the same ids. Its
+            stacks are added in bulk, and told from the others by dedup().
+        """
+        n=len(self.counts)
+        base=len(self.frames)
+        self.frames.extend(part.frames)
+        if numpy is not None:
+            self.start.fromstring((numpy.frombuffer(part.start,numpy.uint64)[
+                1:]+numpy.uint64(base)).tostring())
+        else:
+            self.start.extend(b+base for b in part.start[1:])
+        self.counts.extend(part.counts)
+        dims=[0]+[self.dimid(d) for d in part.dims[1:]]
+        rows=array('L')
+        for r in xrange(len(part.rstk)):
+            rows.append(self.row(n+part.rstk[r],dims[part.rdim[r]]))
+            self.rcnt[rows[-1]]+=part.rcnt[r]
+        self.astk.extend(n+i for i in part.astk)
+        self.aaddr.extend(part.aaddr)
+        self.acnt.extend(part.acnt)
+        part.sealtimes()
+        for b in range(len(part.tstart)-1):
+            for j in range(part.tstart[b],part.tstart[b+1]):
+                t=part.tfirst+b<<32|rows[part.trow[j]]
+                self.times[t]=self.times.get(t,0)+part.tcnt[j]
+        if len(self.counts)-self.uniq>=max(self.uniq,dedupmin):
+            self.dedup()
+
+    def sealtimes(self):
+        """
+            Move the samples in self.times to the time buckets. Only the
+            buckets from the first one self.times has samples of are
+            redone, so adding the samples of the rest of a growing file
+            redoes its last buckets only.
+        """
+        if not self.times:
+            return
+        first=min(self.times)>>32
+        old=self.tfirst
+        redo=old is None or first<old
+        b0=0 if redo else min(first-old,self.buckets())
+        for b in range(b0,self.buckets()):
+            for j in range(self.tstart[b],self.tstart[b+1]):
+                t=old+b<<32|self.trow[j]
+                self.times[t]=self.times.get(t,0)+self.tcnt[j]
+        del self.trow[self.tstart[b0]:]
+        del self.tcnt[self.tstart[b0]:]
+        del self.tstart[b0+1:]
+        del self.tcum[b0+1:]
+        if redo:
+            self.tfirst=first
+        b=self.tfirst+b0
+        n=self.tcum[-1]
+        for t in sorted(self.times):
+            while t>>32>b:
+                self.tstart.append(len(self.trow))
+                self.tcum.append(n)
+                b+=1
+            c=self.times[t]
+            self.trow.append(t&0xffffffff)
+            self.tcnt.append(c)
+            n+=c
+        self.tstart.append(len(self.trow))
+        self.tcum.append(n)
+        self.times={}
+
+    def sealaddrs(self):
+        """
+            Sort the address samples by stack and address and combine the
+            same ones, so they are the same however the file was split to
+            be scanned.
+        """
+        if not len(self.astk):
+            return
+        if numpy is not None:
+            stk=numpy.frombuffer(self.astk,numpy.uint32)
+            addr=numpy.frombuffer(self.aaddr,numpy.uint64)
+            cnt=numpy.frombuffer(self.acnt,numpy.uint64)
+            o=numpy.lexsort((addr,stk))
+            stk,addr,cnt=stk[o],addr[o],cnt[o]
+            first=numpy.ones(len(o),bool)
+            first[1:]=(stk[1:]!=stk[:-1])|(addr[1:]!=addr[:-1])
+            idx=numpy.flatnonzero(first)
+            self.astk=array('I',stk[idx].tostring())
+            self.aaddr=array('L',addr[idx].tostring())
+            self.acnt=array('L',numpy.add.reduceat(cnt,idx).tostring())
+            return
+        sums={}
+        for k,c in itertools.izip(itertools.izip(self.astk,self.aaddr),
+                self.acnt):
+            sums[k]=sums.get(k,0)+c
+        keys=sorted(sums)
+        self.astk=array('I',[k[0] for k in keys])
+        self.aaddr=array('L',[k[1] for k in keys])
+        self.acnt=array('L',[sums[k] for k in keys])
+
+    def buckets(self):
+        """number of time buckets"""
+        return len(self.tstart)-1
+
+    def window(self,b0,b1,mask=None):
+        """
+            Samples of each stack in time buckets [b0, b1), numbered from
+            the first bucket.
+            args:
+                mask: only count the samples of the dimension ids set in
+                    it, see dimmask(). None for all
+            return: array
+        """
+        b0=min(max(b0,0),self.buckets())
+        b1=min(max(b1,b0),self.buckets())
+        begin,end=self.tstart[b0],self.tstart[b1]
+        return self.sum(self.trow[begin:end],self.tcnt[begin:end],mask)
+
+    def select(self,mask):
+        """
+            Samples of each stack of the dimension ids set in 'mask'
+            return: array
+        """
+        return self.sum(None,self.rcnt,mask)
+
+    def sum(self,rows,cnt,mask):
+        """
+            Add up samples 'cnt' of 'rows'(all rows if None) per stack,
+            only the ones of the dimension ids set in 'mask' if it is not
+            None.
+            return: array
+        """
+        if numpy is not None:
+            stk=numpy.frombuffer(self.rstk,numpy.uint32)
+            dim=numpy.frombuffer(self.rdim,numpy.uint32)
+            if rows is not None:
+                rows=numpy.frombuffer(rows,numpy.uint32)
+                stk,dim=stk[rows],dim[rows]
+            w=numpy.frombuffer(cnt,numpy.uint64).astype(numpy.float64)
+            if mask is not None:
+                w=w*numpy.frombuffer(mask,numpy.int8)[dim]
+            cnt=numpy.bincount(stk,w,len(self))
+            return array('L',cnt.round().astype(numpy.uint64).tostring())
+        sums=array('L',[0])*len(self)
+        if rows is None:
+            rows=xrange(len(self.rstk))
+        for r,c in itertools.izip(rows,cnt):
+            if mask is None or mask[self.rdim[r]]:
+                sums[self.rstk[r]]+=c
+        return sums
+
+    def dimsum(self,col,mask=None,b0=None,b1=None):
+        """
+            Samples of each value of dimension 'col'.
+            args:
+                col: 'cpu', 'pid' or 'comm'
+                mask: only count the dimension ids set in it, see
+                    dimmask(). None for all
+                b0, b1: only count time buckets [b0, b1), see window().
+                    None for all samples
+            return: value -> samples, unknown values left out /dict
+        """
+        if b0 is None:
+            rows,cnt=None,self.rcnt
+        else:
+            b0=min(max(b0,0),self.buckets())
+            b1=min(max(b1,b0),self.buckets())
+            begin,end=self.tstart[b0],self.tstart[b1]
+            rows,cnt=self.trow[begin:end],self.tcnt[begin:end]
+        if numpy is not None:
+            dim=numpy.frombuffer(self.rdim,numpy.uint32)
+            if rows is not None:
+                dim=dim[numpy.frombuffer(rows,numpy.uint32)]
+            byid=numpy.bincount(dim,numpy.frombuffer(cnt,numpy.uint64),
+                len(self.dims)).round().astype(numpy.uint64).tolist()
+        else:
+            byid=[0]*len(self.dims)
+            for r,c in itertools.izip(xrange(len(self.rstk))
+                    if rows is None else rows,cnt):
+                byid[self.rdim[r]]+=c
+        col={'cpu':0,'pid':1,'comm':2}[col]
+        vals={}
+        for d,c in enumerate(byid):
+            v=self.dims[d][col]
+            if c and v is not None and (mask is None or mask[d]):
+                vals[v]=vals.get(v,0)+c
+        return vals
+
+    def dimmask(self,sel):
+        """
+            Dimension ids matching 'sel'.
+            args:
+                sel: 'cpu', 'pid' or 'comm' -> set of values. A dimension
+                    matches if its value of each of them is in the set
+            return: array, 1 for the ids matching
+        """
+        cols={'cpu':0,'pid':1,'comm':2}
+        return array('b',[int(all(dim[cols[k]] in v for k,v in
+            sel.iteritems())) for dim in self.dims])
+
+    def addrsum(self,bins,nbins,key=None):
+        """
+            Samples with an address per bin of their address, for each key
+            of their stack.
+            args:
+                bins: bin of each address sample, see layout.bins()
+                nbins: number of bins
+                key: key of each stack, eg. its top function, negative to
+                    leave it out. None for all in one key 0
+            return: key -> samples of each bin /dict of list
+        """
+        if numpy is not None:
+            if key is None:
+                k=numpy.zeros(len(self.astk),numpy.int64)
+            else:
+                k=numpy.asarray(key,numpy.int64)[
+                    numpy.frombuffer(self.astk,numpy.uint32)]
+            b=numpy.asarray(bins,numpy.int64)
+            w=numpy.frombuffer(self.acnt,numpy.uint64).astype(numpy.float64)
+            keep=k>=0
+            keys,inv=numpy.unique(k[keep],return_inverse=True)
+            m=numpy.bincount(inv*nbins+b[keep],w[keep],len(keys)*nbins)
+            m=m.round().astype(numpy.uint64).reshape(len(keys),nbins)
+            return dict(zip(keys.tolist(),m.tolist()))
+        sums={}
+        for i,b,c in itertools.izip(self.astk,bins,self.acnt):
+            k=0 if key is None else key[i]
+            if k<0:
+                continue
+            row=sums.get(k)
+            if row is None:
+                row=sums[k]=[0]*nbins
+            row[b]+=c
+        return sums
+
+    def tops(self):
+        """top(leaf) function of each stack /array"""
+        if numpy is not None:
+            return numpy.frombuffer(self.frames,numpy.uint32)[
+                numpy.frombuffer(self.start,numpy.uint64)[1:].astype(
+                numpy.int64)-1]
+        return array('I',[self.frames[e-1] for e in self.start[1:]])
+
+    def series(self,stks,width):
+        """
+            Samples per 'width' time buckets, the total and the ones of the
+            stacks 'stks'.
+            args:
+                stks: stack indexes, None for all stacks
+            return: list of (total, samples of 'stks')
+        """
+        bounds=range(0,self.buckets(),width)+[self.buckets()]
+        lst=[]
+        if stks is not None and numpy is not None:
+            mark=numpy.zeros(len(self),numpy.uint64)
+            mark[numpy.asarray(stks,numpy.int64)]=1
+            n=numpy.frombuffer(self.tcnt,numpy.uint64)*mark[
+                numpy.frombuffer(self.rstk,numpy.uint32)[
+                numpy.frombuffer(self.trow,numpy.uint32)]]
+            n=numpy.concatenate(([0],numpy.cumsum(n)))
+            return [(self.tcum[b1]-self.tcum[b0],
+                int(n[self.tstart[b1]]-n[self.tstart[b0]]))
+                for b0,b1 in zip(bounds[:-1],bounds[1:])]
+        if stks is not None:
+            mark=array('b',[0])*len(self)
+            for i in stks:
+                mark[i]=1
+        for b0,b1 in zip(bounds[:-1],bounds[1:]):
+            checkpoint(float(b0)/max(self.buckets(),1))
+            total=self.tcum[b1]-self.tcum[b0]
+            if stks is None:
+                lst.append((total,total))
+                continue
+            n=0
+            for j in range(self.tstart[b0],self.tstart[b1]):
+                if mark[self.rstk[self.trow[j]]]:
+                    n+=self.tcnt[j]
+            lst.append((total,n))
+        return lst
+
+    def stack(self,i):
+        return self.frames[self.start[i]:self.start[i+1]]
+
+    def seal(self,since=0):
+        """
+            Loading is done, make the stacks unique, drop the duplicate
+            finders and build the postings and the time buckets.
+            args:
+                since: the stacks before this one have their postings
+                    already, see unseal()
+        """
+        self.dedup()
+        self.hashes=None
+        self.rows={}
+        self.sealtimes()
+        self.sealaddrs()
+        occ={}
+        for s in range(since,len(self.counts)):
+            for i,fn in enumerate(self.stack(s)):
+                o=occ.get(fn)
+                if o is None:
+                    o=occ[fn]=(array('I'),array('H'))
+                o[0].append(s)
+                o[1].append(i)
+        if since==0:
+            post,pstk,ppos={},array('I'),array('H')
+        else:
+            post,pstk,ppos=self.post,self.pstk,self.ppos
+        self.post={}
+        self.pstk=array('I')
+        self.ppos=array('H')
+        # the new stacks come after the old ones, so their postings go
+        # after those of the same function
+        for fn in sorted(set(post)|set(occ)):
+            b=len(self.pstk)
+            if fn in post:
+                pb,pe=post[fn]
+                self.pstk.extend(pstk[pb:pe])
+                self.ppos.extend(ppos[pb:pe])
+            o=occ.pop(fn,None)
+            if o is not None:
+                self.pstk.extend(o[0])
+                self.ppos.extend(o[1])
+            self.post[fn]=(b,len(self.pstk))
+
+    def unseal(self):
+        """
+            Make the table loadable again after seal(), to add the samples
+            of the rest of a growing file, and seal(len(self)) then. The
+            duplicate finders are rebuilt from the stacks and the rows.
+        """
+        self.uniq=len(self)
+        self.hashes=None
+        self.rows=dict((self.rdim[r]<<32|self.rstk[r],r) for r in
+            xrange(len(self.rstk)))
+
+    def postings(self,fn):
+        """
+            Stacks containing function 'fn', or any of the functions of a
+            tuple 'fn', which are taken as one function.
+            return: list of (stack index, position of the first 'fn' in the
+            stack, number of 'fn' in the stack)
+        """
+        if isinstance(fn,tuple):
+            first={}
+            for f in fn:
+                for s,i,n in self.postings(f):
+                    o=first.get(s)
+                    first[s]=(i,n) if o is None else (min(o[0],i),o[1]+n)
+            return [(s,)+first[s] for s in sorted(first)]
+        b,e=self.post.get(fn,(0,0))
+        lst=[]
+        while b<e:
+            if not len(lst)&0xffff:
+                checkpoint()
+            s=self.pstk[b]
+            n=b+1
+            while n<e and self.pstk[n]==s:
+                n+=1
+            lst.append((s,self.ppos[b],n-b))
+            b=n
+        return lst
+
+    def dump(self):
+        self.dedup()
+        self.sealtimes()
+        return (self.frames.tostring(),self.start.tostring(),
+            self.counts.tostring(),self.post,self.pstk.tostring(),
+            self.ppos.tostring(),self.tfirst,self.tstart.tostring(),
+            self.trow.tostring(),self.tcnt.tostring(),self.tcum.tostring(),
+            self.dims,self.rstk.tostring(),self.rdim.tostring(),
+            self.rcnt.tostring(),self.astk.tostring(),self.aaddr.tostring(),
+            self.acnt.tostring())
+
+    @classmethod
+    def load(cls,data,m=None):
+        """
+            Rebuild from dump(). 'm' maps the stored ids to the ids of the
+            current symtab if they differ.
+        """
+        stk=cls()
+        stk.frames.fromstring(data[0])
+        if m is not None:
+            stk.frames=array('I',map(m.__getitem__,stk.frames))
+        stk.start=array('L')
+        stk.start.fromstring(data[1])
+        stk.counts.fromstring(data[2])
+        stk.post=remapdict(data[3],m)
+        stk.pstk.fromstring(data[4])
+        stk.ppos.fromstring(data[5])
+        stk.tfirst=data[6]
+        for a,d in ((stk.tstart,data[7]),(stk.trow,data[8]),
+                (stk.tcnt,data[9]),(stk.tcum,data[10]),(stk.rstk,data[12]),
+                (stk.rdim,data[13]),(stk.rcnt,data[14]),(stk.astk,data[15]),
+                (stk.aaddr,data[16]),(stk.acnt,data[17])):
+            del a[:]
+            a.fromstring(d)
+        stk.dims=[tuple(d) for d in data[11]]
+        stk.dimkeys=dict((d,i) for i,d in enumerate(stk.dims))
+        stk.uniq=len(stk)
+        return stk
+
+class sketch(dict):
+    """
+        Space-saving heavy hitters, a drop-in for the key -> samples dicts
+        of a file(incl, excl, inst) when it is loaded approximately
+        (--sketch). It holds at most 2*size keys, when full only the size
+        keys with the most samples are kept. A key not in it counts as
+        floor samples, the most samples of a dropped key, so a key which
+        comes back starts from there. The samples of a key are thus never
+        less than its real samples, and at most error(key) more.
+        size: number of keys kept when it is pruned
+        floor: samples of a key not in it
+        err: key -> samples its count may be over /dict
+    """
+    def __init__(self,size):
+        dict.__init__(self)
+        self.size=size
+        self.floor=0
+        self.err={}
+
+    def get(self,k,d=None):
+        v=dict.get(self,k)
+        return self.floor if v is None else v
+
+    def __setitem__(self,k,v):
+        if not dict.__contains__(self,k):
+            if len(self)>=2*self.size:
+                self.prune()
+            self.err[k]=self.floor
+        dict.__setitem__(self,k,v)
+
+    def prune(self):
+        """keep the size keys with the most samples"""
+        keep=heapq.nlargest(self.size,self.iteritems(),key=lambda (k,v):v)
+        keep=dict(keep)
+        for k,v in self.items():
+            if k not in keep:
+                self.floor=max(self.floor,v)
+                dict.__delitem__(self,k)
+                del self.err[k]
+
+    def error(self,k):
+        """samples the count of key k may be over"""
+        return self.err[k] if dict.__contains__(self,k) else self.floor
+
+    def merge(self,other):
+        """
+            Add the samples of sketch 'other'. The errors and floors add up.
+        """
+        keys=set(self)|set(other)
+        for k in keys:
+            v=self.get(k)+other.get(k)
+            e=self.error(k)+other.error(k)
+            dict.__setitem__(self,k,v)
+            self.err[k]=e
+        self.floor+=other.floor
+        if len(self)>=2*self.size:
+            self.prune()
+
+    def dump(self):
+        return (dict(self),self.err,self.floor,self.size)
+
+    @classmethod
+    def load(cls,data,m=None):
+        """rebuild from dump(), 'm' maps the ids as in stacktab.load()"""
+        d=cls(data[3])
+        d.update(remapdict(data[0],m))
+        d.err=remapdict(data[1],m)
+        d.floor=data[2]
+        return d
+
+class stacksketch(sketch):
+    """
+        Stacks of a file in a sketch, by packed ids(root first), in place of
+        a stacktab while the file is loaded approximately. Samples have no
+        time buckets, no dimensions and no addresses then.
+    """
+    def add(self,ids,count,bucket=None,dim=None,addr=None):
+        key=array('I',ids).tostring()
+        self[key]=self.get(key)+count
+
+    @classmethod
+    def load(cls,data,m=None):
+        d=super(stacksketch,cls).load(data)
+        if m is not None:
+            remap=lambda key:array('I',map(m.__getitem__,
+                array('I',key))).tostring()
+            dict.clear(d)
+            d.update((remap(k),v) for k,v in data[0].iteritems())
+            d.err=dict((remap(k),v) for k,v in data[1].iteritems())
+        return d
+
+    def stacks(self):
+        """the stacktab of the stacks kept, with their errors"""
+        stk=stacktab()
+        stk.errs=array('L')
+        for key in sorted(self):
+            stk.add(array('I',key),self[key])
+            stk.errs.append(self.err[key])
+        return stk
+
+class cctree(object):
+    """
+        Calling context tree of one profiling file, ie. the prefix tree of
+        its stacks from the bottom(root) to the top(leaf). Node 0 is a
+        virtual root above the bottoms of all stacks. Nodes are in depth
+        first order, so the subtree of node n is n .. end[n]-1.
+        sym: function id of each node /array
+        parent: parent node /array
+        end: end of the subtree of each node /array
+        incl: samples of the stacks going through each node /array
+        excl: samples of the stacks ending at each node /array
+        bysym: function id -> its nodes. Built on first use /dict
+    """
+    def __init__(self):
+        self.sym=array('i',[BOTTOM])
+        self.parent=array('I',[0])
+        self.end=array('I',[1])
+        self.incl=array('L',[0])
+        self.excl=array('L',[0])
+        self.bysym=None
+
+    def __len__(self):
+        return len(self.sym)
+
+    @classmethod
+    def build(cls,stk):
+        """
+            Build from a stacktab. Stacks are walked in sorted order, so
+            a stack shares its path from the root with the previous one
+            up to their common prefix.
+        """
+        t=cls()
+        sym,parent,end,incl,excl=t.sym,t.parent,t.end,t.incl,t.excl
+        path=[0]
+        prev=()
+        for n,s in enumerate(sorted(range(len(stk)),key=stk.stack)):
+            if not n&0xfff:
+                checkpoint(float(n)/len(stk))
+            fns=stk.stack(s)
+            count=stk.counts[s]
+            k=0
+            common=min(len(prev),len(fns))
+            while k<common and prev[k]==fns[k]:
+                k+=1
+            while len(path)>k+1:
+                end[path.pop()]=len(sym)
+            for fn in fns[k:]:
+                parent.append(path[-1])
+                path.append(len(sym))
+                sym.append(fn)
+                end.append(0)
+                incl.append(0)
+                excl.append(0)
+            for i in path:
+                incl[i]+=count
+            excl[path[-1]]+=count
+            prev=fns
+        while path:
+            end[path.pop()]=len(sym)
+        return t
+
+    def add(self,stk,counts):
+        """
+            Add samples to stacks which are in the tree already.
+            args:
+                stk: the stacktab the tree is built from
+                counts: stack index -> samples to add
+        """
+        for s,c in counts.iteritems():
+            n=0
+            self.incl[0]+=c
+            for fn in stk.stack(s):
+                n=next(k for k in self.children(n) if self.sym[k]==fn)
+                self.incl[n]+=c
+            self.excl[n]+=c
+
+    def children(self,n):
+        c=n+1
+        while c<self.end[n]:
+            yield c
+            c=self.end[c]
+
+    def nodes(self,fn):
+        """nodes of function 'fn', in depth first order"""
+        if self.bysym is None:
+            bysym={}
+            for i in range(1,len(self.sym)):
+                bysym.setdefault(self.sym[i],array('I')).append(i)
+            self.bysym=bysym
+        return self.bysym.get(fn,())
+
+    def outermost(self,fn):
+        """nodes of 'fn' which have no 'fn' on their path to the root"""
+        nodes=[]
+        end=0
+        for n in self.nodes(fn):
+            if n>=end:
+                nodes.append(n)
+                end=self.end[n]
+        return nodes
+
+    def dump(self):
+        return (self.sym.tostring(),self.parent.tostring(),
+            self.end.tostring(),self.incl.tostring(),self.excl.tostring())
+
+    @classmethod
+    def load(cls,data,m=None):
+        """
+            Rebuild from dump(). 'm' maps the stored ids to the ids of the
+            current symtab if they differ.
+        """
+        t=cls()
+        for a,d in zip((t.sym,t.parent,t.end,t.incl,t.excl),data):
+            del a[:]
+            a.fromstring(d)
+        if m is not None:
+            t.sym=array('i',[BOTTOM]+[m[i] for i in t.sym[1:]])
+        return t
+
+def memsize(x):
+    """
+        Rough number of bytes taken by 'x' and what it holds, for stats.
+        Big containers are estimated from some of their items, and shared
+        objects(eg. small ints) are counted each time.
+    """
+    n=sys.getsizeof(x)
+    if isinstance(x,array):
+        return n
+    if numpy is not None and isinstance(x,numpy.ndarray):
+        return n+x.nbytes
+    if isinstance(x,dict):
+        items=list(itertools.islice(x.iteritems(),memsample))
+        each=sum(memsize(k)+memsize(v) for k,v in items)
+    elif isinstance(x,(list,tuple,set)):
+        items=list(itertools.islice(x,memsample))
+        each=sum(memsize(v) for v in items)
+    else:
+        return n
+    return n+each*len(x)//max(len(items),1)
+
+def mbytes(n):
+    """'n' bytes as MB, or KB below 1MB"""
+    return '%.1fMB' % (n/1e6) if n>=1e6 else '%dKB' % (n//1000)
+
+def remapdict(d,m):
+    """re-key a dictionary by id map 'm'"""
+    if m is None:
+        return d
+    return dict((m[k],v) for k,v in d.iteritems())
+
+def newframe(syms,line,cache,key=None):
+    """
+        Normalize a frame line to the ids of its function+offset and its
+        function, and cache them by 'key'(default the line itself). The
+        cache is dropped when it gets too big, eg. stap with per frame
+        addresses of a lot of different instructions.
+    """
+    if len(cache)>=framecache:
+        cache.clear()
+    ins=addrpat.sub('',line)
+    ins=lenpat.sub('',ins)
+    fn=syms.intern(offpat.sub('',ins))
+    fr=cache[line if key is None else key]=(syms.intern(ins,fn),fn)
+    return fr
+
+class framefilter(object):
+    """
+        Load time pipeline of the stacks, so what is loaded is only what is
+        looked at, see --drop, --keep, --skip, --fold, --norecurse and
+        --maxdepth. It is applied to each stack as it is added, in this
+        order: stacks are kept or skipped by their functions, frames of
+        some functions are dropped, runs of frames are folded into one
+        pseudo frame, recursion is collapsed, and the stack is cut to its
+        top frames. Functions are matched by their names without offset,
+        and only once, the first time they are seen.
+        spec: (drop, keep, skip, fold, norecurse, maxdepth), see
+              filterspec() /tuple
+        drop, keep, skip: the compiled regexes, None if not given
+        fold: (pseudo function name, compiled regex) list
+        memo: function id -> (skip, keep, drop, pseudo function id or None)
+              of the function. Ids are of the symtab the filter is used
+              with, a worker has a filter of its own /dict
+    """
+    def __init__(self,spec):
+        self.spec=spec
+        drop,keep,skip,fold,self.norecurse,self.maxdepth=spec
+        self.drop,self.keep,self.skip=[p and re.compile(p) for p in
+            (drop,keep,skip)]
+        self.fold=[(name,re.compile(p)) for name,p in fold]
+        self.memo={}
+
+    def classify(self,syms,fn):
+        """what to do with the frames of function 'fn'"""
+        name=syms.name(fn)
+        pseudo=None
+        for fname,pat in self.fold:
+            if pat.search(name):
+                pseudo=syms.intern(fname)
+                break
+        a=self.memo[fn]=(bool(self.skip and self.skip.search(name)),
+            bool(self.keep and self.keep.search(name)),
+            bool(self.drop and self.drop.search(name)),pseudo)
+        return a
+
+    def apply(self,syms,ids):
+        """
+            args:
+                ids: function+offset ids of a stack, top first
+            return: ids of the stack to add, None if it is not kept or no
+            frame is left
+        """
+        owner=syms.owner
+        memo=self.memo
+        keep=self.keep is None
+        out=[]
+        for i in ids:
+            fn=owner[i]
+            a=memo.get(fn)
+            if a is None:
+                a=self.classify(syms,fn)
+            if a[0]:
+                return None
+            keep=keep or a[1]
+            if a[2]:
+                continue
+            if a[3] is not None:
+                if out and out[-1]==a[3]:
+                    continue
+                i=a[3]
+            elif self.norecurse and out and owner[out[-1]]==fn:
+                continue
+            out.append(i)
+        if not keep or not out:
+            return None
+        return out[:self.maxdepth] if self.maxdepth else out
+
+def filterspec(args):
+    """
+        The framefilter spec of --drop, --keep, --skip, --fold, --norecurse
+        and --maxdepth of 'args'. Regexes given more than once match if
+        any of them does.
+        return: the spec, None if none of them is given
+        raise: ValueError if a regex or a fold is malformed
+    """
+    def either(pats):
+        if not pats:
+            return None
+        pat='|'.join('(?:%s)'%(p) for p in pats)
+        try:
+            re.compile(pat)
+        except re.error as e:
+            raise ValueError('%s: %s'%(pat,e))
+        return pat
+    fold=[]
+    for v in args.fold or []:
+        name,sep,pat=v.partition('=')
+        if not sep or not name:
+            raise ValueError('--fold %s: NAME=REGEX expected'%(v))
+        fold.append((name,either([pat])))
+    spec=(either(args.drop),either(args.keep),either(args.skip),tuple(fold),
+        args.norecurse,args.maxdepth)
+    if spec==(None,None,None,(),False,None):
+        return None
+    return spec
+
+def addstack(syms,incl,excl,inst,stk,ids,count,bucket=None,dim=None,
+        filt=None,addr=None):
+    """
+        Add 'count' samples of one stack.
+        args:
+            ids: function+offset ids of the stack, top first
+            bucket: time bucket of the samples, None if no timestamp
+            dim: (cpu, pid, comm) of the samples, None if unknown
+            filt: framefilter to apply to the stack, None for none
+            addr: address of the samples, None if unknown
+        return: the samples added, 0 if the stack is filtered out
+    """
+    if filt is not None:
+        ids=filt.apply(syms,ids)
+        if ids is None:
+            return 0
+    fns=[syms.owner[i] for i in ids]
+    for i in ids:
+        inst[i]=inst.get(i,0)+count
+    for i in fns:
+        incl[i]=incl.get(i,0)+count
+    excl[fns[0]]=excl.get(fns[0],0)+count
+    fns.reverse()
+    stk.add(fns,count,bucket,dim,addr)
+    return count
+
+def scan(lines,syms,incl,excl,inst,stk,flush=False,period=True,filt=None):
+    """
+        Scan lines of a profiling file and extract both function level and
+        instruction level info from call stacks.
+        args:
+            lines: lines of the file, or of a part of it starting at a '!'
+            syms: symtab to intern functions to
+            incl, excl, inst: dicts to add inclusive, exclusive and
+                instruction level samples to
+            stk: stacktab to add the stacks to
+            flush: 'lines' is followed by a '!', so the last stack is
+                complete
+            period: unused, see scanperf()
+            filt: framefilter applied to each stack, None for none
+        return: number of samples
+
+        The same frame lines show up again and again in a file, so each
+        distinct line is normalized and interned only once.
+    """
+    total=0
+    frame={}
+    newstack=0
+    thisline=[]
+    dim=None
+    addr=None
+    for line in itertools.chain(lines,['!'] if flush else []):
+        line=line.strip()
+        if '!' in line:
+            if newstack>0 and len(thisline)>1:
+                count=int(thisline[-1])
+                ids=[]
+                for i in range(len(thisline)-1):
+                    fr=frame.get(thisline[i])
+                    if fr is None:
+                        fr=newframe(syms,thisline[i],frame)
+                    ids.append(fr[0])
+                total+=addstack(syms,incl,excl,inst,stk,ids,count,None,
+                    dim,filt,addr)
+            del thisline[:]
+            newstack+=1
+            m=kpdims.match(line)
+            dim=(int(m.group(3)),int(m.group(2)),m.group(1)) if m else None
+            m=len(line)>1 and kpaddr.match(line)
+            addr=int(m.group(1),16) if m else None
+            continue
+
+        if newstack>0:
+            thisline.append(line)
+    return total
+
+def scanperf(lines,syms,incl,excl,inst,stk,flush=True,period=True,
+        filt=None):
+    """
+        Scan 'perf script' output directly, same as scan() does with what
+        perfconvert.pl makes of it.
+        A sample is a header line(comm pid [cpu] time: period event:
+        [addr]) followed by its frames, one per line, top first. Identical
+        stacks of the same comm, pid, cpu and address in the same time
+        bucket are summed up in a combiner as they stream by, which is
+        drained into the aggregates when it holds combinermax stacks, so
+        memory doesn't grow with the number of samples. The combiner is
+        drained in the order the stacks are first seen, so the order of
+        stacks is the same however the samples are split into ranges.
+        args:
+            see scan(). 'flush' is ignored since the end of the lines is
+            always the end of a sample.
+            period: weight samples by their period if there is one
+        return: number of samples, or total period
+    """
+    total=0
+    frame={}
+    comb=({},[],[])
+    ids=[]
+    weight=0
+    bucket=None
+    dim=None
+    addr=None
+    dims={}
+    for line in itertools.chain(lines,['']):
+        if line[:1].isspace() and line.strip():
+            if not weight:
+                continue
+            fr=frame.get(line)
+            if fr is None:
+                m=perfframe.match(line)
+                if not m:
+                    continue
+                conv='%s : %s+%s/' % (m.group(1),m.group(2),m.group(1))
+                fr=newframe(syms,conv,frame,line)
+            ids.append(fr[0])
+            continue
+        if ids:
+            key=(bucket,dim,addr,tuple(ids))
+            i=comb[0].get(key)
+            if i is None:
+                comb[0][key]=len(comb[1])
+                comb[1].append(key)
+                comb[2].append(weight)
+            else:
+                comb[2][i]+=weight
+            del ids[:]
+            if len(comb[1])>=combinermax:
+                total+=drain(syms,incl,excl,inst,stk,comb,filt)
+        weight=0
+        if line.strip():
+            weight=1
+            bucket=None
+            dim=None
+            addr=None
+            m=perfsample.match(line)
+            if m:
+                key=m.group(3,2,1)
+                dim=dims.get(key)
+                if dim is None:
+                    dim=dims[key]=(None if key[0] is None else int(key[0]),
+                        int(key[1]),key[2])
+                t=m.group(4,5)
+            else:
+                m=perftime.search(line)
+                t=m and m.groups()
+            if m:
+                a=perfaddr.match(line,m.end())
+                if a:
+                    addr=int(a.group(1),16)
+                bucket=int(float(t[0])/timebucket)
+                if period and t[1]:
+                    weight=int(t[1])
+    total+=drain(syms,incl,excl,inst,stk,comb,filt)
+    return total
+
+def drain(syms,incl,excl,inst,stk,comb,filt=None):
+    """
+        Add the stacks in a combiner to the aggregates and empty it.
+        args:
+            comb: ((time bucket, dimensions, address, stack) -> slot,
+                (time bucket, dimensions, address, stack)s, samples) of the
+                combiner
+            filt: see addstack()
+    """
+    total=0
+    for (bucket,dim,addr,ids),count in itertools.izip(comb[1],comb[2]):
+        total+=addstack(syms,incl,excl,inst,stk,ids,count,bucket,dim,filt,
+            addr)
+    comb[0].clear()
+    del comb[1][:]
+    del comb[2][:]
+    return total
+
+def scanfolded(lines,syms,incl,excl,inst,stk,flush=True,period=True,
+        filt=None):
+    """
+        Scan collapsed stacks, ie. FlameGraph's stackcollapse output, one
+        stack per line, 'root;...;leaf count'. The frames are normalized
+        the same way as the ones of scan(), so 'fn+off' is an instruction
+        of 'fn'.
+        args:
+            see scan(). 'flush' and 'period' are unused.
+        return: number of samples
+    """
+    total=0
+    frame={}
+    for line in lines:
+        stack,sep,count=line.strip().rpartition(' ')
+        if not sep or not count.isdigit():
+            continue
+        ids=[]
+        for f in reversed(stack.split(';')):
+            fr=frame.get(f)
+            if fr is None:
+                fr=newframe(syms,f,frame)
+            ids.append(fr[0])
+        total+=addstack(syms,incl,excl,inst,stk,ids,int(count),filt=filt)
+    return total
+
+def pbvarint(n):
+    """protobuf varint of n, negative n as 64 bits two's complement"""
+    n&=(1<<64)-1
+    b=[]
+    while n>0x7f:
+        b.append(chr(n&0x7f|0x80))
+        n>>=7
+    b.append(chr(n))
+    return ''.join(b)
+
+def pbint(num,n):
+    """protobuf varint field 'num'"""
+    return pbvarint(num<<3)+pbvarint(n)
+
+def pbbytes(num,b):
+    """protobuf length delimited field 'num'"""
+    return pbvarint(num<<3|2)+pbvarint(len(b))+b
+
+def pbpacked(num,lst):
+    """protobuf packed repeated varint field 'num'"""
+    return pbbytes(num,''.join(pbvarint(n) for n in lst))
+
+def pbunpack(buf):
+    """
+        The varints back to back in buf, as int64.
+        return: list
+    """
+    lst=[]
+    v=0
+    shift=0
+    for c in buf:
+        c=ord(c)
+        v|=(c&0x7f)<<shift
+        shift+=7
+        if c<0x80:
+            lst.append(v-(1<<64) if v>=1<<63 else v)
+            v=0
+            shift=0
+    return lst
+
+def pbfields(buf):
+    """
+        Decode a protobuf message.
+        return: list of (field number, value). The value of a varint field
+        is an int, of a length delimited field is a str, which is a string,
+        a message, or packed varints
+    """
+    lst=[]
+    i=0
+    end=len(buf)
+    while i<end:
+        key=0
+        shift=0
+        while True:
+            c=ord(buf[i])
+            i+=1
+            key|=(c&0x7f)<<shift
+            shift+=7
+            if c<0x80:
+                break
+        wire=key&7
+        if wire==0 or wire==2:
+            v=0
+            shift=0
+            while True:
+                c=ord(buf[i])
+                i+=1
+                v|=(c&0x7f)<<shift
+                shift+=7
+                if c<0x80:
+                    break
+            if wire==2:
+                v=buf[i:i+v]
+                i+=len(v)
+        elif wire==1:
+            v=struct.unpack('<q',buf[i:i+8])[0]
+            i+=8
+        elif wire==5:
+            v=struct.unpack('<i',buf[i:i+4])[0]
+            i+=4
+        else:
+            raise ValueError('bad protobuf wire type %d'%(wire))
+        lst.append((key>>3,v))
+    return lst
+
+def pbints(v):
+    """values of a repeated varint field, packed(str) or not(int)"""
+    if isinstance(v,str):
+        return pbunpack(v)
+    return [v-(1<<64) if v>=1<<63 else v]
+
+def scanpprof(lines,syms,incl,excl,inst,stk,flush=True,period=True,
+        filt=None):
+    """
+        Read a pprof profile(gzipped profile.proto). The lines of a
+        location are frames of their own, innermost first. The location is
+        an instruction of its last line, the function the others are
+        inlined into, whose code the address is in: the system name of the
+        function if it is the name+offset(see writepprof()), else its
+        address, if any. A location with no line is a frame of its address.
+        Samples are weighted by the last value of the sample, the default
+        of pprof.
+        args:
+            see scan(). 'flush' and 'period' are unused.
+        return: number of samples
+    """
+    data=''.join(lines)
+    if data[:2]==gzmagic:
+        data=zlib.decompress(data,16+zlib.MAX_WBITS)
+    strings=[]
+    funcs={}
+    locs={}
+    samples=[]
+    for num,v in pbfields(data):
+        if num==2:
+            samples.append(v)
+        elif num==4:
+            loc=dict(id=0,address=0,lines=[])
+            for n,w in pbfields(v):
+                if n==1:
+                    loc['id']=w
+                elif n==3:
+                    loc['address']=w
+                elif n==4:
+                    loc['lines']+=[x for m,x in pbfields(w) if m==1][:1]
+            locs[loc['id']]=loc
+        elif num==5:
+            fields=dict(pbfields(v))
+            funcs[fields.get(1,0)]=(fields.get(2,0),fields.get(3,0))
+        elif num==6:
+            strings.append(v)
+    frames={}
+    for i,loc in locs.iteritems():
+        names=[funcs.get(f,(0,0)) for f in loc['lines']]
+        fns=[strings[n] for n,sysname in names]
+        if not fns:
+            fns=['0x%x'%(loc['address'])]
+        ids=[]
+        for fn in fns:
+            fid=syms.intern(fn)
+            ids.append(fid)
+        ins=names and strings[names[-1][1]]
+        if ins and ins.startswith(fns[-1]+'+'):
+            ids[-1]=syms.intern(ins,ids[-1])
+        elif loc['address'] and loc['lines']:
+            ids[-1]=syms.intern('%s+0x%x'%(fns[-1],loc['address']),ids[-1])
+        frames[i]=ids
+    total=0
+    for v in samples:
+        ids=[]
+        count=0
+        for n,w in pbfields(v):
+            if n==1:
+                for loc in pbints(w):
+                    ids+=frames[loc]
+            elif n==2:
+                count=pbints(w)[-1]
+        if ids and count>0:
+            total+=addstack(syms,incl,excl,inst,stk,ids,count,filt=filt)
+    return total
+
+# scanner and stack boundary test of each input format. Files of a format
+# without boundary are not split, they are scanned as a whole.
+scanners={
+    'kpstk':(scan,lambda line:'!' in line),
+    'perf':(scanperf,lambda line:line.strip() and not line[:1].isspace()),
+    'folded':(scanfolded,lambda line:True),
+    'pprof':(scanpprof,None),
+}
+
+def writefolded(out,syms,stk,inst=None):
+    """
+        Write the stacks of stacktab 'stk' as collapsed stacks.
+        args:
+            out: file object
+            inst: unused, collapsed stacks are of functions only
+    """
+    names=syms.names
+    for i in range(len(stk)):
+        if not i&0xfff:
+            checkpoint(float(i)/len(stk))
+        if stk.counts[i]:
+            out.write('%s %d\n'%(';'.join(names[j] for j in stk.stack(i)),
+                stk.counts[i]))
+
+def writepprof(out,syms,stk,inst=None):
+    """
+        Write the stacks of stacktab 'stk' as a pprof profile.proto. Each
+        function+offset is a location, with id its id+1, the offset as its
+        address, and one line of a pprof function of the same id, named by
+        its function and with the function+offset as its system name(the
+        address alone loses +0x0, or the rest of eg. fn+0x4+ffff0010), so
+        scanpprof() gets the instruction level back. The stacks are of
+        functions only, so the
+        samples of each function are handed out to its instructions as
+        many as 'inst' has of each, a stack being split into samples with
+        other instructions when one runs out. A function with none left,
+        or 'inst' None, is a location of its own, with id function id+1.
+        Fields are written as they are made, samples first and the string
+        table last, which protobuf allows.
+        args:
+            out: file object, eg. of gzip
+            inst: samples of each function+offset id, None for functions
+                only
+    """
+    strings={}
+    def sid(x):
+        i=strings.get(x)
+        if i is None:
+            i=strings[x]=len(strings)
+        return i
+    sid('')
+    out.write(pbbytes(1,pbint(1,sid('samples'))+pbint(2,sid('count'))))
+    owner=syms.owner
+    # function id -> [instruction id, samples left] of its instructions
+    left={}
+    for k,v in sorted((inst or {}).iteritems()):
+        if v>0:
+            left.setdefault(owner[k],[]).append([k,v])
+    used=set()
+    for i in range(len(stk)):
+        if not i&0xfff:
+            checkpoint(float(i)/len(stk))
+        if not stk.counts[i]:
+            continue
+        samples=[(stk.counts[i],[])]
+        for fn in reversed(stk.stack(i)):
+            split=[]
+            for n,locs in samples:
+                ins=left.get(fn)
+                while n and ins:
+                    k=ins[0]
+                    take=min(n,k[1])
+                    split.append((take,locs+[k[0]]))
+                    n-=take
+                    k[1]-=take
+                    if not k[1]:
+                        ins.pop(0)
+                if n:
+                    split.append((n,locs+[fn]))
+            samples=split
+        for n,locs in samples:
+            used.update(locs)
+            out.write(pbbytes(2,pbpacked(1,[k+1 for k in locs])+
+                pbpacked(2,[n])))
+    for k in sorted(used):
+        fn=owner[k]
+        # the offset of fn+0x10, none if the name is not of that form
+        m=k!=fn and pprofoff.match(syms.names[k][len(syms.names[fn]):])
+        addr=int(m.group(1),16) if m else 0
+        out.write(pbbytes(4,pbint(1,k+1)+(pbint(3,addr) if addr else '')+
+            pbbytes(4,pbint(1,k+1))))
+        out.write(pbbytes(5,pbint(1,k+1)+pbint(2,sid(syms.names[fn]))+
+            pbint(3,sid(syms.names[k]))))
+    for x in sorted(strings,key=strings.get):
+        out.write(pbbytes(6,x))
+
+# writer of each export format
+writers={
+    'folded':writefolded,
+    'pprof':writepprof,
+}
+
+def fileformat(lines):
+    """
+        Tell the format of a profiling file by its first lines.
+        return: 'perf' for 'perf script' output, 'folded' for collapsed
+        stacks, 'pprof' for gzipped pprof, 'kpstk' otherwise
+    """
+    for i,line in enumerate(lines):
+        if i==0 and line[:2]==gzmagic:
+            return 'pprof'
+        if perfhdr.match(line):
+            return 'perf'
+        if '!' in line:
+            return 'kpstk'
+        if foldedpat.match(line.rstrip('\n')):
+            return 'folded'
+    return 'kpstk'
+
+def splitfile(name,jobs,fmt,size=None):
+    """
+        Split a profiling file into byte ranges for scanrange(). Each range
+        but the first starts at a stack boundary of the format.
+        args:
+            name: file name
+            jobs: number of workers. A file is split into at least that
+                many ranges if it is big enough
+            fmt: format of the file
+            size: split the first 'size' bytes only, None for all
+        return: list of (file name, begin, end, flush, fmt) ranges
+    """
+    boundary=scanners[fmt][1]
+    if size is None:
+        size=os.path.getsize(name)
+    chunk=max(1<<20,min(chunksize,size//jobs+1))
+    bounds=[0]
+    with open(name,'rb') as fd:
+        pos=chunk
+        while pos<size:
+            fd.seek(pos)
+            fd.readline()
+            while True:
+                off=fd.tell()
+                line=fd.readline()
+                if not line or boundary(line):
+                    break
+            if not line:
+                break
+            bounds.append(off)
+            pos=off+chunk
+    bounds.append(size)
+    return [(name,bounds[i],bounds[i+1],i<len(bounds)-2,fmt)
+        for i in range(len(bounds)-1)]
+
+def rfind(fd,end,sub,start=0):
+    """
+        offset of the last 'sub' in a file between offsets 'start' and
+        'end', -1 if none
+    """
+    while end>start:
+        begin=max(start,end-(1<<16))
+        fd.seek(begin)
+        i=fd.read(end-begin).rfind(sub)
+        if i>=0:
+            return begin+i
+        # 'sub' may span the blocks
+        end=begin+len(sub)-1 if begin>start else start
+    return -1
+
+def stackend(fd,fmt,size):
+    """
+        Where the complete stacks of a profiling file, which may still be
+        written, end. The rest of the file can be scanned from there once
+        it is written.
+        args:
+            fd: the opened profiling file
+            fmt: format of the file, not 'pprof'
+            size: size of the file
+        return: offset of the last '!' line of kpstk, of the line after the
+        last blank line of perf(after the last newline if there is no
+        blank line near the end, ie. samples have no call chains), and
+        after the last newline of folded
+    """
+    if fmt=='kpstk':
+        i=rfind(fd,size,'!')
+        return rfind(fd,i,'\n')+1 if i>=0 else 0
+    if fmt=='perf':
+        i=rfind(fd,size,'\n\n',max(0,size-(1<<20)))
+        if i>=0:
+            return i+2
+    return rfind(fd,size,'\n')+1
+
+def readrange(fd,begin,end):
+    """
+        Lines of the bytes [begin, end) of a file, 'end' at the start of a
+        line. They are read in blocks, so there is no python code run per
+        line.
+    """
+    def blocks(n):
+        fd.seek(begin)
+        rest=''
+        while n>0:
+            buf=fd.read(min(n,1<<20))
+            if not buf:
+                break
+            n-=len(buf)
+            lines=buf.split('\n')
+            lines[0]=rest+lines[0]
+            rest=lines.pop()
+            yield lines
+        if rest:
+            yield [rest]
+    return itertools.chain.from_iterable(blocks(end-begin))
+
+def tailsum(fd,end):
+    """digest of the tailcheck bytes of a file before offset 'end'"""
+    fd.seek(max(0,end-tailcheck))
+    return hashlib.md5(fd.read(min(end,tailcheck))).hexdigest()
+
+def scanrange(job):
+    """
+        Worker of doit.loadparallel(). Scan a byte range of a profiling
+        file.
+        args:
+            job: (file name, begin, end, flush, fmt, period, size, spec), a
+                range of splitfile(), the scanner option, the size of the
+                sketches, 0 for exact aggregates, and the framefilter spec,
+                None for none
+        return: symbols, samples, and aggregates of the range, in ids of
+            its own symtab
+    """
+    name,begin,end,flush,fmt,period,size,spec=job
+    with open(name,'rb') as fd:
+        fd.seek(begin)
+        lines=fd.read(end-begin).split('\n')
+    if lines and lines[-1]=='':
+        lines.pop()
+    syms=symtab()
+    if size:
+        incl,excl,inst,stk=(sketch(size),sketch(size),sketch(size),
+            stacksketch(size))
+    else:
+        incl,excl,inst,stk=({},{},{},stacktab())
+    total=scanners[fmt][0](lines,syms,incl,excl,inst,stk,flush,period,
+        spec and framefilter(spec))
+    if size:
+        incl,excl,inst=incl.dump(),excl.dump(),inst.dump()
+    return (syms.names,syms.owner,total,incl,excl,inst,stk.dump())
+
+class stacksum(stacktab):
+    """
+        Stacks of the profiling files merged into one profile, see
+        mergefiles(). Samples of different hosts have different times and
+        cpus, pids and comms, so only the stacks and their counts are kept.
+    """
+    def add(self,ids,count,bucket=None,dim=None,addr=None):
+        return stacktab.add(self,ids,count)
+
+def dirfiles(d):
+    """the profiling files in directory 'd', neither hidden nor indexes"""
+    names=[os.path.join(d,n) for n in sorted(os.listdir(d))
+        if not n.startswith('.') and '.kpidx' not in n]
+    return [n for n in names if os.path.isfile(n)]
+
+def mergegroup(job):
+    """
+        Worker of mergefiles(). Scan a group of profiling files into one
+        partial profile, one file after another, so it takes the memory of
+        the unique stacks of the group only.
+        args:
+            job: (list of (file name, weight), period, framefilter spec),
+                see mergefiles()
+        return: symbols, samples and stacks of the files, in ids of its own
+            symtab
+    """
+    files,period,spec=job
+    filt=spec and framefilter(spec)
+    syms=symtab()
+    stk=stacksum()
+    total=0
+    for name,weight in files:
+        part=stk if weight==1 else stacksum()
+        with open(name,'rb') as fd:
+            fmt=fileformat(fd.read(1<<16).split('\n'))
+            fd.seek(0)
+            n=scanners[fmt][0](fd,syms,{},{},{},part,period=period,
+                filt=filt)
+        if part is not stk:
+            for i in xrange(len(part)):
+                stk.add(part.stack(i),int(round(part.counts[i]*weight)))
+            n=int(round(n*weight))
+        total+=n
+    return (syms.names,syms.owner,total,stk.dump())
+
+def mergepair(job):
+    """
+        Worker of mergefiles(). Merge two partial profiles of mergegroup(),
+        or of itself, into one.
+        args:
+            job: the two partial profiles
+        return: the merged profile, in ids of the symbols of the first
+    """
+    (names,owner,total,stk),(names1,owner1,total1,stk1)=job
+    syms=symtab()
+    syms.merge(names,owner)
+    m=syms.merge(names1,owner1)
+    part=stacksum.load(stk)
+    part.unseal()
+    part.merge(stacktab.load(stk1,m))
+    return (syms.names,syms.owner,total+total1,part.dump())
+
+def mergeinputs(files,weights=None):
+    """
+        The inputs of mergefiles(), the files in directories listed.
+        args:
+            files: files, or directories of them
+            weights: comma separated weight of each file, in the order
+                they are listed, None for all 1
+        return: list of (file name, weight)
+    """
+    names=[]
+    for f in files:
+        names+=dirfiles(f) if os.path.isdir(f) else [f]
+    if not names:
+        raise ValueError('no files to merge')
+    if weights is None:
+        return [(name,1) for name in names]
+    weights=[float(w) for w in weights.split(',')]
+    if len(weights)!=len(names):
+        raise ValueError('%d weights for %d files'%(len(weights),len(names)))
+    return zip(names,weights)
+
+def mergefiles(inputs,output,fmt,jobs,period=True,spec=None):
+    """
+        Merge many profiling files, eg. the same capture from hundreds of
+        hosts, into one profile, and write it to file 'output' in format
+        'fmt'(see writers). The files are split into groups scanned by
+        worker processes, and their partial profiles are merged in pairs,
+        level by level, by the workers too, so the time goes down with
+        the cores, and the memory is of the unique stacks, not of the
+        files.
+        args:
+            inputs: list of (file name, weight). The samples of a file are
+                multiplied by its weight, eg. to count each host the same
+            jobs: max number of worker processes, 1 to do it all in this
+                process
+            period: weight perf samples by their period
+            spec: framefilter spec applied to the stacks, None for none
+        return: (number of samples, number of unique stacks) of the merged
+            profile
+    """
+    sizes=[os.path.getsize(name) for name,weight in inputs]
+    whole=sum(sizes)
+    n=max(1,min(len(inputs),jobs*mergegroups))
+    groups=[]
+    done=0
+    for i,inp in enumerate(inputs):
+        if not groups or done>=whole*len(groups)/float(n):
+            groups.append([])
+        groups[-1].append(inp)
+        done+=sizes[i]
+    pool=multiprocessing.Pool(min(jobs,len(groups))) if jobs>1 else None
+    try:
+        mapper=pool.map if pool is not None else map
+        with meters.timer('merge.scan'):
+            parts=mapper(mergegroup,[(g,period,spec) for g in groups])
+        with meters.timer('merge.merge'):
+            while len(parts)>1:
+                pairs=zip(parts[0::2],parts[1::2])
+                parts=mapper(mergepair,pairs)+parts[len(pairs)*2:]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    names,owner,total,stk=parts[0]
+    syms=symtab()
+    syms.merge(names,owner)
+    stk=stacktab.load(stk)
+    out=gzip.open(output,'wb') if fmt=='pprof' else open(output,'w')
+    try:
+        writers[fmt](out,syms,stk)
+    finally:
+        out.close()
+    return total,len(stk)
+
+def instindex(inst,owner):
+    """
+        Group the instructions by their function.
+        args:
+            inst: instruction id -> samples
+            owner: function id of each instruction id
+        return: function id -> (instruction ids, samples) /dict of array
+    """
+    idx={}
+    for k,v in inst.iteritems():
+        ent=idx.get(owner[k])
+        if ent is None:
+            ent=idx[owner[k]]=(array('I'),array('L'))
+        ent[0].append(k)
+        ent[1].append(v)
+    return idx
+
+def insaddr(name,fsym):
+    """
+        Address of instruction 'name'(fn+off) of a function at fsym, a
+        (address, size). The offset is the address itself if it is not in
+        the function(perfconvert.pl writes so).
+        return: address, None if it can't be told
+    """
+    fn,sep,off=name.rpartition('+')
+    if not sep:
+        return None
+    try:
+        off=int(off.split('/')[0],16)
+    except ValueError:
+        return None
+    if off<fsym[1]:
+        return fsym[0]+off
+    if fsym[0]<=off<fsym[0]+fsym[1]:
+        return off
+    return None
+
+def findvmlinux():
+    """vmlinux of the running kernel, None if not found"""
+    for p in vmlinuxpaths:
+        p=p%(os.uname()[2])
+        if os.path.isfile(p):
+            return p
+    return None
+
+class symbolizer(object):
+    """
+        Resolve addresses of an ELF file to disassembly and source lines.
+        The symbols come from one 'nm' run. A function is disassembled by
+        one 'objdump' run over its address range. Source lines come from
+        one 'addr2line' process kept running, which is fed all addresses
+        of a query at once. Whatever is resolved is cached on disk, so the
+        tools aren't run again for it.
+        elf: path of the ELF file
+        syms: function name -> (address, size) /dict
+        lines: address -> (disassembly, source lines) /dict
+        dirty: lines got new entries since loaded or saved
+        a2l: the addr2line process, None if not started yet
+        lock: serializes queries, eg. of concurrent daemon clients
+    """
+    def __init__(self,elf):
+        os.stat(elf)
+        self.elf=elf
+        self.syms={}
+        self.lines={}
+        self.dirty=False
+        self.a2l=None
+        self.lock=threading.Lock()
+        try:
+            with open(self.cachefile(),'rb') as fd:
+                self.syms,self.lines=marshal.load(fd)
+            return
+        except (IOError,OSError,ValueError,EOFError,TypeError):
+            pass
+        out=subprocess.Popen(['nm','-S','--defined-only',elf],
+            stdout=subprocess.PIPE).communicate()[0]
+        for line in out.split('\n'):
+            f=line.split()
+            if len(f)==4 and f[2] in 'tTwW':
+                self.syms[f[3]]=(int(f[0],16),int(f[1],16))
+        self.dirty=True
+
+    def cachefile(self):
+        st=os.stat(self.elf)
+        key='%s:%d:%r'%(os.path.realpath(self.elf),st.st_size,st.st_mtime)
+        return os.path.join(symcachedir,
+            hashlib.md5(key).hexdigest()+'.kpsym')
+
+    def symbol(self,fn):
+        """(address, size) of function 'fn', None if not in the ELF"""
+        return self.syms.get(fn)
+
+    def resolve(self,fn,addrs):
+        """
+            Disassembly and source lines of addresses of function 'fn'.
+            return: address -> (disassembly, source lines) /dict
+        """
+        with self.lock:
+            todo=[a for a in addrs if a not in self.lines]
+            if todo:
+                dis=self.disassemble(fn)
+                starts=sorted(dis)
+                src=self.source(todo)
+                for a in todo:
+                    # an address may be in the middle of an instruction, eg.
+                    # a return address minus 1
+                    i=bisect.bisect_right(starts,a)-1
+                    ins=dis[starts[i]] if i>=0 else '?'
+                    self.lines[a]=(ins,src.get(a,[]))
+                self.dirty=True
+                self.save()
+            return dict((a,self.lines[a]) for a in addrs)
+
+    def disassemble(self,fn):
+        """address -> instruction, of all instructions of function 'fn'"""
+        start,size=self.syms[fn]
+        out=subprocess.Popen(['objdump','-d','-w','--no-show-raw-insn',
+            '--start-address=0x%x'%(start),'--stop-address=0x%x'%(start+size),
+            self.elf],stdout=subprocess.PIPE).communicate()[0]
+        dis={}
+        for line in out.split('\n'):
+            m=objdumppat.match(line)
+            if m:
+                dis[int(m.group(1),16)]=m.group(2).strip()
+        return dis
+
+    def source(self,addrs):
+        """
+            address -> source lines(innermost inlined function first), by
+            the addr2line process. An address 0 is sent after the others,
+            its output tells the end of the answer.
+        """
+        if self.a2l is None:
+            self.a2l=subprocess.Popen(['addr2line','-e',self.elf,'-a','-f',
+                '-i'],stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+        self.a2l.stdin.write(''.join('0x%x\n'%(a) for a in addrs+[0]))
+        self.a2l.stdin.flush()
+        src={}
+        lst=None
+        while True:
+            line=self.a2l.stdout.readline()
+            if not line:
+                self.a2l=None
+                break
+            line=line.strip()
+            if line.startswith('0x'):
+                a=int(line,16)
+                if a==0:
+                    self.a2l.stdout.readline()
+                    self.a2l.stdout.readline()
+                    break
+                lst=src[a]=[]
+                fn=None
+            elif fn is None:
+                fn=line
+            else:
+                lst.append('%s %s'%(line,fn))
+                fn=None
+        return src
+
+    def save(self):
+        """write the cache, failing to do so is not an error"""
+        if not self.dirty:
+            return
+        tmp='%s.%d'%(self.cachefile(),os.getpid())
+        try:
+            if not os.path.isdir(symcachedir):
+                os.makedirs(symcachedir)
+            with open(tmp,'wb') as fd:
+                marshal.dump((self.syms,self.lines),fd)
+            os.rename(tmp,self.cachefile())
+            self.dirty=False
+        except (IOError,OSError):
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+symbolizers={}
+symlock=threading.Lock()
+
+def getsymbolizer(elf):
+    """the symbolizer of ELF file 'elf', made once"""
+    with symlock:
+        sym=symbolizers.get(elf)
+        if sym is None:
+            sym=symbolizers[elf]=symbolizer(elf)
+        return sym
+
+class cmptable(object):
+    """
+        Samples of the same keys(functions, instructions or caller/callee
+        stacks) in N files side by side. Function and instruction keys
+        are symbol ids shared by all files, so with numpy the rows are
+        aligned by sorting and searching the ids, and all the math below
+        is vectorized. Without numpy, plain lists are used.
+        keys: key of each row /array or list
+        pct: percentage of each row in each file, 0 if the key is not in
+             the file /list of array or list
+        has: whether the key is in each file /list of array or list
+    """
+    def __init__(self,dicts,totals):
+        """
+            args:
+                dicts: key -> samples, of each file
+                totals: number of samples of each file
+        """
+        self.pct=[]
+        self.has=[]
+        ints=all(isinstance(k,(int,long)) for d in dicts for k in
+            itertools.islice(d,1))
+        if numpy is not None and ints:
+            ks=[numpy.fromiter(d.iterkeys(),numpy.int64,len(d))
+                for d in dicts]
+            self.keys=numpy.unique(numpy.concatenate(ks))
+            for d,k,total in zip(dicts,ks,totals):
+                rows=numpy.searchsorted(self.keys,k)
+                col=numpy.zeros(len(self.keys))
+                col[rows]=numpy.fromiter(d.itervalues(),numpy.float64,
+                    len(d))*100.0/total
+                has=numpy.zeros(len(self.keys),bool)
+                has[rows]=True
+                self.pct.append(col)
+                self.has.append(has)
+            return
+        pos={}
+        self.keys=[]
+        for d in dicts:
+            for k in d:
+                if k not in pos:
+                    pos[k]=len(self.keys)
+                    self.keys.append(k)
+        for d,total in zip(dicts,totals):
+            col=[0.0]*len(self.keys)
+            has=[False]*len(self.keys)
+            for k,v in d.iteritems():
+                col[pos[k]]=100.0*v/total
+                has[pos[k]]=True
+            if numpy is not None:
+                col=numpy.array(col)
+                has=numpy.array(has)
+            self.pct.append(col)
+            self.has.append(has)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self,j,d,total):
+        """
+            Redo the column of file j, whose samples changed, eg. it is
+            reloaded.
+            args:
+                d: key -> samples, of the file
+                total: number of samples of the file
+            return: False if the file has keys not in the table, which is
+            then to be built again
+        """
+        if numpy is not None and isinstance(self.keys,numpy.ndarray):
+            k=numpy.fromiter(d.iterkeys(),numpy.int64,len(d))
+            rows=numpy.searchsorted(self.keys,k)
+            if len(k) and (rows.max()>=len(self.keys) or
+                    (self.keys[rows]!=k).any()):
+                return False
+            col=numpy.zeros(len(self.keys))
+            col[rows]=numpy.fromiter(d.itervalues(),numpy.float64,
+                len(d))*100.0/total
+            has=numpy.zeros(len(self.keys),bool)
+            has[rows]=True
+        else:
+            pos=dict((k,i) for i,k in enumerate(self.keys))
+            if any(k not in pos for k in d):
+                return False
+            col=[0.0]*len(self.keys)
+            has=[False]*len(self.keys)
+            for k,v in d.iteritems():
+                col[pos[k]]=100.0*v/total
+                has[pos[k]]=True
+            if numpy is not None:
+                col=numpy.array(col)
+                has=numpy.array(has)
+        self.pct[j]=col
+        self.has[j]=has
+        return True
+
+    def delta(self,base,how):
+        """
+            Difference of each row between files.
+            args:
+                base: index of the baseline file
+                how: "last": last file(not the baseline) - baseline
+                     "max": the one of file - baseline with the largest
+                            absolute value
+                     "spread": largest - smallest percentage, ie. the
+                            largest difference between any 2 files
+            return: array or list
+        """
+        others=[j for j in range(len(self.pct)) if j!=base]
+        if numpy is not None:
+            if how=="last":
+                return self.pct[others[-1]]-self.pct[base]
+            if how=="spread":
+                m=numpy.vstack(self.pct)
+                return m.max(axis=0)-m.min(axis=0)
+            d=numpy.vstack([self.pct[j] for j in others])-self.pct[base]
+            return d[numpy.abs(d).argmax(axis=0),numpy.arange(len(self))]
+        if how=="last":
+            j=others[-1]
+            return [a-b for a,b in zip(self.pct[j],self.pct[base])]
+        if how=="spread":
+            return [max(r)-min(r) for r in zip(*self.pct)]
+        b=self.pct[base]
+        return [max((self.pct[j][i]-b[i] for j in others),key=abs)
+            for i in range(len(self))]
+
+    def top(self,val,n,rows=None):
+        """
+            Rows of the n largest values, in descending order. Only the top
+            n are selected and sorted, not all rows.
+            args:
+                val: value of each row, eg. from delta()
+                rows: only select from these rows if not None
+        """
+        if numpy is not None:
+            if rows is None:
+                rows=numpy.arange(len(val))
+            rows=numpy.asarray(rows,numpy.int64)
+            v=numpy.asarray(val)[rows]
+            if n<len(rows):
+                sel=numpy.argpartition(-v,n-1)[:n]
+                rows,v=rows[sel],v[sel]
+            return rows[numpy.argsort(-v,kind='mergesort')]
+        if rows is None:
+            rows=range(len(val))
+        return heapq.nlargest(n,rows,key=val.__getitem__)
+
+    def pcts(self,i):
+        """percentage of row i in each file, -100% if it is not in"""
+        return [self.pct[j][i] if self.has[j][i] else -100.0
+            for j in range(len(self.pct))]
+
+class jointable(object):
+    """
+        Samples of the same keys(functions or instructions) in N captures
+        of the same run, each taken on a different event, eg. cycles, cache
+        misses and TLB misses, joined into one table of metrics. The rows
+        are aligned by cmptable. Each event has its samples and its share
+        of all of them, and each event but the reference one, eg. cycles,
+        also has its samples per 1k samples of the reference event, and
+        its share over the share of the reference event. A function with
+        5% of the cycles and 20% of the cache misses has 4.00 there, it
+        misses more than its share of the time, ie. it is memory-bound.
+        keys: key of each row /array or list
+        names: name of each column /list
+        cols: value of each row in each column, nan for a ratio to no
+              reference samples /list of array or list
+        fmts: format of each column /list
+        ref: name of the share column of the reference event /str
+    """
+    def __init__(self,t,totals,events,ref):
+        """
+            args:
+                t: cmptable of the samples of each event
+                totals: number of samples of each event
+                events: name of each event
+                ref: index of the reference event
+        """
+        self.t=t
+        self.keys=t.keys
+        self.names=[]
+        self.cols=[]
+        self.fmts=[]
+        n=[self.scale(p,total/100.0) for p,total in zip(t.pct,totals)]
+        for e,c,p in zip(events,n,t.pct):
+            self.add(e,c,'%d')
+            self.add(e+'%',p,'%.2f%%')
+        for j,e in enumerate(events):
+            if j!=ref:
+                self.add(e+'/1k',self.ratio(n[j],n[ref],1000.0),'%.2f')
+                self.add('%s%%/%s%%' % (e,events[ref]),
+                    self.ratio(t.pct[j],t.pct[ref],1.0),'%.2f')
+        self.ref=events[ref]+'%'
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self,name,col,fmt):
+        self.names.append(name)
+        self.cols.append(col)
+        self.fmts.append(fmt)
+
+    @staticmethod
+    def scale(a,k):
+        """a*k of each row"""
+        if numpy is not None:
+            return a*k
+        return [x*k for x in a]
+
+    @staticmethod
+    def ratio(a,b,k):
+        """a*k/b of each row, nan where b is 0"""
+        if numpy is not None:
+            with numpy.errstate(divide='ignore',invalid='ignore'):
+                r=a*k/b
+            r[b==0]=numpy.nan
+            return r
+        return [x*k/y if y else float('nan') for x,y in zip(a,b)]
+
+    def top(self,name,n,minpct=0.0):
+        """
+            Rows of the n largest values of column 'name', in descending
+            order, those with no value last, see cmptable.top().
+            args:
+                minpct: only the rows with at least minpct% of the
+                    reference event
+        """
+        val=self.cols[self.names.index(name)]
+        ref=self.cols[self.names.index(self.ref)]
+        if numpy is not None:
+            val=numpy.where(numpy.isnan(val),-numpy.inf,val)
+            rows=numpy.flatnonzero(ref>=minpct) if minpct>0 else None
+        else:
+            val=[-float('inf') if v!=v else v for v in val]
+            rows=[i for i,p in enumerate(ref) if p>=minpct] if minpct>0 \
+                else None
+        return self.t.top(val,n,rows)
+
+    def row(self,i):
+        """the columns of row i, formatted, '-' for no value"""
+        return ['-' if c[i]!=c[i] else fmt % (round(c[i]) if fmt=='%d'
+            else c[i]) for c,fmt in zip(self.cols,self.fmts)]
+
+class layout(object):
+    """
+        Page size and NUMA node of address ranges, the layout map the
+        addresses of samples are binned by. Read from a file of 'start end
+        [size [node]]' lines, hex addresses with the end excluded, '-' for
+        a part not known, and '#' comments, eg.
+            0xffff888000000000 0xffff888040000000 1G 0
+            0xffff888040000000 0xffff888080000000 2M 1
+        starts, ends: of each range, in address order /list
+        sizes, nodes: page size(eg. '2M') and node of each range, None if
+              not known /list
+        pages, numa: column names of the page sizes, smallest first, and of
+              the nodes, '?' for not known or not in the map /list
+        pcol, ncol: column of each bin, ie. of each range and then of the
+              addresses not in the map /list
+    """
+    units={'':1,'K':1<<10,'M':1<<20,'G':1<<30,'T':1<<40}
+
+    def __init__(self,name):
+        """
+            args:
+                name: file name of the map
+            raise: IOError, or ValueError if a line is not right
+        """
+        ranges=[]
+        with open(name) as fd:
+            for n,line in enumerate(fd):
+                v=line.split('#')[0].split()
+                if not v:
+                    continue
+                try:
+                    if len(v)<2 or len(v)>4:
+                        raise ValueError
+                    start,end=int(v[0],16),int(v[1],16)
+                    size=v[2].upper() if len(v)>2 and v[2]!='-' else None
+                    if size is not None:
+                        self.pagebytes(size)
+                    node=int(v[3]) if len(v)>3 and v[3]!='-' else None
+                except ValueError:
+                    raise ValueError('%s:%d: not start end [size [node]]' % (
+                        name,n+1))
+                if start>=end:
+                    raise ValueError('%s:%d: empty range' % (name,n+1))
+                ranges.append((start,end,size,node))
+        ranges.sort()
+        for a,b in zip(ranges,ranges[1:]):
+            if b[0]<a[1]:
+                raise ValueError('%s: %x-%x overlaps %x-%x' % (name,a[0],a[1],
+                    b[0],b[1]))
+        self.starts=[r[0] for r in ranges]
+        self.ends=[r[1] for r in ranges]
+        self.sizes=[r[2] for r in ranges]
+        self.nodes=[r[3] for r in ranges]
+        self.pages=sorted(set(self.sizes)-set([None]),key=self.pagebytes)+[
+            '?']
+        self.numa=['N%d' % i for i in sorted(set(self.nodes)-set([None]))]+[
+            '?']
+        self.pcol=[self.pages.index(s or '?') for s in self.sizes+[None]]
+        self.ncol=[self.numa.index('?' if i is None else 'N%d' % i)
+            for i in self.nodes+[None]]
+
+    def __len__(self):
+        """number of bins"""
+        return len(self.starts)+1
+
+    @classmethod
+    def pagebytes(cls,size):
+        """'2M' -> 2097152, raise ValueError if it is not a size"""
+        m=re.match(r'(\d+)([KMGT]?)B?$',size)
+        if not m:
+            raise ValueError(size)
+        return int(m.group(1))*cls.units[m.group(2)]
+
+    def bins(self,addrs):
+        """
+            Bin of each address, the index of its range, or len(self)-1 if
+            it is not in the map.
+            args:
+                addrs: /array
+            return: array or list
+        """
+        if numpy is not None:
+            a=numpy.frombuffer(addrs,numpy.uint64)
+            starts=numpy.array(self.starts,numpy.uint64)
+            ends=numpy.array(self.ends+[0],numpy.uint64)
+            i=numpy.searchsorted(starts,a,'right').astype(numpy.int64)-1
+            i[i<0]=len(self.starts)
+            i[a>=ends[i]]=len(self.starts)
+            return i
+        lst=[]
+        for a in addrs:
+            i=bisect.bisect_right(self.starts,a)-1
+            lst.append(i if i>=0 and a<self.ends[i] else len(self.starts))
+        return lst
+
+    def fold(self,row,col,n):
+        """the samples of each bin in 'row' summed up by column 'col'"""
+        sums=[0]*n
+        for b,c in enumerate(row):
+            sums[col[b]]+=c
+        return sums
+
+def cmdparser(error):
+    """
+        Parser of the subcmds once files are opened, shared by the
+        interactive mode, the daemon and its client.
+        args:
+            error: called with the message on a parse error
+        return: (parser, help text)
+    """
+    desc1=textwrap.dedent('''\
+        file(s) opened
+        ''')
+    help1=textwrap.dedent('''\
+        subcommand:
+            quit: exit
+            open: open more files, or the files in a directory. It
+                returns right away, the files are loaded in the background
+                open file1|dir1 [file2 [file3 ...]]
+            ls:  list opened file and active files, how far the files
+                still loading are, and the memory each file takes or if it
+                is spilled(see --mem-budget)
+            close: forget opened files and what is loaded of them
+                close file1 [file2 ...]
+            pin: keep files in memory under --mem-budget, default the
+                active ones. -u lets them be spilled again
+                pin [-u] [-f file1 [file2 ...]]
+            reload: add what the files have grown by since they were
+                loaded, only the new bytes are scanned. A file written
+                again from the start is loaded again. Default all files
+                reload [file1 [file2 ...]]
+            merge: merge many files, eg. the same capture of hundreds of
+                hosts, into one profile written to output, and open it.
+                The files are scanned and merged by worker processes. -w
+                weights the samples of each file, the files of directories
+                in name order
+                merge -o output [-t folded|pprof] [-w w1,w2,...]
+                    file1|dir1 [file2 ...]
+            jobs: list the background jobs, how far those running are, or
+                how long those over took
+            fg: wait for a background job, default the last one, and print
+                its output
+                fg [n]
+            kill: cancel a background job, default the last one
+                kill [n]
+            stats: print how each opened file was loaded, its unique
+                stacks and symbols and the memory they take, and the time
+                spent in loading, diffing and sorting so far
+            help: print usage
+            in : print inclusive of one file or diff of files, or of the
+                functions matching 'pat' and of all of them taken as one
+                in [-f file1 [file2 ...]] [-n lines] [-b n] [-d delta]
+                    [--fail pct] [pat]
+            ex : print exclusive of one file or diff of files
+                ex [-f file1 [file2 ...]] [-n lines] [-b n] [-d delta]
+                    [--fail pct] [pat]
+            ina : print in & ex of one file, sorted by inclusive
+                ina [-f file1] [-n lines] [pat]
+            exa : print in & ex of one file, sorted by exclusive
+                exa [-f file1] [-n lines] [pat]
+            caller : print call stack to 'fn' 
+                caller [-f file1 [file2 ...]] [-n lines] [-s depth] fn
+            callee : print functions called by 'fn'
+                callee [-f file1 [file2 ...]] [-n lines] fn
+            func : print expensive instructions with 'fn'
+                func [-f file1 [file2 ...]] [-n lines] fn
+            annotate : print expensive instructions with 'fn', with their
+                disassembly and source lines from vmlinux(or another ELF)
+                annotate [-f file1] [-n lines] [-k vmlinux] fn
+            join : join the active files, captures of the same run on
+                different events(eg. cycles, cache misses, TLB misses),
+                by exclusive of each function, or by instruction of 'fn'.
+                Each event has its samples and share(%), and each one but
+                the baseline(the reference event, eg. cycles) its samples
+                per 1k reference samples(/1k), and its share over the
+                reference share(eg. misses%/cycles%, above 1 is
+                memory-bound)
+                join [-f file1 file2 ...] [-n lines] [-b n] [-e names]
+                    [-i] [-c column] [-m pct] [--from t] [--to t] [fn]
+            pages : bin the addresses of the samples(perf script -F +addr
+                or +phys_addr, or '! 0xaddr' lines) by the page size and
+                the NUMA node of their range in the layout map, and print
+                the histograms of all of them, of the top functions, or of
+                the stacks with 'fn'
+                pages [-f file1] [-n lines] [-s depth] [-m map] [fn]
+            topdown : print call tree from stack bottom, or below 'fn'
+                topdown [-f file1] [-n lines] [-s depth] [-p pct] [fn]
+            bottomup : print inverted call tree from stack top, or of
+                the callers of 'fn'
+                bottomup [-f file1] [-n lines] [-s depth] [-p pct] [fn]
+            tree : print heaviest path from stack bottom, or from 'fn'
+                tree [-f file1] [-s depth] [-p pct] [fn]
+            timeline : print inclusive of 'fn', or samples, per time slot
+                timeline [-f file1] [-w width] [--from t] [--to t] [fn]
+            export : write the stacks as collapsed stacks(folded), or as a
+                gzipped pprof profile
+                export [-f file1] [-t folded|pprof] [-o output] [--from t]
+                    [--to t]
+        options:
+            -n : number of lines displayed. For topdown and bottomup,
+                 number of children displayed per node
+            -s : depth of call stack. For topdown, bottomup and tree,
+                 depth of the tree, 0(default) means no limit
+            -p : prune branches below pct% of samples. Default 1
+            -w : seconds of a time slot of timeline. Default 1. For merge,
+                 comma separated weights the samples of each file are
+                 multiplied by. Default 1 each
+            -k : vmlinux, or ELF file, of annotate. By default the one of
+                 the running kernel in the usual places
+            -t : format of export and merge. Default folded
+            -e : comma separated event names of the active files of join.
+                 Default the file names
+            -i : join by inclusive
+            -c : column join sorts by. Default the reference samples
+            -m : only join the rows with at least pct% of the reference
+                 samples. Default 0. For pages, the layout map, a file of
+                 'start end [size [node]]' lines, hex addresses, '-' for
+                 not known. Default the one of --layout
+            -o : output file of export. Default the standard output, pprof
+                 needs one. Output file of merge
+            --from, --to : only count samples in this time window, in
+                 seconds from the start of each file. For in, ex, ina, exa,
+                 caller, callee, timeline, export and join(not of the
+                 instructions of a fn). Files need timestamps, which perf
+                 script output has
+            --cpu, --pid, --comm : only count samples on these cpus, of
+                 these pids or comms, comma separated. For in, ex, ina,
+                 exa, caller and callee. perf script output has them, and
+                 the '! comm pid [cpu]' lines profile.ebpf writes
+            --by : cpu, pid or comm. Show in, ex, ina, exa, caller or
+                 callee for each cpu, pid or comm, the ones with the most
+                 samples first, up to -n of them
+            -f : file(s) to operate on(-f file1, or -f file1 file2 ...)
+            -b : index of the active file as the baseline of the diff.
+                 Default 0, the first one
+            -d : diff column of in, ex, caller, callee and func.
+                 last(default): last file - baseline
+                 max: file - baseline with the largest absolute value
+                 spread: largest - smallest percentage of all files
+            --fail : tell the functions of which the diff column of in or
+                 ex is over pct%, eg. whose inclusive grew by more than
+                 pct% of the samples. --batch exits with 1 then
+
+        Notes:
+            Profiling files need to be opened first before any kind of
+            post processing can be done. In theory, there is no limit
+            by this tool itself on the number of files opened. Keeping
+            the file open is very convenient when the files are pretty
+            large since the pre-processed files are saved in memory, so
+            all subsequent processes are fast.
+
+            Active files are those subcmds operate on if '-f' is not
+            specified by the subcmd. Active files must be subset of
+            opened files. There are at least 1 active file. If there are
+            more, all those subcmds which need files are working in diff
+            mode -- the percentage of each file and their difference are
+            displayed. By default, active files are the first 2 files
+            opened, or all the files given on the command line. Then
+            afterwards, if any subcmd specifies '-f' opention, the file(s)
+            becomes the active one(s)
+
+            'ls' subcmd lists all opened and active files. '-f' accepts
+            either the file name or the opened file index
+
+            'fn' of caller, callee, func, join, pages and timeline, and
+            'pat' of in, ex, ina and exa, can be a glob, eg. 'tcp_*', or a
+            regex between slashes, eg. '/^ext4_.*write/', matching many
+            functions, which are then taken as one. Tab completes the
+            subcmds, function names, opened files after -f and paths of
+            open and merge
+
+            ^C cancels the subcmd running, and the opened files stay
+            loaded. A subcmd ending with '&' runs in the background, eg.
+            'caller -s 100 fn &', and the prompt is back right away. Its
+            output is kept until 'fg'. A subcmd taking long, or waiting for
+            files still loading, tells how far it is and how long it may
+            still take. open, reload and merge can't be cancelled, and
+            don't run while there are background jobs
+        ''')
+
+    def addargs(subparser,cmd,add_fn,depth=1):
+        if add_fn:          
+            subparser.add_argument("fn",nargs=1)
+        subparser.add_argument("-n","--lines", type=int, default=20)
+        subparser.add_argument("-s","--depth", type=int, default=depth)
+        subparser.add_argument("-f","--files", nargs='+', type=str)
+        subparser.add_argument("-b","--baseline", type=int, default=0)
+        subparser.add_argument("-d","--delta", default='last',
+            choices=['last','max','spread'])
+        subparser.set_defaults(func=cmd)
+
+    parser1=argparse.ArgumentParser(description=desc1, epilog=help1,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser1.error=error
+    parser1.exit=error
+    subparsers=parser1.add_subparsers(help=help1)
+    sub_quit=subparsers.add_parser('quit')
+    sub_quit.set_defaults(func='quit')
+    sub_help=subparsers.add_parser('help')
+    sub_help.set_defaults(func='help')
+    sub_ls=subparsers.add_parser('ls')
+    sub_ls.set_defaults(func='ls')
+    sub_stats=subparsers.add_parser('stats')
+    sub_stats.set_defaults(func='stats')
+    sub_open=subparsers.add_parser('open')
+    sub_open.add_argument('files',nargs='+')
+    sub_open.set_defaults(func='open')
+    sub_reload=subparsers.add_parser('reload')
+    sub_reload.add_argument('files',nargs='*')
+    sub_reload.set_defaults(func='reload')
+    sub_close=subparsers.add_parser('close')
+    sub_close.add_argument('files',nargs='+')
+    sub_close.set_defaults(func='close')
+    sub_pin=subparsers.add_parser('pin')
+    sub_pin.add_argument("-f","--files", nargs='+', type=str)
+    sub_pin.add_argument("-u","--unpin",action='store_true')
+    sub_pin.set_defaults(func='pin')
+    sub_merge=subparsers.add_parser('merge')
+    sub_merge.add_argument('files',nargs='+')
+    sub_merge.add_argument("-o","--output",required=True)
+    sub_merge.add_argument("-t","--type", choices=['folded','pprof'],
+        default='folded')
+    sub_merge.add_argument("-w","--weights")
+    sub_merge.set_defaults(func='merge')
+    sub_jobs=subparsers.add_parser('jobs')
+    sub_jobs.set_defaults(func='jobs')
+    for t in ['fg','kill']:
+        sub=subparsers.add_parser(t)
+        sub.add_argument('job',nargs='?',type=lambda v:int(v.lstrip('%')))
+        sub.set_defaults(func=t)
+    sub_caller=subparsers.add_parser('caller')
+    addargs(sub_caller,"caller",1)
+    sub_callee=subparsers.add_parser('callee')
+    addargs(sub_callee,"callee",1)
+    sub_func=subparsers.add_parser('func')
+    addargs(sub_func,"func",1)
+    sub_annotate=subparsers.add_parser('annotate')
+    addargs(sub_annotate,"annotate",1)
+    sub_annotate.add_argument("-k","--vmlinux")
+    sub_join=subparsers.add_parser('join')
+    addargs(sub_join,"join",0)
+    sub_join.add_argument("fn",nargs='?')
+    sub_join.add_argument("-e","--events")
+    sub_join.add_argument("-i","--incl",action='store_true')
+    sub_join.add_argument("-c","--column")
+    sub_join.add_argument("-m","--min",type=float,default=0.0)
+    sub_pages=subparsers.add_parser('pages')
+    addargs(sub_pages,"pages",0,depth=4)
+    sub_pages.add_argument("fn",nargs='?')
+    sub_pages.add_argument("-m","--map")
+    sub_in=subparsers.add_parser('in')
+    addargs(sub_in,"in",0)
+    sub_ex=subparsers.add_parser('ex')
+    addargs(sub_ex,"ex",0)
+    for sub in [sub_in,sub_ex]:
+        sub.add_argument("--fail", type=float)
+    sub_ina=subparsers.add_parser('ina')
+    addargs(sub_ina,"ina",0)
+    sub_exa=subparsers.add_parser('exa')
+    addargs(sub_exa,"exa",0)
+    for sub in [sub_in,sub_ex,sub_ina,sub_exa]:
+        sub.add_argument("fn",nargs='?')
+    for t in ['topdown','bottomup','tree']:
+        sub_tree=subparsers.add_parser(t)
+        addargs(sub_tree,t,0,depth=0)
+        sub_tree.add_argument("fn",nargs='?')
+        sub_tree.add_argument("-p","--pct", type=float, default=1.0)
+    sub_timeline=subparsers.add_parser('timeline')
+    addargs(sub_timeline,"timeline",0)
+    sub_timeline.add_argument("fn",nargs='?')
+    sub_timeline.add_argument("-w","--width", type=float, default=1.0)
+    sub_export=subparsers.add_parser('export')
+    addargs(sub_export,"export",0)
+    sub_export.add_argument("-t","--type", choices=['folded','pprof'],
+        default='folded')
+    sub_export.add_argument("-o","--output")
+    for t in windowcmds:
+        sub=subparsers.choices[t]
+        sub.add_argument("--from", type=float)
+        sub.add_argument("--to", type=float)
+    for t in dimcmds:
+        adddimargs(subparsers.choices[t])
+    return parser1,help1
+
+def intlist(v):
+    """'1,2,3' -> [1, 2, 3]"""
+    return [int(x) for x in v.split(',')]
+
+def adddimargs(parser):
+    """add --cpu, --pid, --comm and --by to 'parser'"""
+    parser.add_argument("--cpu", help="only count samples on these cpus, "
+                        "eg. 0,3", type=intlist)
+    parser.add_argument("--pid", help="only count samples of these pids",
+                        type=intlist)
+    parser.add_argument("--comm", help="only count samples of these comms, "
+                        "eg. nginx,mysqld", type=lambda v:v.split(','))
+    parser.add_argument("--by", help="break the samples down by cpu, pid "
+                        "or comm", choices=['cpu','pid','comm'])
+
+def dimsel(args):
+    """
+        The samples to keep by --cpu, --pid and --comm of 'args'
+        return: 'cpu', 'pid' or 'comm' -> set of values, None if none of
+        them is given
+    """
+    sel={}
+    for k in ['cpu','pid','comm']:
+        if getattr(args,k,None) is not None:
+            sel[k]=set(getattr(args,k))
+    return sel or None
+
+class loadqueue(object):
+    """
+        Opened files waiting to be loaded by the background loader, see
+        doit.openfile(). It is shared by the copies of doit, eg. those the
+        daemon runs subcmds on.
+        pending: index of the opened files nobody has started to load yet
+                 /list
+        loading: index of a file being loaded -> function returning how
+                 much of it is loaded, 0.0 to 1.0, or None if not known
+                 /dict
+        since: index of a file being loaded -> when it started /dict
+        cv: guards the others /threading.Condition
+        thread: the background loader, None if there is none
+                /threading.Thread
+        urgent: number of files callers of doit.wait() are loading
+                themselves, the loader pauses while there is any
+        stopping: stop loading in the background, see doit.stop()
+    """
+    def __init__(self):
+        self.pending=[]
+        self.loading={}
+        self.since={}
+        self.cv=threading.Condition()
+        self.thread=None
+        self.urgent=0
+        self.stopping=False
+
+class stopped(Exception):
+    """The background loader is stopped, see doit.stop()"""
+
+class cancelled(Exception):
+    """The subcmd of a job is cancelled, see job"""
+
+class refused(Exception):
+    """A subcmd of --batch can't be done as asked, see doit.refuse()"""
+
+# the job each thread runs, see checkpoint()
+jobtls=threading.local()
+
+def checkpoint(progress=None):
+    """
+        Called by subcmds every so often. Tell how far the subcmd is, and
+        stop it there if its job is cancelled. Nothing is done by threads
+        running no job, eg. the background loader or the daemon.
+        args:
+            progress: how far the subcmd is, 0.0 to 1.0, or a function
+                returning that. None to leave it as it is
+        raise: cancelled if the job of this thread is cancelled
+    """
+    j=getattr(jobtls,'job',None)
+    if j is None:
+        return
+    if progress is not None:
+        j.report(progress)
+    if j.cancel.is_set():
+        raise cancelled()
+
+@contextlib.contextmanager
+def nocancel():
+    """run the block as no job, so it is not cancelled halfway"""
+    j=getattr(jobtls,'job',None)
+    jobtls.job=None
+    try:
+        yield
+    finally:
+        jobtls.job=j
+
 class doit(object):
     def __init__(self,args):
         """
         files: fd /type if list
+        fmt: format of each file, 'kpstk' or 'perf' /list
         fmap: file name -> fd /dict
         handle: index of opened files which are now active /list
         fname: file name of opened files which are now active /list
         total: number of samples for each file /list
-        incl: inclusive of each func for each file /dict list
+        syms: function and function+offset ids of all files /symtab
+        incl: inclusive of each func id for each file /dict list
         excl: exclusive /dict list
-        caller_callee: each individual stack for each file /dict list
-        inst: instruction level of each func for each file /dict list
-        excldiff: exclusive difference between 2 files /list
-        instdiff: instruction difference between 2 files /list
-        incldiff: inclusive difference between 2 files /list
+        caller_callee: each individual stack for each file /stacktab list
+        cct: calling context tree of each file, None until it is used,
+             see calltree() /cctree list
+        inst: instruction level(function+offset id) of each func for each
+              file /dict list
+        finst: function id -> (instruction ids, samples) of the function,
+               for each file. Built from inst at load /dict list
+        excldiff: exclusive of active files side by side, None if not
+                  built yet /cmptable
+        incldiff: inclusive of active files side by side /cmptable
+        ccmemo: (file, cmd, fn, depth) -> (result of cc_helper, recursive)
+                /dict
+        memolock: held while ccmemo is used. The copies of doit running
+                  background jobs, daemon and --batch queries share ccmemo
+                  /threading.Lock
         lines: lines to display for the subcmd. Default 20
         depth: call stack depth to show for caller
+        baseline: index of the active file the others are compared to
+        delta: how the diff column is calculated, see cmptable.delta()
+        pct: branches of call trees below pct% of samples are pruned
+        noindex: don't read or write the index sidecar
+        jobs: max number of worker processes to scan files, no more than
+              the CPUs. Files under parallelmin are scanned serially
+        period: weight perf samples by their period
+        vmlinux: ELF file of annotate, None to look for the running kernel's
+        sketch: load files approximately, keeping about this many functions,
+                instructions and stacks per file, see sketch. 0 for exact
+        loadinfo: how each file was loaded, 'scan', 'parallel' or 'index',
+                  the seconds it took and its size in bytes(None for the
+                  standard input) /tuple list
+        timings: print the wall time of each subcmd and load
+        ready: set once each file is loaded /threading.Event list
+        loadq: files to load in the background /loadqueue
+        tail: where the loaded stacks of each file end, and the digest of
+              the tailcheck bytes before that, see tailsum(). None if the
+              rest of the file can't be added as it grows, eg. it is the
+              standard input, a pprof, or loaded approximately /tuple list
+        stamp: inode, size and mtime of each file when it was loaded, None
+               for the standard input /tuple list
+        follow: seconds between checking the files for growing, None not
+                to follow them
+        filt: what of the stacks is loaded, None for all of them
+              /framefilter
+        bgjobs: background jobs of the interactive mode, by job number. A
+                job is kept until 'fg' takes its output /dict
+        fail: the diff of in and ex a function fails the subcmd over, in %,
+              None for no threshold
+        rows: the rows of the tables the subcmd prints, key and column ->
+              value, kept for --batch. None not to keep them /list
+        failed: the rows over the fail threshold, key and diff, kept for
+                --batch. None not to keep them, ie. not in --batch /list
+        cands: the candidates of the last tab completion, see complete()
+               /list
+        membudget: bytes the loaded files may take, the least recently used
+                   inactive ones are spilled over it, see budget(). None for
+                   no limit
+        mem: bytes each file takes when it is in memory, see memparts()
+             /list
+        spilled: temporary file each spilled file is written to, None if
+                 it is in memory /list
+        used: when each file was last used by a subcmd /list
+        clock: ticks of used /itertools.count
+        pinned: files which are never spilled /set
+        users: file -> number of subcmds using it, which is not spilled
+               then. Shared by the copies of doit /dict
+        using: files the subcmd running uses, see run(). None out of a
+               subcmd /list
+        memlock: held while files are spilled or brought back
+                 /threading.RLock
         """
         self.files=[]
+        self.fmt=[]
+        self.syms=symtab()
         self.incl=[]
         self.excl=[]
         self.inst=[]
+        self.finst=[]
         self.caller_callee=[]
+        self.cct=[]
         self.coalesce=[]
         self.total=[]
-        self.incldiff={}
-        self.excldiff={}
-        self.instdiff={}
+        self.loadinfo=[]
+        self.tail=[]
+        self.stamp=[]
+        self.ready=[]
+        self.loadq=loadqueue()
+        self.incldiff=None
+        self.excldiff=None
+        self.ccmemo={}
+        self.memolock=threading.Lock()
+        self.cands=[]
         self.fmap={}
         self.handle=[]
         self.fname=[]
         self.lines=args.lines
         self.depth=args.depth
+        self.baseline=args.baseline
+        self.delta=args.delta
+        self.pct=1.0
+        self.noindex=args.noindex
+        self.jobs=max(1,min(args.jobs,multiprocessing.cpu_count()))
+        self.period=not args.noperiod
+        self.vmlinux=args.vmlinux
+        self.sketch=args.sketch
+        self.timings=args.timings
+        self.follow=args.follow
+        self.layout=args.layout
+        self.filt=args.filt and framefilter(args.filt)
+        self.bgjobs={}
+        self.fail=None
+        self.rows=None
+        self.failed=None
+        self.membudget=args.mem_budget and args.mem_budget*1e6
+        self.mem=[]
+        self.spilled=[]
+        self.used=[]
+        self.clock=itertools.count(1)
+        self.pinned=set()
+        self.users={}
+        self.using=None
+        self.memlock=threading.RLock()
         self.openfile(args.files)
 
+    def stats(self):
+        """
+            Handle stats. For each opened file, how it was loaded and how
+            fast, its samples, unique stacks and symbols, and roughly the
+            memory of each of its structures, see memsize(). Then the time
+            spent in the hot paths and the hits of the memos so far.
+        """
+        mb=mbytes
+        for name,fd in sorted(self.fmap.iteritems(),
+                key=lambda (k,v):self.files.index(v)):
+            f=self.files.index(fd)
+            if not self.ready[f].is_set():
+                print('%d:%s(%s):%s' % (f,name,self.fmt[f],self.loadstate(f)))
+                continue
+            if self.spilled[f] is not None:
+                print('%d:%s(%s): spilled, samples %d, memory %s' % (f,name,
+                    self.fmt[f],self.total[f],mb(self.mem[f])))
+                continue
+            how,secs,size=self.loadinfo[f] or ('?',0.0,None)
+            stk=self.caller_callee[f]
+            rate='' if size is None else ', %s, %.1fMB/s' % (mb(size),
+                size/1e6/max(secs,1e-6))
+            print('%d:%s(%s): %s in %.3fs%s' % (f,name,self.fmt[f],how,secs,
+                rate))
+            print('\tsamples %d, unique stacks %d, frames %d, functions %d, '
+                'instructions %d' % (self.total[f],len(stk),len(stk.frames),
+                len(self.incl[f]),len(self.inst[f])))
+            print('\ttime buckets %d, cpu/pid/comm %d, rows %d, address '
+                'samples %d' % (stk.buckets(),len(stk.dims)-1,len(stk.rstk),
+                len(stk.astk)))
+            sizes=[(k,memsize(v)) for k,v in self.memparts(f)]
+            print('\tmemory %s: %s' % (mb(sum(n for k,n in sizes)),
+                ', '.join('%s %s' % (k,mb(n)) for k,n in sizes)))
+        print('symbols %d: %s, memo: caller/callee %d' % (len(self.syms.names),
+            mb(memsize(vars(self.syms).values())),len(self.ccmemo)))
+        with meters.lock:
+            times=sorted(meters.times.iteritems())
+            hits=sorted(meters.hits.iteritems())
+        print('Time\t\t\tcalls\tseconds\tavg(ms)')
+        for k,(n,secs) in times:
+            print('%-20s\t%d\t%.3f\t%.3f' % (k,n,secs,1000.0*secs/n))
+        for k,(hit,miss) in hits:
+            print('%-20s\thits %d, misses %d' % (k,hit,miss))
+
+    def memparts(self,f):
+        """
+            The structures of loaded file 'f' for memsize().
+            return: (name, structure) /list
+        """
+        stk=self.caller_callee[f]
+        return [('incl',self.incl[f]),('excl',self.excl[f]),
+            ('inst',self.inst[f]),('finst',self.finst[f]),
+            ('stacks',[v for k,v in vars(stk).iteritems()
+                if k not in ('times','rows','hashes')]),
+            ('cct',vars(self.cct[f]).values() if self.cct[f] else [])]
+
     def listfile(self):
         """
             List opened files and active files.
-            opened files: all those opened and loaded profiling files
-            active files: 1 or 2. Default files being worked on if not
+            opened files: all those opened profiling files, how far those
+                          still loading are, and the memory each takes or
+                          if it is spilled
+            active files: 1 or more. Default files being worked on if not
                           specified
         """
         print("Opened file(s):")
         for f in self.fmap:
-            print('\t%s'%(self.files.index(self.fmap[f])),end=':')
-            print(f)
+            i=self.files.index(self.fmap[f])
+            print('\t%s'%(i),end=':')
+            print(f+self.loadstate(i)+self.memstate(i))
         print("active file(s):")
         for i in range(len(self.handle)):
             print('\t%s'%(self.handle[i]),end=':')
             print(self.fname[i])
+        files=[self.files.index(fd) for fd in self.fmap.itervalues()]
+        resident=sum(self.mem[f] or 0 for f in files
+            if self.spilled[f] is None)
+        print('memory: %s resident, %d spilled%s' % (mbytes(resident),
+            sum(1 for f in files if self.spilled[f] is not None),
+            '' if self.membudget is None else ', budget %s' % (
+            mbytes(self.membudget))))
+
+    def memstate(self,f):
+        """
+            The memory opened file 'f' takes, eg. ' (12.3MB)', if it is
+            spilled, ' (spilled 12.3MB)', and if it is pinned. '' if it is
+            not loaded yet.
+        """
+        if self.mem[f] is None:
+            return ''
+        return ' (%s%s%s)' % ('' if self.spilled[f] is None else 'spilled ',
+            mbytes(self.mem[f]),', pinned' if f in self.pinned else '')
+
+    def activate(self,files):
+        """
+            Make the opened files the active ones.
+            args:
+                files: names of opened files
+        """
+        self.handle=[self.files.index(self.fmap[f]) for f in files]
+        self.fname=list(files)
+        self.incldiff=None
+        self.excldiff=None
 
     def openfile(self,files):
         """
-            Open the profiling files
+            Open the profiling files. They are only registered here, and
+            loaded by a background thread, the active ones first, then the
+            others in the order they are opened. A subcmd waits for its
+            active files only, see wait().
+            A directory opens the files in it.
+            '-' is the standard input, eg. perf script |post-kp.py -. It is
+            loaded before returning.
+            Files which don't exist are told once the others are opened.
         """
+        missing=[]
         for f in files:
+            if f!='-' and os.path.isdir(f):
+                self.openfile(dirfiles(f))
+                continue
             if f in self.fmap:
                 continue
             try:
-                fd=open(f,'r');
+                if f=='-':
+                    fd=sys.stdin
+                    head=[]
+                    for line in fd:
+                        head.append(line)
+                        if len(head)>=sniffmax:
+                            break
+                    self.fmt.append(fileformat(head))
+                    fd=itertools.chain(head,fd)
+                else:
+                    fd=open(f,'rb');
+                    self.fmt.append(fileformat(fd.read(1<<16).split('\n')))
+                    fd.seek(0)
                 self.files.append(fd)
                 self.fmap[f]=fd
+                for lst in (self.total,self.finst,self.inst,self.excl,
+                        self.incl,self.caller_callee,self.cct,self.loadinfo,
+                        self.tail,self.stamp,self.mem,self.spilled):
+                    lst.append(None)
+                self.used.append(0)
+                self.clear(len(self.files)-1)
+                self.ready+=[threading.Event()]
                 if len(self.handle)<2:
-                    self.handle.append(len(self.files)-1)
-                    self.fname.append(f)
-                self.total+=[0]
-                self.inst+=[{}]
-                self.excl+=[{}]
-                self.incl+=[{}]
-                self.caller_callee+=[{}]
-                self.loadfile(fd)
+                    self.activate(self.fname+[f])
             except IOError:
+                missing.append(f)
+                continue
+            if f=='-':
+                self.load(len(self.files)-1)
+                continue
+            q=self.loadq
+            with q.cv:
+                q.pending.append(len(self.files)-1)
+                if q.thread is None:
+                    q.thread=threading.Thread(target=self.loadnext)
+                    q.thread.daemon=True
+                    q.thread.start()
+        if missing:
+            self.refuse('\n'.join('%s not exist!!'%(f) for f in missing))
+
+    def clear(self,f):
+        """Empty what is loaded of opened file 'f'"""
+        self.total[f]=0
+        self.finst[f]={}
+        if self.sketch:
+            self.inst[f]=sketch(self.sketch)
+            self.excl[f]=sketch(self.sketch)
+            self.incl[f]=sketch(self.sketch)
+            self.caller_callee[f]=stacksketch(self.sketch)
+        else:
+            self.inst[f]={}
+            self.excl[f]={}
+            self.incl[f]={}
+            self.caller_callee[f]=stacktab()
+        self.cct[f]=None
+        self.loadinfo[f]=None
+        self.tail[f]=None
+        self.stamp[f]=None
+
+    def reset(self,f,name):
+        """
+            Forget what is loaded of opened file 'f', to load it again from
+            the start. It is opened again, in case it is replaced by
+            another file.
+            args:
+                name: name of the file
+        """
+        fd=open(name,'rb')
+        self.fmt[f]=fileformat(fd.read(1<<16).split('\n'))
+        fd.seek(0)
+        self.files[f].close()
+        self.files[f]=fd
+        self.fmap[name]=fd
+        self.clear(f)
+        self.forget(f)
+        self.ready[f].clear()
+
+    def loadnext(self):
+        """
+            The background loader. Load the pending files one by one, an
+            active one first if any, until there is none left.
+        """
+        q=self.loadq
+        while 1:
+            with q.cv:
+                if not q.pending:
+                    q.thread=None
+                    return
+                f=min(q.pending,key=lambda f:(f not in self.handle,f))
+                q.pending.remove(f)
+            try:
+                self.load(f)
+            except stopped:
+                return
+
+    def stop(self):
+        """
+            Stop the background loader before exiting. A file it is
+            scanning is left as it is, one it has loaded gets its index
+            saved first.
+        """
+        q=self.loadq
+        with q.cv:
+            q.stopping=True
+            del q.pending[:]
+            q.cv.notify_all()
+            loader=q.thread
+        if loader is not None:
+            loader.join()
+
+    def wait(self,files=None):
+        """
+            Wait until the files are loaded. If the background loader is
+            busy with another file, a file nobody has started to load yet
+            is loaded right away by the caller, instead of after that one.
+            Otherwise it is left to the loader, which takes the active
+            files first, so that the files are loaded one at a time and
+            their symbols get the same ids every time.
+            A spilled file is brought back, and within run() the files are
+            not spilled until the subcmd is over, see using.
+            args:
+                files: indexes of opened files, None for all of them
+            return: names of the files which failed to load
+        """
+        q=self.loadq
+        failed=[]
+        files=([f for f,fd in enumerate(self.files) if fd is not None]
+            if files is None else files)
+        def done():
+            n=0.0
+            for f in files:
+                if self.ready[f].is_set():
+                    n+=1
+                else:
+                    n+=(q.loading.get(f) or (lambda:0))() or 0
+            return n/max(len(files),1)
+        for f in files:
+            with q.cv:
+                mine=f in q.pending and len(q.loading)>0
+                if mine:
+                    q.pending.remove(f)
+                    q.urgent+=1
+            if mine:
+                # a file half loaded is not to be left so
+                try:
+                    with nocancel():
+                        self.load(f)
+                finally:
+                    with q.cv:
+                        q.urgent-=1
+                        q.cv.notify_all()
+            # a timeout, so that ^C still works while waiting
+            while not self.ready[f].is_set():
+                checkpoint(done)
+                self.ready[f].wait(0.5)
+            if self.loadinfo[f][0]=='failed':
+                failed+=[k for k,v in self.fmap.iteritems()
+                    if v is self.files[f]]
+        with self.memlock:
+            for f in files:
+                if self.spilled[f] is not None:
+                    self.unspill(f)
+                self.used[f]=next(self.clock)
+                if self.using is not None:
+                    self.users[f]=self.users.get(f,0)+1
+                    self.using.append(f)
+        self.budget()
+        return failed
+
+    def pause(self):
+        """
+            Called by loading every so often. The background loader waits
+            here while a caller of wait() loads a file itself, so the
+            caller doesn't share the cpu with it.
+        """
+        q=self.loadq
+        if threading.current_thread() is not q.thread:
+            return
+        if q.urgent:
+            with q.cv:
+                while q.urgent and not q.stopping:
+                    q.cv.wait(1.0)
+        if q.stopping:
+            raise stopped()
+
+    def paused(self,lines):
+        """
+            'lines', calling pause() every pauselines lines. They are
+            taken in blocks, so there is no python code run per line.
+        """
+        lines=iter(lines)
+        block=lambda:self.pause() or list(itertools.islice(lines,pauselines))
+        return itertools.chain.from_iterable(iter(block,[]))
+
+    def loadstate(self,f):
+        """
+            How far opened file 'f' is loaded, and how long it may still
+            take, eg. ' (loading 40%, ETA 3s)', '' if it is loaded.
+        """
+        if self.ready[f].is_set():
+            return ' (failed)' if self.loadinfo[f][0]=='failed' else ''
+        done=self.loadq.loading.get(f)
+        since=self.loadq.since.get(f)
+        if done is None:
+            return ' (queued)'
+        done=done()
+        if done is None:
+            return ' (loading)'
+        if not done or since is None:
+            return ' (loading %d%%)' % (100*done)
+        return ' (loading %d%%, ETA %ds)' % (100*done,
+            math.ceil((time.time()-since)*(1-done)/done))
+
+    def load(self,f):
+        """
+            Load opened file 'f', from its index if it has a usable one,
+            else scan it, by worker processes if it is big, and save its
+            index. Errors reading it are told, and it is loaded as far as
+            it is read.
+        """
+        q=self.loadq
+        fd=self.files[f]
+        name=[k for k,v in self.fmap.iteritems() if v is fd][0]
+        st=os.fstat(fd.fileno()) if isinstance(fd,file) else None
+        q.loading[f]=lambda:None
+        start=q.since[f]=time.time()
+        how='failed'
+        try:
+            if st is None:
+                self.loadfile(fd)
+                how='scan'
+            else:
+                self.stamp[f]=(st.st_ino,st.st_size,st.st_mtime)
+                how=self.loadindex(name,fd) or self.scanfile(f,st.st_size)
+            # saved before the file is ready, a reload must not change
+            # it while it is written
+            if how in ['scan','parallel','tail'] and st is not None:
+                self.saveindex(name,fd)
+        except stopped:
+            raise
+        except Exception as e:
+            # a file which is not what its format says, eg. truncated or
+            # garbled, fails alone rather than the loader with it
+            print('%s failed to load: %s!!'%(name,e))
+        finally:
+            self.loaded(fd,how,time.time()-start)
+            q.loading.pop(f,None)
+            q.since.pop(f,None)
+            self.ready[f].set()
+
+    def scanfile(self,f,size):
+        """
+            load() of a file which has no usable index. Scan it, by worker
+            processes if it is big.
+            args:
+                size: size of the file
+            return: 'parallel' or 'scan'
+        """
+        q=self.loadq
+        fd=self.files[f]
+        if (self.jobs>1 and size>=parallelmin and
+                scanners[self.fmt[f]][1] is not None):
+            name=[k for k,v in self.fmap.iteritems() if v is fd][0]
+            self.loadparallel([(name,fd,size)])
+            self.endtail(f,size)
+            return 'parallel'
+        q.loading[f]=lambda:os.lseek(fd.fileno(),0,
+            os.SEEK_CUR)/float(max(size,1))
+        fd.seek(0)
+        self.loadfile(fd,self.paused(fd)
+            if threading.current_thread() is q.thread else None)
+        # where the scan stopped, the file may have grown since
+        self.endtail(f,os.lseek(fd.fileno(),0,os.SEEK_CUR))
+        return 'scan'
+
+    def endtail(self,f,seen):
+        """
+            Keep where the loaded stacks of file 'f' end, once the first
+            'seen' bytes of it are scanned, see tail.
+        """
+        fmt=self.fmt[f]
+        if fmt=='pprof' or self.sketch:
+            self.tail[f]=None
+            return
+        fd=self.files[f]
+        end=stackend(fd,fmt,seen)
+        # scan() leaves out a last stack with no '!' after it, the other
+        # scanners count it, even if it is still being written
+        if fmt!='kpstk' and end<seen:
+            self.tail[f]=None
+        else:
+            self.tail[f]=(end,tailsum(fd,end))
+
+    def loaded(self,fd,how,secs):
+        """
+            Keep how file 'fd' was loaded in loadinfo, and tell it if
+            --timings.
+        """
+        f=self.files.index(fd)
+        size=os.fstat(fd.fileno()).st_size if isinstance(fd,file) else None
+        self.loadinfo[f]=(how,secs,size)
+        self.mem[f]=sum(memsize(v) for k,v in self.memparts(f))
+        self.budget()
+        if self.timings:
+            name=[k for k,v in self.fmap.iteritems() if v is fd][0]
+            rate='' if size is None else ', %.1fMB/s' % (size/1e6/max(secs,
+                1e-6))
+            print('(%s: %s in %.3fs%s)' % (name,how,secs,rate))
+
+    def loadindex(self,name,fd):
+        """
+            Load the aggregates of a profiling file from its index sidecar
+            instead of scanning the file.
+            If the file has grown since the index was written, only the
+            bytes after it are scanned, see loadtail().
+            args:
+                name: file name
+                fd: the opened profiling file
+            return: 'index', 'tail' if the file has grown, or False if there
+            is no usable index, eg. it doesn't exist, it is of another
+            version, or it is stale(the profiling file changed other than
+            by growing since it was written), or perf samples were weighted
+            differently. Files loaded approximately have no index.
+        """
+        if self.noindex or self.sketch:
+            return False
+        with meters.timer('load.index'):
+            return self.readindex(name,fd)
+
+    def readindex(self,name,fd):
+        """
+            loadindex() once the index is to be read. The index is an eager
+            cache: the whole payload is unmarshalled, and its symbol ids
+            remapped to those of syms, when the file is opened. It saves
+            the scan, not memory, the mmap only saves reading the bytes into
+            a string to unmarshal them.
+        """
+        st=os.fstat(fd.fileno())
+        try:
+            with open(name+'.kpidx','rb') as ifd:
+                mm=mmap.mmap(ifd.fileno(),0,access=mmap.ACCESS_READ)
+        except (IOError,OSError,ValueError):
+            return False
+        try:
+            if len(mm)<idxhdr.size:
+                return False
+            magic,ver,size,mtime=idxhdr.unpack(mm[:idxhdr.size])
+            if magic!=idxmagic or ver!=idxversion:
+                return False
+            grown=size!=st.st_size or mtime!=st.st_mtime
+            if grown and size>st.st_size:
+                return False
+            data=marshal.loads(buffer(mm,idxhdr.size))
+        except (ValueError,EOFError,TypeError):
+            return False
+        finally:
+            mm.close()
+        f=self.files.index(fd)
+        if self.fmt[f]=='perf' and data[0]!=self.period:
+            return False
+        (period,names,owner,total,incl,excl,inst,stk,tail,spec)=data
+        # the index of a file loaded through another framefilter is of
+        # other stacks
+        if spec!=(self.filt and self.filt.spec):
+            return False
+        if grown and (tail is None or tailsum(fd,tail[0])!=tail[1]):
+            return False
+        self.total[f]=total
+        self.tail[f]=tail
+        m=self.syms.merge(names,owner)
+        self.incl[f]=remapdict(incl,m)
+        self.excl[f]=remapdict(excl,m)
+        self.inst[f]=remapdict(inst,m)
+        self.caller_callee[f]=stacktab.load(stk,m)
+        self.cct[f]=None
+        self.finst[f]=instindex(self.inst[f],self.syms.owner)
+        if grown:
+            self.loadtail(f)
+            return 'tail'
+        return 'index'
+
+    def saveindex(self,name,fd):
+        """
+            Write the aggregates of a loaded profiling file to its index
+            sidecar. The index is written to a temporary file first and
+            then renamed, so a reader never sees a partial one. Failing to
+            write(eg. read-only directory) is not an error, the file is
+            just scanned again next time. The index is of the file as it
+            was when it was loaded, see stamp, it may have grown since.
+        """
+        if self.noindex or self.sketch:
+            return
+        f=self.files.index(fd)
+        ino,size,mtime=self.stamp[f]
+        # only keep the symbols used by this file in its index
+        used=sorted(set(self.incl[f])|set(self.inst[f]))
+        if used==range(len(used)):
+            m=None
+        else:
+            m=dict((v,i) for i,v in enumerate(used))
+        names=[self.syms.names[i] for i in used]
+        owner=[self.syms.owner[i] for i in used]
+        if m is not None:
+            owner=[m[i] for i in owner]
+            stk=stacktab.load(self.caller_callee[f].dump(),m).dump()
+        else:
+            stk=self.caller_callee[f].dump()
+        idx=name+'.kpidx'
+        tmp='%s.%d'%(idx,os.getpid())
+        start=time.time()
+        try:
+            with open(tmp,'wb') as ifd:
+                ifd.write(idxhdr.pack(idxmagic,idxversion,size,mtime))
+                marshal.dump((self.period,names,owner,self.total[f],
+                    remapdict(self.incl[f],m),remapdict(self.excl[f],m),
+                    remapdict(self.inst[f],m),stk,self.tail[f],
+                    self.filt and self.filt.spec),ifd)
+            os.rename(tmp,idx)
+        except (IOError,OSError):
+            try:
+                os.unlink(tmp)
+            except OSError:
                 pass
-                print('%s not exist!!'%(f))
+        meters.add('load.saveindex',time.time()-start)
+
+    def loadfile(self,fd,lines=None):
+        """
+            Scan profiling file and extract both function level and
+            instruction level info from call stacks.
+            args:
+                lines: lines of fd to scan, fd itself if None
+        """
+        f=self.files.index(fd)
+        with meters.timer('load.scan'):
+            self.total[f]=scanners[self.fmt[f]][0](
+                fd if lines is None else lines,self.syms,self.incl[f],
+                self.excl[f],self.inst[f],self.caller_callee[f],
+                period=self.period,filt=self.filt)
+        self.endload(f)
+
+    def loadparallel(self,files):
+        """
+            Scan profiling files by a pool of worker processes.
+            Each file is split into byte ranges at '!' lines, each worker
+            scans a range into its own symtab and aggregates, and they are
+            merged in file order, so the result is the same as loadfile()'s,
+            ids of symbols and order of stacks included.
+            args:
+                files: list of (file name, fd, number of bytes to scan)
+        """
+        jobs=[]
+        done={}
+        for name,fd,size in files:
+            f=self.files.index(fd)
+            spec=self.filt and self.filt.spec
+            parts=[r+(self.period,self.sketch,spec) for r in splitfile(name,
+                self.jobs,self.fmt[f],size)]
+            jobs+=parts
+            done[f]=[0,len(parts)]
+            self.loadq.loading[f]=lambda d=done[f]:d[0]/float(d[1])
+        pool=multiprocessing.Pool(min(self.jobs,len(jobs)))
+        try:
+            start=time.time()
+            for name,data in itertools.izip([j[0] for j in jobs],
+                    pool.imap(scanrange,jobs)):
+                # waiting for the workers is scanning, the rest merging
+                meters.add('load.scan',time.time()-start)
+                start=time.time()
+                self.pause()
+                f=self.files.index(self.fmap[name])
+                (names,owner,total,incl,excl,inst,stk)=data
+                m=self.syms.merge(names,owner)
+                self.total[f]+=total
+                done[f][0]+=1
+                if self.sketch:
+                    for d,part in ((self.incl[f],incl),(self.excl[f],excl),
+                            (self.inst[f],inst)):
+                        d.merge(sketch.load(part,m))
+                    self.caller_callee[f].merge(stacksketch.load(stk,m))
+                    continue
+                for d,part in ((self.incl[f],incl),(self.excl[f],excl),
+                        (self.inst[f],inst)):
+                    for k,v in remapdict(part,m).iteritems():
+                        d[k]=d.get(k,0)+v
+                self.caller_callee[f].merge(stacktab.load(stk,m))
+                meters.add('load.merge',time.time()-start)
+                start=time.time()
+        finally:
+            pool.close()
+            pool.join()
+        for name,fd,size in files:
+            self.endload(self.files.index(fd))
+
+    def endload(self,f):
+        """
+            All stacks of file 'f' are loaded. Build the postings from the
+            unique stacks, and the instructions of each function. The
+            calling context tree is left to the first subcmd using it, see
+            calltree().
+        """
+        if isinstance(self.caller_callee[f],stacksketch):
+            self.caller_callee[f]=self.caller_callee[f].stacks()
+        with meters.timer('load.seal'):
+            self.caller_callee[f].seal()
+        with meters.timer('load.finst'):
+            self.finst[f]=instindex(self.inst[f],self.syms.owner)
+
+    def loadtail(self,f):
+        """
+            Scan the bytes file 'f' has grown by since it was loaded, up to
+            where its complete stacks end, and add them to what is loaded.
+            Its postings, time buckets, calling context tree, instructions
+            of each function, and the diff tables and caller/callee memos
+            of the active files are updated rather than built again.
+        """
+        fd=self.files[f]
+        fmt=self.fmt[f]
+        offset=self.tail[f][0]
+        end=stackend(fd,fmt,os.fstat(fd.fileno()).st_size)
+        if end<=offset:
+            return
+        stk=self.caller_callee[f]
+        n=len(stk)
+        counts=stk.counts[:]
+        incl,excl,inst={},{},{}
+        stk.unseal()
+        with meters.timer('load.scan'):
+            total=scanners[fmt][0](readrange(fd,offset,end),self.syms,incl,
+                excl,inst,stk,flush=True,period=self.period,filt=self.filt)
+        with meters.timer('load.seal'):
+            stk.seal(n)
+        for d,part in ((self.incl[f],incl),(self.excl[f],excl),
+                (self.inst[f],inst)):
+            for k,v in part.iteritems():
+                d[k]=d.get(k,0)+v
+        self.total[f]+=total
+        self.tail[f]=(end,tailsum(fd,end))
+        with meters.timer('load.cct'):
+            if len(stk)>n:
+                # new stacks need new nodes, the tree is built again when
+                # it is used, see calltree()
+                self.cct[f]=None
+            elif self.cct[f] is not None:
+                self.cct[f].add(stk,dict((s,stk.counts[s]-counts[s])
+                    for s in xrange(n) if stk.counts[s]!=counts[s]))
+        with meters.timer('load.finst'):
+            owner=self.syms.owner
+            fns={}
+            for k in inst:
+                fns.setdefault(owner[k],[]).append(k)
+            for fn,ks in fns.iteritems():
+                ids=self.finst[f].get(fn,(array('I'),))[0]
+                old=set(ids)
+                ids=ids+array('I',[k for k in ks if k not in old])
+                self.finst[f][fn]=(ids,array('L',[self.inst[f][k]
+                    for k in ids]))
+        for j in [j for j,g in enumerate(self.handle) if g==f]:
+            if self.incldiff is not None and not self.incldiff.update(j,
+                    self.incl[f],self.total[f]):
+                self.incldiff=None
+            if self.excldiff is not None and not self.excldiff.update(j,
+                    self.excl[f],self.total[f]):
+                self.excldiff=None
+        self.forget(f,False)
+
+    def merge(self,files,output,fmt,weights=None):
+        """
+            Handle merge. Merge profiling files into one profile written to
+            'output' in format 'fmt', see mergefiles(), and open it, or
+            load it again if it is opened already.
+            args:
+                files: files, or directories of them
+                weights: comma separated weight of each file, None for 1
+        """
+        try:
+            inputs=mergeinputs(files,weights)
+            total,n=mergefiles(inputs,output,fmt,self.jobs,self.period,
+                self.filt and self.filt.spec)
+        except (IOError,OSError,ValueError) as e:
+            self.refuse('merge failed: %s!!'%(e))
+            return
+        print('%d file(s) merged into %s: %d samples, %d unique stacks'%(
+            len(inputs),output,total,n))
+        if output in self.fmap:
+            self.reload([output],True)
+        else:
+            self.openfile([output])
+
+    def forget(self,f,diffs=True):
+        """
+            Drop what is memoized of file 'f', which changed.
+            args:
+                diffs: the diff tables too, if 'f' is active
+        """
+        with self.memolock:
+            for k in list(self.ccmemo):
+                if k[0]==f:
+                    del self.ccmemo[k]
+        if diffs and f in self.handle:
+            self.incldiff=None
+            self.excldiff=None
+
+    def budget(self):
+        """
+            --mem-budget. Spill the least recently used files until the
+            loaded files take no more than membudget. Active, pinned and
+            failed files, and the files of the subcmds running, are not
+            spilled.
+        """
+        if self.membudget is None:
+            return
+        with self.memlock:
+            files=[f for f,fd in enumerate(self.files)
+                if fd is not None and self.spilled[f] is None]
+            resident=sum(self.mem[f] or 0 for f in files)
+            lru=sorted((f for f in files if self.ready[f].is_set() and
+                self.loadinfo[f][0]!='failed' and f not in self.handle and
+                f not in self.pinned and not self.users.get(f)),
+                key=lambda f:self.used[f])
+            for f in lru:
+                if resident<=self.membudget:
+                    break
+                if not self.spill(f):
+                    break
+                resident-=self.mem[f]
+
+    def spill(self,f):
+        """
+            Write what is loaded of opened file 'f' to a temporary file and
+            drop it from memory, with its caller/callee memos. It is
+            brought back by unspill() once a subcmd uses it.
+            return: False if it can't be written, after telling so
+        """
+        stk=self.caller_callee[f]
+        approx=isinstance(self.incl[f],sketch)
+        pack=(lambda d:d.dump()) if approx else (lambda d:d)
+        errs=getattr(stk,'errs',None)
+        try:
+            with meters.timer('spill'):
+                fd=tempfile.TemporaryFile(prefix='post-kp.')
+                marshal.dump((approx,pack(self.incl[f]),pack(self.excl[f]),
+                    pack(self.inst[f]),stk.dump(),errs and errs.tostring(),
+                    self.cct[f] and self.cct[f].dump()),fd)
+                fd.flush()
+        except (IOError,OSError,ValueError) as e:
+            print('%s can\'t be spilled: %s!!' % ([k for k,v in
+                self.fmap.iteritems() if v is self.files[f]][0],e))
+            return False
+        self.spilled[f]=fd
+        for lst in (self.incl,self.excl,self.inst,self.finst,
+                self.caller_callee,self.cct):
+            lst[f]=None
+        self.forget(f,False)
+        return True
+
+    def unspill(self,f):
+        """
+            Bring back spilled file 'f', see spill(). It is read by a mmap
+            rather than from the file offset, which the --batch worker
+            processes share.
+        """
+        fd=self.spilled[f]
+        with meters.timer('unspill'):
+            mm=mmap.mmap(fd.fileno(),0,access=mmap.ACCESS_READ)
+            try:
+                approx,incl,excl,inst,stk,errs,cct=marshal.loads(buffer(mm))
+            finally:
+                mm.close()
+            fd.close()
+            unpack=sketch.load if approx else (lambda d:d)
+            self.incl[f]=unpack(incl)
+            self.excl[f]=unpack(excl)
+            self.inst[f]=unpack(inst)
+            self.caller_callee[f]=stacktab.load(stk)
+            if errs is not None:
+                self.caller_callee[f].errs=array('L')
+                self.caller_callee[f].errs.fromstring(errs)
+            self.cct[f]=cct and cctree.load(cct)
+            self.finst[f]=instindex(self.inst[f],self.syms.owner)
+        self.spilled[f]=None
+
+    def close(self,names):
+        """
+            Handle close. Forget the opened files and what is loaded of
+            them. If the active files are all closed, the first 2 files
+            left are the active ones.
+            args:
+                names: names of opened files
+        """
+        q=self.loadq
+        for name in names:
+            fd=self.fmap[name]
+            f=self.files.index(fd)
+            with q.cv:
+                if f in q.loading:
+                    print('%s is loading, can\'t be closed!!' % (name))
+                    continue
+                if f in q.pending:
+                    q.pending.remove(f)
+            with self.memlock:
+                if self.spilled[f] is not None:
+                    self.spilled[f].close()
+                self.forget(f)
+                for lst in (self.incl,self.excl,self.inst,self.finst,
+                        self.caller_callee,self.cct,self.spilled):
+                    lst[f]=None
+                self.mem[f]=None
+                self.pinned.discard(f)
+                self.files[f]=None
+            del self.fmap[name]
+            if isinstance(fd,file) and fd is not sys.stdin:
+                fd.close()
+            self.ready[f].set()
+            if f in self.handle:
+                self.activate([k for k in self.fname if k!=name])
+        if not self.handle and self.fmap:
+            self.activate(sorted(self.fmap,
+                key=lambda k:self.files.index(self.fmap[k]))[:2])
+
+    def calltree(self,f):
+        """
+            Calling context tree of file 'f', built by the first subcmd
+            using it(tree, topdown, bottomup) rather than at load, nor kept
+            in the index, as most sessions never use it. It is dropped again
+            by loadtail() if new stacks come.
+        """
+        if self.cct[f] is None:
+            with meters.timer('load.cct'):
+                t=cctree.build(self.caller_callee[f])
+            with self.memlock:
+                self.cct[f]=t
+                if self.mem[f] is not None:
+                    self.mem[f]+=memsize(vars(t).values())
+        return self.cct[f]
+
+    def reload(self,names,quiet=False):
+        """
+            Handle reload. Add what the opened files have grown by since
+            they were loaded, see loadtail(). A file which changed other
+            than by growing, eg. it is written again from the start or
+            replaced by another, or which can't be added to(see tail), is
+            loaded again from the start.
+            args:
+                names: names of opened files
+                quiet: don't tell what is done to each file
+            return: number of files which changed
+        """
+        changed=0
+        for name in names:
+            fd=self.fmap[name]
+            f=self.files.index(fd)
+            self.wait([f])
+            if not isinstance(fd,file):
+                print('%s can\'t be reloaded!!'%(name))
+                continue
+            try:
+                st=os.stat(name)
+            except OSError as e:
+                print('%s: %s!!'%(name,e))
+                continue
+            stamp=(st.st_ino,st.st_size,st.st_mtime)
+            if stamp==self.stamp[f]:
+                if not quiet:
+                    print('%s: unchanged'%(name))
+                continue
+            changed+=1
+            tail=self.tail[f]
+            if (tail is not None and self.stamp[f] is not None and
+                    st.st_ino==self.stamp[f][0] and st.st_size>=tail[0] and
+                    tailsum(fd,tail[0])==tail[1]):
+                start=time.time()
+                total,stacks=self.total[f],len(self.caller_callee[f])
+                self.stamp[f]=stamp
+                self.loadtail(f)
+                self.loaded(fd,'tail',time.time()-start)
+                if not quiet:
+                    print('%s: %d more samples, %d new stacks'%(name,
+                        self.total[f]-total,
+                        len(self.caller_callee[f])-stacks))
+                continue
+            try:
+                self.reset(f,name)
+            except IOError as e:
+                print('%s: %s!!'%(name,e))
+                continue
+            self.load(f)
+            if not quiet:
+                print('%s: loaded again'%(name))
+        return changed
 
-    def loadfile(self,fd):
+    def changed(self):
         """
-            Scan profiling file and extract both function level and
-            instruction level info from call stacks.
+            Names of the opened files which are loaded and have changed
+            since.
         """
-        pat=re.compile(r'!')
-        f=self.files.index(fd)
-        index=0
-        newstack=0
-        fnc={}
-        inc={}
-        thisline=[]
-        for line in fd:
-            line=line.strip()
-            if pat.search(line):
-                if newstack>0 and index>1:
-                    count=int(thisline[index-1])
-                    for i in range(index-1):
-                        fn=thisline[i]
-                        fn=re.sub('^.*(: |`)','',fn)
-                        fn=re.sub('\/.*$','',fn)
-                        inc[fn]=inc.get(fn,0)+1
-                        fn=re.sub('\+.*$','',fn)
-                        fnc[fn]=fnc.get(fn,0)+1
-                        if i==0:
-                            self.excl[f][fn]=self.excl[f].get(fn,0)+count
-                        else:
-                            fn=fn+"+"+prefunc
-                        prefunc=fn
-                    self.total[f]+=count
-                    for i in fnc:
-                        self.incl[f][i]=self.incl[f].get(i,0)+count*fnc[i]
-                    for i in inc:
-                        self.inst[f][i]=self.inst[f].get(i,0)+count*inc[i]
-                    self.caller_callee[f][fn]=self.caller_callee[f].get(fn,0)+count
-                    fnc.clear()
-                    inc.clear()
-                    del thisline[:]
-                    index=0
-
-                newstack+=1
+        names=[]
+        for k,v in sorted(self.fmap.iteritems(),
+                key=lambda (k,v):self.files.index(v)):
+            f=self.files.index(v)
+            if not isinstance(v,file) or not self.ready[f].is_set():
+                continue
+            try:
+                st=os.stat(k)
+            except OSError:
                 continue
+            if (st.st_ino,st.st_size,st.st_mtime)!=self.stamp[f]:
+                names.append(k)
+        return names
 
-            if newstack>0:
-                thisline += [line]
-                index+=1
+    def refresh(self):
+        """
+            --follow. Reload the opened files which are loaded and have
+            changed since, quietly.
+            return: number of files which changed
+        """
+        return self.reload(self.changed(),True)
 
-    def getdiff(self,din1,n1,din2,n2,dout):
+    def getdiff(self,dins,ns):
         """
-            Get diffs from 2 inputs.
+            Get diffs from N inputs.
             args:
-                dinx: input dictionary x
-                nx: total number of samples for x
-                dout: output dictionary
+                dins: input dictionaries
+                ns: total number of samples of each input
+            return: cmptable
             Since samples in file1 and file2 may be(and always are) different,
             only percentage makeks sense.
+            A key dropped by a sketch counts as its floor, see sketch.
         """
-        for k in din1:
-            if k in din2:
-                dout[k]=100.0*din2[k]/n2-100.0*din1[k]/n1
-            else:
-                dout[k]=0-100.0*din1[k]/n1
-        for k in din2:
-            if k not in dout:
-                dout[k]=100.0*din2[k]/n2
+        with meters.timer('getdiff'):
+            if any(isinstance(d,sketch) and d.floor for d in dins):
+                keys=set().union(*dins)
+                dins=[dict((k,d.get(k)) for k in keys)
+                    if isinstance(d,sketch) and d.floor else d for d in dins]
+            return cmptable(dins,ns)
+
+    def diffcol(self):
+        """title of the diff column, see cmptable.delta()"""
+        return {'last':'Diff','max':'MaxDiff','spread':'Spread'}[self.delta]
 
     def instruction(self, fn):
         """
@@ -207,44 +4151,78 @@ class doit(object):
             instruction level info is more useful. Eg. Memory access cache
             miss and atomic instruction are expensive. Instruction level
             helps in order to identify those.
+            Only the instructions of 'fn' are looked at, see finst.
         """
         print("---------------------non-coalesce function----------------")
+        fid=self.fnid(fn)
+        if fid is None:
+            return
         if len(self.handle)==1:
             f0=self.handle[0]
-            lst=sorted(self.inst[f0].items(), key=lambda (k,v):v,reverse=True)
-        else:
-            f0=self.handle[0]
-            f1=self.handle[1]
-            if not self.instdiff:
-                self.getdiff(self.inst[f0],self.total[f0],
-                        self.inst[f1],self.total[f1],
-                        self.instdiff)
-            lst=sorted(self.instdiff.items(), key=lambda (k,v):v,reverse=True)
-            title='\t\t\t%s\t%s\tDiff' % (self.fname[0],self.fname[1])
-            print(title)
-        count=0
-        for i in lst:
-            (k,v)=i[0],i[1]
-            fns=i[0].strip().split('+')
-            if fns[0]==fn and count<= self.lines:
-                count+=1
-                if len(self.handle)==1:
-                    row='%-20s\t%6.2f%%(%d)' % (k,100.0*v/self.total[f0],v)
-                else:
-                    pct1=self.pct_helper(k,self.inst[f0],self.total[f0])
-                    pct2=self.pct_helper(k,self.inst[f1],self.total[f1])
-                    row='%-20s %6.2f%%\t%6.2f%%\t%6.2f%%' % (k,pct1,pct2,v)
+            ids,counts=self.finsts(f0,fid)
+            with meters.timer('sort.func'):
+                lst=heapq.nlargest(self.lines+1,itertools.izip(ids,counts),
+                    key=lambda (k,v):v)
+            for k,v in lst:
+                name=self.syms.name(k)
+                row='%-20s\t%6.2f%%(%d)%s' % (name,100.0*v/self.total[f0],v,
+                    self.errstr(self.inst[f0],k,f0))
                 print(row)
+            return
+        self.approx([self.inst[f] for f in self.handle])
+        title='\t\t\t%s\t%s' % ('\t'.join(self.fname),self.diffcol())
+        print(title)
+        t=self.getdiff([dict(itertools.izip(*self.finsts(f,fid)))
+            for f in self.handle],[self.total[f] for f in self.handle])
+        with meters.timer('sort.func'):
+            val=t.delta(self.baseline,self.delta)
+            top=t.top(val,self.lines+1)
+        for i in top:
+            name=self.syms.name(t.keys[i])
+            row='%-20s %s\t%6.2f%%' % (name,
+                '\t'.join('%6.2f%%' % p for p in t.pcts(i)),val[i])
+            print(row)
 
-    def pct_helper(self,k,d,total):
+    def annotate(self, fn, elf):
         """
-            helper function to calculate the percentage of a function or stack.
-            if the specified func doesn't exist, return -100%
+            Handle annotate. Show the hottest instructions of 'fn' in the
+            1st active file with their disassembly and source lines(inlined
+            functions included), resolved from the ELF file 'elf', eg. a
+            vmlinux with debug info. See symbolizer.
         """
-        if k in d:
-            return 100.0*d[k]/total
-        else:
-            return -100.0
+        f0=self.handle[0]
+        fid=self.syms.lookup(fn)
+        if fid not in self.finst[f0]:
+            print('%s not exist!!' % (fn))
+            return
+        if elf is None:
+            elf=findvmlinux()
+            if elf is None:
+                print('no vmlinux found, specify it by -k!!')
+                return
+        try:
+            sym=getsymbolizer(elf)
+        except (IOError,OSError) as e:
+            print('%s: %s'%(elf,e))
+            return
+        fsym=sym.symbol(fn)
+        if fsym is None:
+            print('%s not in %s!!'%(fn,elf))
+            return
+        ids,counts=self.finst[f0][fid]
+        lst=heapq.nlargest(self.lines,itertools.izip(ids,counts),
+            key=lambda (k,v):v)
+        addrs=[insaddr(self.syms.name(k),fsym) for k,v in lst]
+        info=sym.resolve(fn,[a for a in addrs if a is not None])
+        print("---------------------annotate %s(%s)----------------" % (fn,
+            elf))
+        for (k,v),a in zip(lst,addrs):
+            dis,src=info.get(a,('?',[])) if a is not None else ('?',[])
+            row='%-20s %6.2f%%(%d)\t%s' % (self.syms.name(k),
+                100.0*v/self.total[f0],v,dis)
+            print(row)
+            for line in src:
+                print('\t\t\t\t%s' % (line))
 
     def cc_helper(self, cmd, fn, f):
         """
@@ -253,54 +4231,75 @@ class doit(object):
             info to a dictionary.
             args:
                 cmd: "caller" or "callee"
-                fn: function specified
+                fn: id of the function specified, or tuple of ids taken
+                    as one, see stacktab.postings()
                 f: the active file
-            return: a dictionary
+            return: a dictionary, keyed by tuple of function ids
 
             For caller, if the fn is the bottom one on the stack,
             show "bottom_of_stack"
             For callee, if the fn is the top one one the stack,
             show "top_of_stack". Actually it is exactly the exclusive
             number of the function.
+
+            Only the stacks in the postings of 'fn' are visited, and the
+            result is memoized per (file, cmd, fn, depth), so running it
+            again with other '-n', or in diff mode, costs nothing.
         """
+        memo=(f,cmd,fn,self.depth)
+        with self.memolock:
+            hit=self.ccmemo.get(memo)
+        meters.hit('ccmemo',hit is not None)
+        if hit is not None:
+            cc,recursive=hit
+            if recursive:
+                print("Note: recursive!")
+            return cc
+        start=time.time()
         cc=dict()
         recursive = False
-        for stk in self.caller_callee[f]:
-            stk=stk.strip()
-            fns=stk.split('+')
-            count=fns.count(fn)
-            if count==0:
-                continue;
+        stks=self.caller_callee[f]
+        posts=stks.postings(fn)
+        for n,(s,i,count) in enumerate(posts):
+            if not n&0xfff:
+                checkpoint(float(n)/len(posts))
+            if not stks.counts[s]:
+                continue
+            fns=stks.stack(s)
             if count>1:
                 recursive = True
-            i=fns.index(fn)
             if cmd=="caller":
                 if i>0:
                     if i+1>self.depth:
-                        key='+'.join(fns[i-self.depth:i+1])
+                        key=tuple(fns[i-self.depth:i+1])
                     else:
-                        key='+'.join(fns[:i+1])
+                        key=tuple(fns[:i+1])
                 else:
-                    key="bottom_of_stack!+"+fns[0]
+                    key=(BOTTOM,fns[0])
             if cmd=="callee":
                 if i!=len(fns)-1:
                     if len(fns)-i>self.depth:
-                        key='+'.join(fns[i:i+self.depth+1])
+                        key=tuple(fns[i:i+self.depth+1])
                     else:
-                        key='+'.join(fns[i:])
+                        key=tuple(fns[i:])
                 else:
-                    key="top_of_stack!"
-            cc[key]=cc.get(key,0)+self.caller_callee[f][stk]*count
+                    key=(TOP,)
+            cc[key]=cc.get(key,0)+stks.counts[s]*count
             #print("key=%s\n" % key)
         if recursive:
             print("Note: recursive!")
+        with self.memolock:
+            if len(self.ccmemo)>=ccmemosize:
+                self.ccmemo.clear()
+            self.ccmemo[memo]=(cc,recursive)
+        meters.add('cc_helper',time.time()-start)
         return cc
 
     def cc(self, cmd, fn):
         """
             Handle caller and callee. Depend on the number of active
-            files(1 or 2), it displays the info of 1 file, or the diff of 2 
-            files.
+            files(1 or N), it displays the info of 1 file, or the diff of
+            N files.
                     
             args:   
                 cmd: "caller" or "callee"
@@ -314,40 +4313,35 @@ class doit(object):
             Only the "caller" can show stacks, '-s' is used to specified
             depth of the stack to show.
         """
-        cc={}
+        fid=self.fnid(fn)
+        if fid is None:
+            return
         if len(self.handle)==1:
             f0=self.handle[0]
-            if fn not in self.incl[f0]:
-                warning='%s not exist!!' % (fn)
-                print(warning)
-                return
-            cc=self.cc_helper(cmd,fn,f0)
+            cc=self.cc_helper(cmd,fid,f0)
+            with meters.timer('sort.cc'):
+                lst=heapq.nlargest(self.lines,cc.iteritems(),
+                    key=lambda (k,v):v)
         else:
-            f0=self.handle[0]
-            f1=self.handle[1]
-            if fn not in self.incl[f0] and fn not in self.incl[f1]:
-                warning='%s not exist!!' % (fn)
-                print(warning)
-                return
-            cc0=self.cc_helper(cmd,fn,f0)
-            cc1=self.cc_helper(cmd,fn,f1)
-            self.getdiff(cc0,self.total[f0],cc1,self.total[f1],cc)
-        lst=sorted(cc.items(), key=lambda (k,v):v,reverse=True)
+            ccs=[self.cc_helper(cmd,fid,f) for f in self.handle]
+            t=self.getdiff(ccs,[self.total[f] for f in self.handle])
+            with meters.timer('sort.cc'):
+                val=t.delta(self.baseline,self.delta)
+                lst=[(t.keys[i],i) for i in t.top(val,self.lines)]
         if cmd=="caller":
             print("-----------------Caller-------------------")
         if cmd=="callee":
             print("-----------------Callee-------------------")
+        self.approx([self.caller_callee[f] for f in self.handle])
         if len(self.handle)>1:
-            title='\t\t\t%s\t\t%s\t\tDiff' % (self.fname[0],self.fname[1])
+            title='\t\t\t%s\t\t%s' % ('\t\t'.join(self.fname),
+                self.diffcol())
             print(title)
-        for i in range(min(self.lines,len(lst))):
-            (k,v)=lst[i][0],lst[i][1]
-            fns=k.strip().split('+')
+        for k,v in lst:
+            fns=[self.syms.name(j) for j in k]
             if len(self.handle)>1:
-                pct1=self.pct_helper(k,cc0,self.total[f0])
-                pct2=self.pct_helper(k,cc1,self.total[f1])
-                row='%-20s\t%6.2f%%\t%6.2f%%\t%6.2f%%' % (fns[len(fns)-1],
-                    pct1,pct2,v)
+                row='%-20s\t%s\t%6.2f%%' % (fns[len(fns)-1],
+                    '\t'.join('%6.2f%%' % p for p in t.pcts(v)),val[v])
             else:
                 row='%-20s %6.2f%%(%d)' % (fns[len(fns)-1],
                      100.0*v/self.total[f0],v)
@@ -357,13 +4351,15 @@ class doit(object):
                 print(row)
             print("------------------------------------------")
 
-    def ie(self,cmd):
+    def ie(self,cmd,pat=None):
         """
             Handle inclusive and/or exclusive. Depend on the number of active
-            files(1 or 2), it displays the info of 1 file, or the diff of 2 
+            files(1 or N), it displays the info of 1 file, or the diff of N
             files.
 
             args:
+                pat: only show the functions matching it, see fnid(), and
+                    then all of them taken as one
                 cmd: "in", "ex", "ina", "exa"   
                 "in":
                     Show inclusive in decending order
@@ -374,71 +4370,931 @@ class doit(object):
                 "exa":
                     Show both inclusive and exclusive in exclusive decending order
             
-            In diff mode(2 active files), only "in" and "ex" are supported. So
-            if you run like,
+            In diff mode(2 or more active files), only "in" and "ex" are
+            supported. So if you run like,
             (file1, file2)>ina
             only the in & ex info of 1st file is displayed.
         """
-        if len(self.handle)==1:
-            f0=self.handle[0]
-            if cmd=="in":
-                title="Function\t\t\tInclusive"
-                lst=sorted(self.incl[f0].items(), key=lambda (k,v):v,reverse=True)
-            if cmd=="ex":
-                title="Function\t\t\tExclusive"
-                lst=sorted(self.excl[f0].items(), key=lambda (k,v):v,reverse=True)
-        else:       
-            f0=self.handle[0]
-            f1=self.handle[1]
-            if not self.incldiff:
-                self.getdiff(self.incl[f0],self.total[f0],
-                        self.incl[f1],self.total[f1],
-                        self.incldiff)
-                self.getdiff(self.excl[f0],self.total[f0],
-                        self.excl[f1],self.total[f1],
-                        self.excldiff)
+        f0=self.handle[0]
+        bykey=lambda (k,v):v
+        ids=None
+        if pat is not None:
+            ids=self.fnid(pat)
+            if ids is None:
+                return
+            ids=ids if isinstance(ids,tuple) else (ids,)
+            only=lambda d:dict((k,d[k]) for k in ids if k in d)
+        if cmd in ["in","ex"] and len(self.handle)>1:
+            meters.hit('incldiff' if cmd=="in" else 'excldiff',
+                self.incldiff is not None)
+            if ids is None and self.incldiff is None:
+                self.incldiff=self.getdiff([self.incl[f] for f in self.handle],
+                    [self.total[f] for f in self.handle])
+                self.excldiff=self.getdiff([self.excl[f] for f in self.handle],
+                    [self.total[f] for f in self.handle])
             if cmd=="in":
                 print("--Inclusive--")
-                title='Function\t\t\t%s\t%s\tDiff' % (self.fname[0],self.fname[1])
-                lst=sorted(self.incldiff.items(), key=lambda (k,v):v,reverse=True)
-            if cmd=="ex":
+                t=self.incldiff
+            else:
                 print("--Exclusive--")
-                title='Function\t\t\t%s\t%s\tDiff' % (self.fname[0],self.fname[1])
-                lst=sorted(self.excldiff.items(), key=lambda (k,v):v,reverse=True)
-        if cmd=="ina": 
-            title="Function\t\t\tInclusive\tExclusive"
-            lst=sorted(self.incl[f0].items(), key=lambda (k,v):v,reverse=True)
-        if cmd=="exa": 
+                t=self.excldiff
+            totals=[self.total[f] for f in self.handle]
+            if ids is not None:
+                t=self.getdiff([only((self.incl if cmd=="in" else
+                    self.excl)[f]) for f in self.handle],totals)
+            self.approx([(self.incl if cmd=="in" else self.excl)[f]
+                for f in self.handle])
+            title='Function\t\t\t%s\t%s' % ('\t'.join(self.fname),
+                self.diffcol())
+            print(title)
+            with meters.timer('sort.ie'):
+                val=t.delta(self.baseline,self.delta)
+                top=t.top(val,self.lines)
+            for i in top:
+                name=self.syms.name(t.keys[i])
+                row='%-30s%s' % (name,
+                    '\t\t'.join(['%6.2f%%' % p for p in t.pcts(i)]+
+                    ['%6.2f%%' % val[i]]))
+                print(row)
+                self.record(name,zip(self.fname,[p if t.has[j][i] else None
+                    for j,p in enumerate(t.pcts(i))])+[(self.diffcol(),
+                    val[i])])
+            if ids is not None:
+                name='%s (%d)' % (pat,len(ids))
+                t1=self.getdiff([{0:self.setsum(cmd,f,ids)}
+                    for f in self.handle],totals)
+                v=t1.delta(self.baseline,self.delta)[0]
+                print('%-30s%s' % (name,'\t\t'.join(['%6.2f%%' % p
+                    for p in t1.pcts(0)]+['%6.2f%%' % v])))
+                self.record(name,zip(self.fname,t1.pcts(0))+[(
+                    self.diffcol(),v)])
+            if self.fail is not None:
+                self.check(t,val)
+            return
+        if cmd in ["in","ex"]:
+            title="Function\t\t\t%s" % ("Inclusive" if cmd=="in" else
+                "Exclusive")
+        else:
             title="Function\t\t\tInclusive\tExclusive"
-            lst=sorted(self.excl[f0].items(), key=lambda (k,v):v,reverse=True)
+        d=self.incl[f0] if cmd in ["in","ina"] else self.excl[f0]
+        if ids is not None:
+            d=only(d)
+        with meters.timer('sort.ie'):
+            lst=heapq.nlargest(self.lines,d.iteritems(),key=bykey)
+        if self.fail is not None:
+            self.refuse('--fail needs 2 or more active files!!')
         print(title)
-        for i in range(min(len(lst),self.lines)):
-            (k,v)=lst[i][0],lst[i][1]
+        incl,excl=self.incl[f0],self.excl[f0]
+        for k,v in lst:
+            name=self.syms.name(k)
             if cmd=="in" or cmd=="ex":
-                if len(self.handle)>1:
-                    if cmd=="in":
-                        pct1=self.pct_helper(k,self.incl[f0],self.total[f0])
-                        pct2=self.pct_helper(k,self.incl[f1],self.total[f1])
-                    else:
-                        pct1=self.pct_helper(k,self.excl[f0],self.total[f0])
-                        pct2=self.pct_helper(k,self.excl[f1],self.total[f1])
-                    row='%-30s%6.2f%%\t\t%6.2f%%\t\t%6.2f%%' % (k,pct1,pct2,v)
-                else:
-                    row='%-30s %6.2f%%(%d)' % (k,100.0*v/self.total[f0],v)
+                row='%-30s %6.2f%%(%d)%s' % (name,100.0*v/self.total[f0],v,
+                    self.errstr(incl if cmd=="in" else excl,k,f0))
+                cols=[(cmd,v)]
             elif cmd=="ina":
-                exv=self.excl[f0][k] if k in self.excl[f0] else 0
-                row='%-30s %6.2f%%(%d)\t%6.2f%%(%d)' % (k,
-                    100.0*v/self.total[f0],v,
-                    100.0*exv/self.total[f0], exv)
+                exv=excl[k] if k in excl else 0
+                row='%-30s %6.2f%%(%d)%s\t%6.2f%%(%d)%s' % (name,
+                    100.0*v/self.total[f0],v,self.errstr(incl,k,f0),
+                    100.0*exv/self.total[f0], exv,self.errstr(excl,k,f0))
+                cols=[('in',v),('ex',exv)]
+            else:
+                inv=incl[k] if k in incl else 0
+                row='%-30s %6.2f%%(%d)%s\t%6.2f%%(%d)%s' % (name,
+                    100.0*inv/self.total[f0], inv,self.errstr(incl,k,f0),
+                    100.0*v/self.total[f0], v,self.errstr(excl,k,f0))
+                cols=[('in',inv),('ex',v)]
+            print(row)
+            self.record(name,[(c+'%',100.0*n/self.total[f0]) for c,n in cols]+
+                cols)
+        if ids is not None:
+            name='%s (%d)' % (pat,len(ids))
+            cols=[(c,self.setsum(c,f0,ids)) for c in (["in","ex"] if
+                cmd in ["ina","exa"] else [cmd])]
+            print('%-30s %s' % (name,'\t'.join('%6.2f%%(%d)' % (
+                100.0*n/self.total[f0],n) for c,n in cols)))
+            self.record(name,[(c+'%',100.0*n/self.total[f0]) for c,n in cols]+
+                cols)
+
+    def fnid(self,fn):
+        """
+            Id of function 'fn', or if there is no such function and 'fn'
+            is a glob or a regex(see symtab.match()), the ids of the
+            functions of the active files matching it, taken as one by
+            caller, callee, func and in/ex.
+            return: id, or tuple of ids. None if there are none, after
+            telling so
+        """
+        fid=self.syms.lookup(fn)
+        if fid is None and (fn.startswith('/') or
+                any(c in fn for c in '*?[')):
+            try:
+                ids=self.syms.match(fn)
+            except re.error as e:
+                print('%s: %s!!' % (fn,e))
+                return None
+            fid=tuple(i for i in ids if any(i in self.incl[f]
+                for f in self.handle))
+            if fid:
+                return fid
+        if all(fid not in self.incl[f] for f in self.handle):
+            print('%s not exist!!' % (fn))
+            return None
+        return fid
+
+    def finsts(self,f,fid):
+        """
+            (instruction ids, samples) of the function fid, or of all the
+            functions of a tuple fid, of file f, see finst
+        """
+        if not isinstance(fid,tuple):
+            return self.finst[f].get(fid,((),()))
+        ids,counts=array('I'),array('L')
+        for i in fid:
+            a,b=self.finst[f].get(i,((),()))
+            ids.extend(a)
+            counts.extend(b)
+        return ids,counts
+
+    def setsum(self,cmd,f,ids):
+        """
+            Samples of file f of the functions 'ids' taken as one. For
+            inclusive("in"), of the stacks with any of them, for exclusive,
+            the sum of their exclusive.
+        """
+        if cmd=="ex":
+            return sum(self.excl[f].get(i,0) for i in ids)
+        stk=self.caller_callee[f]
+        return sum(stk.counts[s] for s,i,n in stk.postings(ids))
+
+    def record(self,key,cols):
+        """
+            Keep a row of the table the subcmd prints, if rows are kept,
+            see --batch.
+            args:
+                key: the function, or other key, of the row
+                cols: (column, value) of the row /list
+        """
+        if self.rows is not None:
+            self.rows.append(dict([('key',key)]+cols))
+
+    def check(self,t,val):
+        """
+            Tell the functions of which the diff is over the --fail
+            threshold, the largest first, and keep them if rows are kept.
+            args:
+                t: the cmptable of the diff
+                val: diff of each row, see cmptable.delta()
+        """
+        if numpy is not None:
+            over=numpy.flatnonzero(numpy.asarray(val)>self.fail)
+        else:
+            over=[i for i,v in enumerate(val) if v>self.fail]
+        if not len(over):
+            return
+        over=t.top(val,len(over),over)
+        print('FAIL: %d function(s) over %+.2f%%: %s%s' % (len(over),
+            self.fail,', '.join('%s(%+.2f%%)' % (self.syms.name(t.keys[i]),
+            val[i]) for i in over[:self.lines]),
+            ', ...' if len(over)>self.lines else ''))
+        if self.failed is not None:
+            self.failed.extend({'key':self.syms.name(t.keys[i]),
+                'diff':float(val[i]),'threshold':self.fail} for i in over)
+
+    def errstr(self,d,k,f):
+        """
+            ' err<x%', how much the samples of key k of file f may be over,
+            if d is a sketch. '' if d is exact.
+        """
+        if not isinstance(d,sketch):
+            return ''
+        return ' err<%.2f%%' % (100.0*d.error(k)/self.total[f])
+
+    def approx(self,dicts):
+        """
+            Tell how far off the samples of the active files may be, for
+            those loaded approximately.
+            args:
+                dicts: where the samples of each active file come from,
+                    a sketch or a stacktab
+        """
+        for name,f,d in zip(self.fname,self.handle,dicts):
+            total=float(self.total[f]) or 1.0
+            if isinstance(d,sketch):
+                over=max(d.err.values()+[d.floor])
+                print('approximate %s: up to %.2f%% over' % (name,
+                    100.0*over/total))
+            elif isinstance(d,stacktab) and d.errs is not None:
+                # the stacks dropped have at most the samples not known
+                # to be in the kept ones
+                over=sum(d.errs)
+                under=self.total[f]-sum(d.counts)+over
+                print('approximate %s: up to %.2f%% over, %.2f%% under' % (
+                    name,100.0*over/total,100.0*under/total))
+
+    def join(self,fn,events,incl,column,minpct):
+        """
+            Handle join. The active files are captures of the same run on
+            different events, and their samples per function, or per
+            instruction of 'fn', are joined into one table with the derived
+            metrics, see jointable. The baseline is the reference event.
+            args:
+                events: comma separated name of the event of each active
+                    file, None for the file names
+                incl: by inclusive rather than exclusive
+                column: column to sort by, None for the samples of the
+                    reference event
+                minpct: only the rows with at least minpct% of the
+                    reference event
+        """
+        if len(self.handle)<2:
+            print('join needs 2 or more active files!!')
+            return
+        events=events.split(',') if events else list(self.fname)
+        if len(events)!=len(self.handle):
+            print('%d event names for %d active files!!' % (len(events),
+                len(self.handle)))
+            return
+        if fn is None:
+            dicts=[(self.incl if incl else self.excl)[f] for f in self.handle]
+            self.approx(dicts)
+        else:
+            fid=self.fnid(fn)
+            if fid is None:
+                return
+            dicts=[dict(itertools.izip(*self.finsts(f,fid)))
+                for f in self.handle]
+            self.approx([self.inst[f] for f in self.handle])
+        totals=[self.total[f] for f in self.handle]
+        with meters.timer('join'):
+            t=jointable(self.getdiff(dicts,totals),totals,events,
+                self.baseline)
+        column=column or events[self.baseline]
+        if column not in t.names:
+            print('no column %s, it is one of %s!!' % (column,
+                ', '.join(t.names)))
+            return
+        with meters.timer('sort.join'):
+            top=t.top(column,self.lines,minpct)
+        width=[max(len(c),9) for c in t.names]
+        print('%-30s %s' % ('Function' if fn is None else 'Instruction',
+            ' '.join(c.rjust(w) for c,w in zip(t.names,width))))
+        for i in top:
+            print('%-30s %s' % (self.syms.name(t.keys[i]),
+                ' '.join(c.rjust(w) for c,w in zip(t.row(i),width))))
+            self.record(self.syms.name(t.keys[i]),[(c,None if v[i]!=v[i]
+                else v[i]) for c,v in zip(t.names,t.cols)])
+
+    def pages(self,fn,name):
+        """
+            Handle pages. Bin the addresses of the samples of the 1st active
+            file by the page size and the NUMA node of their range in the
+            layout map, and show the histograms of all of them, then of the
+            top functions of the stacks, or of the stacks with 'fn'.
+            args:
+                name: file name of the layout map, None for --layout's
+        """
+        f0=self.handle[0]
+        if len(self.handle)>1:
+            print("Note: only %s is shown" % (self.fname[0]))
+        name=name or self.layout
+        if name is None:
+            print('no layout map, give one with -m!!')
+            return
+        try:
+            lay=layout(name)
+        except (IOError,ValueError) as e:
+            print('%s!!' % (e))
+            return
+        stk=self.caller_callee[f0]
+        if not len(stk.astk):
+            print('%s has no addresses!!' % (self.fname[0]))
+            return
+        with meters.timer('pages'):
+            bins=lay.bins(stk.aaddr)
+            whole=stk.addrsum(bins,len(lay))[0]
+            if fn is None:
+                rows=stk.addrsum(bins,len(lay),stk.tops())
+            else:
+                fid=self.fnid(fn)
+                if fid is None:
+                    return
+                key=array('l',[-1])*len(stk)
+                for s,pos,n in stk.postings(fid):
+                    key[s]=s
+                rows=stk.addrsum(bins,len(lay),key)
+        total=sum(whole)
+        pct=lambda n,total:'%6.2f%%' % (100.0*n/(total or 1))
+        print('%d of %d samples have an address' % (total,self.total[f0]))
+        print('--Page size--')
+        for p,n in zip(lay.pages,lay.fold(whole,lay.pcol,len(lay.pages))):
+            print('%-8s%s(%d)' % (p,pct(n,total),n))
+        print('--Node--')
+        for p,n in zip(lay.numa,lay.fold(whole,lay.ncol,len(lay.numa))):
+            print('%-8s%s(%d)' % (p,pct(n,total),n))
+        print('--Page size/Node--')
+        print('%-8s%s' % ('',''.join(p.rjust(9) for p in lay.numa)))
+        for i,p in enumerate(lay.pages):
+            row=[0]*len(lay.numa)
+            for b,n in enumerate(whole):
+                if lay.pcol[b]==i:
+                    row[lay.ncol[b]]+=n
+            print('%-8s%s' % (p,''.join(pct(n,total).rjust(9) for n in row)))
+        with meters.timer('sort.pages'):
+            top=heapq.nlargest(self.lines,rows.iteritems(),
+                key=lambda (k,v):sum(v))
+        print('--%s--' % ('Function' if fn is None else 'Stacks with %s' % (
+            fn)))
+        cols=lay.pages+lay.numa
+        print('%-30s %9s %s' % ('Function' if fn is None else '','Samples',
+            ''.join(c.rjust(8) for c in cols)))
+        for k,v in top:
+            n=sum(v)
+            vals=(lay.fold(v,lay.pcol,len(lay.pages))+
+                lay.fold(v,lay.ncol,len(lay.numa)))
+            if fn is None:
+                print('%-30s %9d %s' % (self.syms.name(k),n,
+                    ''.join(pct(x,n).rjust(8) for x in vals)))
+                continue
+            frames=stk.stack(k)
+            print('%-30s %9d %s' % ('',n,''.join(pct(x,n).rjust(8)
+                for x in vals)))
+            print('\t%s%s' % ('...;' if self.depth and len(frames)>self.depth
+                else '',';'.join(self.syms.name(i) for i in
+                frames[-self.depth if self.depth else 0:])))
+
+    def tree(self, cmd, fn):
+        """
+            Handle topdown, bottomup and tree. They walk the calling context
+            tree of the 1st active file, so they don't work in diff mode.
+
+            args:
+                cmd: "topdown", "bottomup" or "tree"
+                fn: the function specified, or None
+                "topdown":
+                    Show the call tree from the bottom of the stacks, or the
+                    call tree below 'fn' with all the places 'fn' is called
+                    from merged.
+                "bottomup":
+                    Show the inverted call tree from the top of the stacks
+                    down to their bottom, or the callers of 'fn' that way.
+                "tree":
+                    Show the heaviest path from the bottom of the stacks, or
+                    from 'fn', to the top of the stack.
+
+            A merged node of the tree is a list of cct nodes with the same
+            path of functions. Branches below self.pct percent of samples
+            are pruned, at most self.lines children are shown for a node,
+            and self.depth limits the depth of the tree(0 means no limit).
+        """
+        f0=self.handle[0]
+        t=self.calltree(f0)
+        total=self.total[f0]
+        if fn is None:
+            top=[0]
+        else:
+            fid=self.syms.lookup(fn)
+            if fid not in self.incl[f0]:
+                warning='%s not exist!!' % (fn)
+                print(warning)
+                return
+            top=t.outermost(fid)
+        limit=self.pct*total/100.0
+        if cmd=="bottomup":
+            # a bottom-up node is a list of (cct node, samples)
+            if fn is None:
+                grp={}
+                for n in range(1,len(t)):
+                    if t.excl[n]:
+                        grp.setdefault(t.sym[n],[]).append((n,t.excl[n]))
+                top=grp.values()
+            else:
+                top=[[(n,t.incl[n]) for n in top]]
+        if len(self.handle)>1:
+            print("Note: only %s is shown" % (self.fname[0]))
+        if cmd=="topdown":
+            print("-----------------Top-down-------------------")
+        if cmd=="bottomup":
+            print("-----------------Bottom-up------------------")
+            print("Samples\t\t\t\tFunction")
+        if cmd=="tree":
+            print("-----------------Heaviest path--------------")
+        if cmd!="bottomup":
+            print("Inclusive\tExclusive\tFunction")
+
+        def td_children(nodes):
+            grp={}
+            for n in nodes:
+                for c in t.children(n):
+                    grp.setdefault(t.sym[c],[]).append(c)
+            lst=[(sum(t.incl[c] for c in v),v) for v in grp.itervalues()]
+            lst.sort(key=lambda (v,nodes):v,reverse=True)
+            return lst
+
+        def td_row(nodes,level):
+            checkpoint()
+            inc=sum(t.incl[n] for n in nodes)
+            exc=sum(t.excl[n] for n in nodes)
+            name=self.syms.name(t.sym[nodes[0]]) if nodes[0] else '(root)'
+            row='%6.2f%%(%d)\t%6.2f%%(%d)\t%s%s' % (100.0*inc/total,inc,
+                100.0*exc/total,exc,'  '*level,name)
+            print(row)
+
+        def topdown(nodes,level):
+            td_row(nodes,level)
+            if self.depth and level>=self.depth:
+                return
+            for v,c in td_children(nodes)[:self.lines]:
+                if v<limit:
+                    break
+                topdown(c,level+1)
+
+        def bottomup(nodes,level):
+            checkpoint()
+            v=sum(w for n,w in nodes)
+            row='%6.2f%%(%d)\t\t\t%s%s' % (100.0*v/total,v,'  '*level,
+                self.syms.name(t.sym[nodes[0][0]]))
+            print(row)
+            if self.depth and level>=self.depth:
+                return
+            grp={}
+            for n,w in nodes:
+                if t.parent[n]:
+                    grp.setdefault(t.sym[t.parent[n]],[]).append(
+                        (t.parent[n],w))
+            lst=sorted(grp.itervalues(),key=lambda c:sum(w for n,w in c),
+                reverse=True)
+            for c in lst[:self.lines]:
+                if sum(w for n,w in c)<limit:
+                    break
+                bottomup(c,level+1)
+
+        if cmd=="topdown" and top:
+            topdown(top,0)
+        elif cmd=="bottomup":
+            top.sort(key=lambda c:sum(w for n,w in c),reverse=True)
+            for c in top[:self.lines]:
+                if sum(w for n,w in c)<limit:
+                    break
+                bottomup(c,0)
+        elif cmd=="tree" and top:
+            level=0
+            while top:
+                td_row(top,level)
+                level+=1
+                if self.depth and level>self.depth:
+                    break
+                lst=td_children(top)
+                top=lst[0][1] if lst and lst[0][0]>=limit else None
+
+    def run(self,args1):
+        """
+            Run a subcmd other than quit and help, and tell how long it
+            took if --timings.
+            args:
+                args1: the subcmd parsed by cmdparser()
+        """
+        start=time.time()
+        self.using=[]
+        try:
+            self.runcmd(args1)
+        finally:
+            with self.memlock:
+                for f in self.using:
+                    self.users[f]-=1
+            self.using=None
+            secs=time.time()-start
+            meters.add('cmd.'+args1.func,secs)
+            if self.timings:
+                print('(%s: %.3fs)' % (args1.func,secs))
+
+    def opened(self,v):
+        """
+            Name of opened file 'v', given by its name or index, None if it
+            is not opened.
+        """
+        if v.isdigit() and 0<=int(v)<len(self.files):
+            for k in self.fmap:
+                if self.fmap[k]==self.files[int(v)]:
+                    return k
+        if v not in self.fmap:
+            self.refuse('%s not opened yet, open it first!'%(v))
+            return None
+        return v
+
+    def refuse(self,msg):
+        """
+            Tell the subcmd can't be done as asked. In --batch it is raised
+            instead, so runquery() counts it as an error, and a CI gate
+            doesn't pass on what couldn't be checked.
+            args:
+                msg: what is wrong, ending in '!!'
+            raise: refused in --batch
+        """
+        if self.failed is not None:
+            raise refused(msg)
+        print(msg)
+
+    def runcmd(self,args1):
+        """run()"""
+        cmd=args1.func
+        if cmd=="ls":
+            self.listfile()
+        elif cmd=="stats":
+            self.stats()
+        elif cmd=="open":
+            if args1.files is not None:
+                self.openfile(args1.files)
+        elif cmd=="reload":
+            names=map(self.opened,args1.files or
+                sorted(self.fmap,key=lambda k:self.files.index(self.fmap[k])))
+            if None not in names:
+                self.reload(names)
+        elif cmd=="merge":
+            self.merge(args1.files,args1.output,args1.type,args1.weights)
+        elif cmd=="close":
+            names=map(self.opened,args1.files)
+            if None not in names:
+                self.close(names)
+        elif cmd=="pin":
+            names=map(self.opened,args1.files or self.fname)
+            if None in names:
+                return
+            for f in [self.files.index(self.fmap[k]) for k in names]:
+                if args1.unpin:
+                    self.pinned.discard(f)
+                else:
+                    self.pinned.add(f)
+            self.budget()
+        else:
+            if args1.files is not None:
+                args1.files=map(self.opened,args1.files)
+                if None in args1.files:
+                    return
+                self.activate(args1.files)
+            self.lines=args1.lines
+            self.depth=args1.depth
+            self.delta=args1.delta
+            self.fail=getattr(args1,'fail',None)
+            if not 0<=args1.baseline<len(self.handle):
+                self.refuse('baseline %d is not an active file!!'%(
+                    args1.baseline))
+                return
+            self.baseline=args1.baseline
+            failed=self.wait(self.handle)
+            if failed:
+                self.refuse('%s failed to load!!'%(','.join(failed)))
+                return
+            if cmd=="timeline":
+                self.timeline(args1.fn,args1.width,getattr(args1,'from'),
+                    args1.to)
+                return
+            if cmd=="pages":
+                self.pages(args1.fn,args1.map)
+                return
+            begin,end=getattr(args1,'from',None),getattr(args1,'to',None)
+            sel=dimsel(args1)
+            if getattr(args1,'by',None):
+                self.groupby(cmd,args1.by,begin,end,sel,
+                    args1.fn[0] if cmd in ["caller","callee"] else args1.fn)
+                return
+            kp=self
+            if begin is not None or end is not None or sel:
+                kp=self.window(begin,end,sel)
+                if kp is None:
+                    return
+            if cmd in ["in","ex","ina","exa"]:
+                kp.ie(cmd,args1.fn)
+            if cmd in ["caller","callee"]:
+                kp.cc(cmd,args1.fn[0])
+            if cmd=="export":
+                kp.export(args1.type,args1.output,kp is self)
+            if cmd=="join":
+                if args1.fn is not None and kp is not self:
+                    print('instructions are not windowed!!')
+                    return
+                kp.join(args1.fn,args1.events,args1.incl,args1.column,
+                    args1.min)
+            if cmd=="func":
+                self.instruction(args1.fn[0])
+            if cmd=="annotate":
+                self.annotate(args1.fn[0],args1.vmlinux or self.vmlinux)
+            if cmd in ["topdown","bottomup","tree"]:
+                self.pct=args1.pct
+                self.tree(cmd,args1.fn)
+
+    def buckets(self,begin,end):
+        """
+            Time buckets of the window [begin, end) seconds, counted from
+            the start of the first bucket of a file.
+            return: (first bucket, end bucket), numbered from the first
+        """
+        b0=0 if begin is None else int(math.floor(begin/timebucket+1e-6))
+        b1=1<<62 if end is None else int(math.ceil(end/timebucket-1e-6))
+        return b0,b1
+
+    def window(self,begin,end,sel=None):
+        """
+            The samples of the active files in a time window, and/or of
+            some cpus, pids or comms. The samples of each stack in the
+            window are summed up from its time buckets, or from its rows,
+            and the inclusive and exclusive rebuilt from those, the file is
+            not scanned again. Instruction level info and the calling context
+            tree are not windowed.
+            args:
+                begin, end: the window [begin, end) in seconds from the
+                    start of each file, None for no limit
+                sel: 'cpu', 'pid' or 'comm' -> set of values to keep, see
+                    stacktab.dimmask(). None to keep all
+            return: a copy of self for the window, None if an active file
+            has no timestamps, or no dimensions to select by
+        """
+        kp=copy.copy(self)
+        kp.caller_callee=list(self.caller_callee)
+        kp.incl=list(self.incl)
+        kp.excl=list(self.excl)
+        kp.total=list(self.total)
+        kp.ccmemo={}
+        kp.incldiff=None
+        kp.excldiff=None
+        b0,b1=self.buckets(begin,end)
+        timed=begin is not None or end is not None
+        for f,name in zip(self.handle,self.fname):
+            stk=self.caller_callee[f]
+            if timed and stk.tfirst is None:
+                print('%s has no timestamps!!'%(name))
+                return None
+            mask=None
+            if sel:
+                if len(stk.dims)==1:
+                    print('%s has no cpu, pid or comm!!'%(name))
+                    return None
+                mask=stk.dimmask(sel)
+            win=copy.copy(stk)
+            if timed:
+                win.counts=stk.window(b0,b1,mask)
+            else:
+                win.counts=stk.select(mask)
+            incl={}
+            excl={}
+            for i,count in enumerate(win.counts):
+                if not i&0xffff:
+                    checkpoint(float(i)/len(win.counts))
+                if not count:
+                    continue
+                fns=stk.stack(i)
+                for fn in fns:
+                    incl[fn]=incl.get(fn,0)+count
+                excl[fns[-1]]=excl.get(fns[-1],0)+count
+            kp.caller_callee[f]=win
+            kp.incl[f]=incl
+            kp.excl[f]=excl
+            kp.total[f]=sum(win.counts)
+        return kp
+
+    def groupby(self,cmd,by,begin,end,sel,fn=None):
+        """
+            Handle --by. Run 'cmd' for the samples of each cpu, pid or comm
+            'by' of the active files, the ones with the most samples in
+            the 1st active file first, up to self.lines of them.
+            args:
+                begin, end, sel: only count these samples, see window()
+                fn: function of caller and callee, or functions of in/ex
+        """
+        f0=self.handle[0]
+        stk=self.caller_callee[f0]
+        if len(stk.dims)==1:
+            print('%s has no cpu, pid or comm!!'%(self.fname[0]))
+            return
+        mask=stk.dimmask(sel) if sel else None
+        b0,b1=self.buckets(begin,end)
+        if begin is None and end is None:
+            vals=stk.dimsum(by,mask)
+        elif stk.tfirst is None:
+            print('%s has no timestamps!!'%(self.fname[0]))
+            return
+        else:
+            vals=stk.dimsum(by,mask,b0,b1)
+        total=sum(vals.itervalues()) or 1
+        lst=heapq.nlargest(self.lines,vals.iteritems(),key=lambda (k,v):v)
+        for j,(v,n) in enumerate(lst):
+            checkpoint(float(j)/len(lst))
+            s=dict(sel or {})
+            s[by]=set([v])
+            kp=self.window(begin,end,s)
+            if kp is None:
+                return
+            print('==========%s %s: %6.2f%%(%d)==========' % (by,v,
+                100.0*n/total,n))
+            if cmd in ["in","ex","ina","exa"]:
+                kp.ie(cmd,fn)
+            else:
+                kp.cc(cmd,fn)
+
+    def timeline(self, fn, width, begin, end):
+        """
+            Handle timeline. Show the inclusive of 'fn' in each time slot of
+            'width' seconds of the 1st active file, or the samples of each
+            slot if 'fn' is None, so spikes stand out.
+            args:
+                begin, end: only show the slots in [begin, end) seconds
+        """
+        f0=self.handle[0]
+        stk=self.caller_callee[f0]
+        if stk.tfirst is None:
+            print('%s has no timestamps!!'%(self.fname[0]))
+            return
+        stks=None
+        if fn is not None:
+            fid=self.fnid(fn)
+            if fid is None:
+                return
+            stks=[s for s,i,count in stk.postings(fid)]
+        n=max(1,int(round(width/timebucket)))
+        lst=stk.series(stks,n)
+        b0,b1=self.buckets(begin,end)
+        peak=max([v for total,v in lst]+[1])
+        print('Time\t\t%s' % ('Samples' if fn is None else fn))
+        for i,(total,v) in enumerate(lst):
+            if not b0<=i*n<b1:
+                continue
+            if fn is None:
+                bar='#'*int(round(50.0*v/peak))
+                row='%8.1fs\t%d\t%s' % (i*n*timebucket,v,bar)
             else:
-                inv=self.incl[f0][k] if k in self.incl[f0] else 0
-                row='%-30s %6.2f%%(%d)\t%6.2f%%(%d)' % (k,
-                    100.0*inv/self.total[f0], inv,
-                    100.0*v/self.total[f0], v)
+                pct=100.0*v/total if total else 0.0
+                bar='#'*int(round(pct/2))
+                row='%8.1fs\t%6.2f%%(%d)\t%s' % (i*n*timebucket,pct,v,bar)
             print(row)
 
+    def export(self, fmt, path, inst=True):
+        """
+            Handle export. Write the stacks of the 1st active file in format
+            'fmt'(see writers), to file 'path' or the standard output. pprof
+            is gzipped as it is written, and is not written to the standard
+            output.
+            args:
+                inst: write the instruction level too, if the format has
+                    it. Not for a window, its instructions are not windowed
+        """
+        f0=self.handle[0]
+        if fmt=='pprof' and path is None:
+            print('pprof needs an output file!!')
+            return
+        try:
+            if path is None:
+                out=sys.stdout
+            elif fmt=='pprof':
+                out=gzip.open(path,'wb')
+            else:
+                out=open(path,'w')
+            try:
+                writers[fmt](out,self.syms,self.caller_callee[f0],
+                    self.inst[f0] if inst and not isinstance(self.inst[f0],
+                    sketch) else None)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+        except IOError as e:
+            print('%s: %s'%(path,e))
+
+    def submit(self,line,args1,background=False):
+        """
+            Run a subcmd of the interactive mode as a job. A foreground one
+            is waited for, see foreground(). A background one runs on a
+            copy of self, so its options(eg. -f) are its own, and what it
+            prints is kept until 'fg'. writecmds run neither in the
+            background nor while background jobs are running.
+            args:
+                line: the subcmd as it was typed
+                args1: the subcmd parsed by cmdparser()
+        """
+        cmd=args1.func
+        running=[j for j in self.bgjobs.itervalues() if j.state=='running']
+        if cmd in writecmds:
+            if background:
+                print('%s can\'t run in the background!!'%(cmd))
+                return
+            if running:
+                print('%d background job(s) running, fg or kill them '
+                    'first!!'%(len(running)))
+                return
+        if background:
+            if not isinstance(sys.stdout,tlsout):
+                sys.stdout=tlsout(sys.stdout)
+            out=sys.stdout
+            kp=copy.copy(self)
+            num=max(self.bgjobs.keys()+[0])+1
+            self.bgjobs[num]=job(num,line,lambda:out.collect(kp.run,args1))
+            print('[%d] %s'%(num,line))
+            return
+        if self.follow is not None and not running:
+            self.refresh()
+        self.foreground(job(0,line,lambda:self.run(args1),
+            cmd not in writecmds))
+
+    def foreground(self,j):
+        """
+            Wait for job 'j', and tell how far it is every second on a
+            terminal. ^C cancels it. Then print its output if it ran in
+            the background, or why it failed.
+        """
+        shown=False
+        tty=sys.stderr.isatty()
+        while j.thread.is_alive():
+            try:
+                j.thread.join(0.2)
+                if tty and j.thread.is_alive() and time.time()-j.start>=1:
+                    sys.stderr.write('\r(%s)\x1b[K'%(j.status()))
+                    shown=True
+            except KeyboardInterrupt:
+                if not j.cancellable:
+                    print('\n%s can\'t be cancelled, wait for it!!'%(
+                        j.line))
+                    continue
+                j.cancel.set()
+        if shown:
+            sys.stderr.write('\r\x1b[K')
+        if j.output:
+            print(j.output,end='')
+        if j.state=='cancelled':
+            print('%s cancelled'%(j.line))
+        elif j.state=='failed':
+            print(j.error,end='')
+        j.told=True
+
+    def jobcmd(self,args1):
+        """
+            Handle jobs, fg and kill. jobs lists the background jobs and
+            how far they are. fg waits for a job(default the last one) and
+            prints its output, kill cancels it.
+        """
+        if args1.func=='jobs':
+            for num in sorted(self.bgjobs):
+                j=self.bgjobs[num]
+                print('[%d] %-24s %s'%(num,j.status(),j.line))
+                j.told=j.state!='running'
+            return
+        num=args1.job
+        if num is None and self.bgjobs:
+            num=max(self.bgjobs)
+        j=self.bgjobs.get(num)
+        if j is None:
+            print('no such job!!')
+            return
+        if args1.func=='kill':
+            j.cancel.set()
+            return
+        self.foreground(j)
+        del self.bgjobs[num]
+
+    def reap(self):
+        """
+            Tell the background jobs over since the last prompt, and
+            give back sys.stdout once none is running.
+        """
+        for num in sorted(self.bgjobs):
+            j=self.bgjobs[num]
+            if j.state!='running' and not j.told:
+                print('[%d] %-24s %s'%(num,j.status(),j.line))
+                j.told=True
+        if isinstance(sys.stdout,tlsout) and all(j.state!='running' for j
+                in self.bgjobs.itervalues()):
+            sys.stdout=sys.stdout.out
+
+    def complete(self,text,state):
+        """
+            readline completer. The 1st word is completed with the
+            subcmds, the words after -f/--files with the opened files, the
+            ones of open and merge with paths, and the others with function
+            names, see symtab.prefix().
+            return: the state-th candidate, None if there are no more.
+            They are looked up for state 0 and kept in self.cands.
+        """
+        if state>0:
+            return self.cands[state] if state<len(self.cands) else None
+        try:
+            words=readline.get_line_buffer()[:readline.get_begidx()].split()
+            if not words:
+                cands=[c for c in subcmds if c.startswith(text)]
+            elif words[-1] in ['-f','--files'] or words[0]=='close':
+                cands=[f for f in self.fmap if f.startswith(text)]
+            elif words[0] in ['open','merge']:
+                d,b=os.path.split(text)
+                cands=[os.path.join(d,f)+('/' if os.path.isdir(os.path.join(
+                    d or '.',f)) else '') for f in sorted(os.listdir(d or '.'))
+                    if f.startswith(b)]
+            else:
+                cands=[k for k,i in self.syms.prefix(text)[:1000]]
+        except Exception:
+            cands=[]
+        self.cands=cands
+        return cands[0] if cands else None
+
     def go(self,args):
         """Second level entry of execution"""
+        readline.set_completer(self.complete)
+        readline.set_completer_delims(' \t')
+        readline.parse_and_bind('tab: complete')
 
         desc0=textwrap.dedent('''\
             No file(s) opened
@@ -453,98 +5309,11 @@ class doit(object):
             formatter_class=argparse.RawDescriptionHelpFormatter)
         parser0.add_argument('cmd', nargs='*', type=str)
 
-        desc1=textwrap.dedent('''\
-            file(s) opened
-            ''')
-        help1=textwrap.dedent('''\
-            subcommand:
-                quit: exit
-                open: open more files
-                    open file1 [file2 [file3 ...]]
-                ls:  list opened file and active files
-                help: print usage
-                in : print inclusive of one file or diff of two files 
-                    in [-f file1 [file2]] [-n lines]
-                ex : print exclusive of one file or diff of two files
-                    ex [-f file1 [file2]] [-n lines]
-                ina : print in & ex of one file, sorted by inclusive
-                    ina [-f file1] [-n lines]
-                exa : print in & ex of one file, sorted by exclusive
-                    exa [-f file1 [file2]] [-n lines]
-                caller : print call stack to 'fn' 
-                    caller [-f file1 [file2]] [-n lines] [-s depth] fn
-                callee : print functions called by 'fn'
-                    callee [-f file1 [file2]] [-n lines] fn
-                func : print expensive instructions with 'fn'
-                    func [-f file1 [file2]] [-n lines] fn
-            options:
-                -n : number of lines displayed
-                -s : depth of call stack
-                -f : file to operate on(-f file1, or -f file1 file2)
-
-            Notes:
-                Profiling files need to be opened first before any kind of
-                post processing can be done. In theory, there is no limit
-                by this tool itself on the number of files opened. Keeping
-                the file open is very convenient when the files are pretty
-                large since the pre-processed files are saved in memory, so
-                all subsequent processes are fast.
-
-                Active files are those subcmds operate on if '-f' is not
-                specified by the subcmd. Active files must be subset of
-                opened files. There are at least 1 and at most 2 active files.
-                If there are 2, all those subcmds which need files are working
-                in diff mode -- the difference between 2 files is displayed.
-                By default, active files are the first 2 files opened. Then
-                afterwards, if any subcmd specifies '-f' opention, the file(s)
-                becomes the active one(s)
-
-                'ls' subcmd lists all opened and active files. '-f' accepts
-                either the file name or the opened file index
-            ''')
-
-        subcmd=['quit','ls','help','open','in','ex','ina','exa','caller',
-                'callee','func']
         def print_help(errmsg):
             print(errmsg)
-        def addargs(subparser,cmd,add_fn):
-            if add_fn:          
-                subparser.add_argument("fn",nargs=1)
-            subparser.add_argument("-n","--lines", type=int, default=20)
-            subparser.add_argument("-s","--depth", type=int, default=1)
-            subparser.add_argument("-f","--files", nargs='+', type=str)
-            subparser.set_defaults(func=cmd)
-
-        parser1=argparse.ArgumentParser(description=desc1, epilog=help1,
-            formatter_class=argparse.RawDescriptionHelpFormatter)
-        parser1.error=print_help
-        parser1.exit=print_help
-        subparsers=parser1.add_subparsers(help=help1)
-        sub_quit=subparsers.add_parser('quit')
-        sub_quit.set_defaults(func='quit')
-        sub_help=subparsers.add_parser('help')
-        sub_help.set_defaults(func='help')
-        sub_ls=subparsers.add_parser('ls')
-        sub_ls.set_defaults(func='ls')
-        sub_open=subparsers.add_parser('open')
-        sub_open.add_argument('files',nargs='+')
-        sub_open.set_defaults(func='open')
-        sub_caller=subparsers.add_parser('caller')
-        addargs(sub_caller,"caller",1)
-        sub_callee=subparsers.add_parser('callee')
-        addargs(sub_callee,"callee",1)
-        sub_func=subparsers.add_parser('func')
-        addargs(sub_func,"func",1)
-        sub_in=subparsers.add_parser('in')
-        addargs(sub_in,"in",0)
-        sub_ex=subparsers.add_parser('ex')
-        addargs(sub_ex,"ex",0)
-        sub_ina=subparsers.add_parser('ina')
-        addargs(sub_ina,"ina",0)
-        sub_exa=subparsers.add_parser('exa')
-        addargs(sub_exa,"exa",0)
+        parser1,help1=cmdparser(print_help)
         while 1:
-            while len(self.files)==0:
+            while not self.fmap:
                 #print("kp", end='>')
                 #line = sys.stdin.readline().strip()
                 line = raw_input("kp>")
@@ -562,16 +5331,24 @@ class doit(object):
                 args.interactive=True
                 break
 
-            while len(self.files)!=0:
-                if len(self.fname)>1:
-                    prompt='(%s,%s)>'%(self.fname[0],self.fname[1])
-                else:
-                    prompt='(%s)>'%(self.fname[0])
+            while self.fmap:
+                self.reap()
+                prompt='(%s)>'%(','.join(self.fname))
                 #print(prompt, end='>')
-                line = raw_input(prompt).split()
+                try:
+                    line = raw_input(prompt).split()
+                except KeyboardInterrupt:
+                    print()
+                    continue
+                # 'subcmd &' runs in the background
+                background=bool(line) and line[-1].endswith('&')
+                if background:
+                    line[-1]=line[-1][:-1]
+                    if not line[-1]:
+                        line.pop()
                 if len(line)<1:
                     continue
-                if line[0] not in subcmd:
+                if line[0] not in subcmds:
                     print('\'%s\' unknown!!'%(line[0]))
                     continue
                 args1,unknown=parser1.parse_known_args(line)
@@ -582,46 +5359,488 @@ class doit(object):
                     exit(0)
                 elif cmd=="help":
                     print(help1, end='')
-                elif cmd=="ls":
-                    self.listfile()
-                elif cmd=="open":
-                    if args1.files is not None:
-                        self.openfile(args1.files)
+                elif cmd in jobcmds:
+                    self.jobcmd(args1)
                 else:
-                    if args1.files is not None:
-                        class InvalidFile(Exception): pass
-                        try:
-                            for i,v in enumerate(args1.files):
-                                if v.isdigit() and 0<=int(v)<len(self.files):
-                                    for k in self.fmap:
-                                        if self.fmap[k]==self.files[int(v)]:
-                                            v=k
-                                            args1.files[i]=k
-                                            break
-                                if v not in self.fmap:
-                                    print('%s not opened yet, open it first!'%(v))
-                                    raise InvalidFile
-                        except InvalidFile:
-                            pass
-                            continue
-                        self.handle=[]
-                        self.fname=[]
-                        self.incldiff={}
-                        self.excldiff={}
-                        self.instdiff={}
-                        for i in args1.files:
-                            if len(self.handle)<2:
-                                self.handle.append(self.files.index(self.fmap[i]))
-                                self.fname.append(i)
-                    self.lines=args1.lines
-                    self.depth=args1.depth
-                    if cmd in ["in","ex","ina","exa"]:
-                        self.ie(cmd)
-                    if cmd in ["caller","callee"]:
-                        self.cc(cmd,args1.fn[0])
-                    if cmd=="func":
-                        self.instruction(args1.fn[0])
-                
+                    self.submit(' '.join(line),args1,background)
+
+class job(object):
+    """
+        A subcmd of the interactive mode, run by a thread of its own so
+        that it can be cancelled(^C, kill) and run in the background(&).
+        It is cancelled at the next checkpoint() of its subcmd, which
+        leaves what is loaded as it was.
+        num: job number, 0 for a foreground one
+        line: the subcmd as it was typed
+        cancellable: whether it stops once cancelled, writecmds don't
+        cancel: set to cancel it /threading.Event
+        progress: how far it is, 0.0 to 1.0, or a function returning that
+                  or None. None if not known
+        since: when the progress started from 0, for the ETA
+        start: when it started
+        secs: seconds it took, None while it runs
+        state: 'running', 'done', 'cancelled' or 'failed'
+        output: what it printed if it runs in the background, None if it
+                prints to the terminal
+        error: traceback of a failed job
+        told: whether it is told to be over
+        thread: /threading.Thread
+    """
+    def __init__(self,num,line,fn,cancellable=True):
+        """
+            Start the job.
+            args:
+                fn: runs the subcmd, returns the output of a background one
+        """
+        self.num=num
+        self.line=line
+        self.cancellable=cancellable
+        self.cancel=threading.Event()
+        self.progress=None
+        self.since=None
+        self.start=time.time()
+        self.secs=None
+        self.state='running'
+        self.output=None
+        self.error=None
+        self.told=False
+        self.thread=threading.Thread(target=self.main,args=(fn,))
+        self.thread.daemon=True
+        self.thread.start()
+
+    def main(self,fn):
+        if self.cancellable:
+            jobtls.job=self
+        try:
+            self.output=fn()
+            self.state='done'
+        except cancelled:
+            self.state='cancelled'
+        except Exception:
+            self.error=traceback.format_exc()
+            self.state='failed'
+        finally:
+            self.secs=time.time()-self.start
+
+    def report(self,progress):
+        """checkpoint() of the job"""
+        p=self.progress
+        if p is None or callable(p)!=callable(progress) or (callable(p)
+                and p is not progress) or (not callable(p) and progress<p):
+            self.since=time.time()
+        self.progress=progress
+
+    def status(self):
+        """eg. 'running 40%, ETA 3s', 'done in 1.2s'"""
+        if self.state!='running':
+            return '%s in %.1fs'%(self.state,self.secs)
+        p=self.progress() if callable(self.progress) else self.progress
+        if p is None:
+            return 'running %ds'%(time.time()-self.start)
+        if p<=0:
+            return 'running 0%'
+        return 'running %d%%, ETA %ds'%(100*p,
+            math.ceil((time.time()-self.since)*(1-p)/p))
+
+class tlsout(object):
+    """
+        sys.stdout of the daemon, and of the interactive mode while it has
+        background jobs. What the subcmds print is collected per thread,
+        so the output of concurrent queries doesn't mix.
+        out: the real stdout
+        tls: buf, output of the query of this thread /threading.local
+    """
+    def __init__(self,out):
+        self.out=out
+        self.tls=threading.local()
+
+    def write(self,s):
+        buf=getattr(self.tls,'buf',None)
+        (self.out if buf is None else buf).write(s)
+
+    def flush(self):
+        if getattr(self.tls,'buf',None) is None:
+            self.out.flush()
+
+    def collect(self,fn,*args):
+        """run fn(*args), return what it prints"""
+        self.tls.buf=StringIO.StringIO()
+        try:
+            fn(*args)
+            return self.tls.buf.getvalue()
+        finally:
+            self.tls.buf=None
+
+class rwlock(object):
+    """
+        Any number of readers, or one writer.
+        readers: number of readers holding the lock
+    """
+    def __init__(self):
+        self.cond=threading.Condition()
+        self.readers=0
+
+    def rdlock(self):
+        with self.cond:
+            self.readers+=1
+
+    def rdunlock(self):
+        with self.cond:
+            self.readers-=1
+            if self.readers==0:
+                self.cond.notify_all()
+
+    def wrlock(self):
+        self.cond.acquire()
+        while self.readers:
+            self.cond.wait()
+
+    def wrunlock(self):
+        self.cond.release()
+
+def utf8(v):
+    """json strings are unicode, names in the files are bytes"""
+    return v.encode('utf-8') if isinstance(v,unicode) else str(v)
+
+class kpserver(SocketServer.ThreadingMixIn,SocketServer.UnixStreamServer):
+    """
+        The daemon(--serve). It keeps the opened files in memory and
+        answers subcmds over a unix domain socket. A request is a line of
+        json, eg.
+            {"cmd": "caller", "fn": "tcp_sendmsg", "lines": 10, "depth": 3}
+        where fn is the function of the subcmd(the files of open), and the
+        other keys are the long options of the subcmd. The response is a
+        line of json too,
+            {"ok": true, "output": "..."}
+            {"ok": false, "error": "..."}
+        A connection can send any number of requests, one after another.
+        Each connection is served by its own thread. open, reload and
+        close are run alone, other subcmds are read-only and run concurrently, each
+        on its own copy of doit, so their -f, -n and so on don't affect the
+        others. With --follow, the files which changed are reloaded before
+        a subcmd is run.
+        kp: the opened files /doit
+        lock: open and reload are the writers, other subcmds are readers
+              /rwlock
+        out: sys.stdout while serving /tlsout
+    """
+    daemon_threads=True
+
+    def __init__(self,path,kp):
+        SocketServer.UnixStreamServer.__init__(self,path,kphandler)
+        def error(msg=None,*args):
+            raise ValueError(msg)
+        self.kp=kp
+        self.lock=rwlock()
+        self.out=tlsout(sys.stdout)
+        self.parser,self.help=cmdparser(error)
+
+    def query(self,req):
+        """
+            Answer one request.
+            args:
+                req: the request /dict
+            return: output of the subcmd
+        """
+        if not isinstance(req,dict) or req.get('cmd') not in servecmds:
+            raise ValueError('unknown request %s'%(json.dumps(req)))
+        cmd=utf8(req['cmd'])
+        opts=[]
+        pos=[]
+        for k,v in req.iteritems():
+            if k=='cmd' or v is None or v is False:
+                continue
+            if v is True:
+                opts.append('--'+utf8(k))
+                continue
+            v=map(utf8,v) if isinstance(v,list) else [utf8(v)]
+            if k=='fn' or (k=='files' and cmd in writecmds):
+                pos+=v
+            else:
+                opts+=['--'+utf8(k)]+v
+        if pos:
+            opts+=['--']+pos
+        args1,unknown=self.parser.parse_known_args([cmd]+opts)
+        if unknown:
+            raise ValueError('%s unknown'%(unknown))
+        if cmd=='help':
+            return self.help
+        if cmd in writecmds:
+            self.lock.wrlock()
+            try:
+                return self.out.collect(self.kp.run,args1)
+            finally:
+                self.lock.wrunlock()
+        out=''
+        if self.kp.follow is not None and self.kp.changed():
+            self.lock.wrlock()
+            try:
+                out=self.out.collect(self.kp.refresh)
+            finally:
+                self.lock.wrunlock()
+        self.lock.rdlock()
+        try:
+            return out+self.out.collect(copy.copy(self.kp).run,args1)
+        finally:
+            self.lock.rdunlock()
+
+class kphandler(SocketServer.StreamRequestHandler):
+    """A connection to the daemon"""
+    def handle(self):
+        while 1:
+            line=self.rfile.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                out=self.server.query(json.loads(line))
+                resp=json.dumps({'ok':True,'output':out})
+            except (Exception,SystemExit) as e:
+                resp=json.dumps({'ok':False,'error':str(e)})
+            self.wfile.write(resp+'\n')
+            self.wfile.flush()
+
+def serve(kp,path):
+    """
+        Run the daemon on the unix domain socket path until interrupted.
+        args:
+            kp: the opened files /doit
+    """
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            print('%s exists and is not a socket!!'%(path))
+            return
+        s=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+            print('%s is served by another daemon!!'%(path))
+            return
+        except socket.error:
+            os.unlink(path)
+        finally:
+            s.close()
+    server=kpserver(path,kp)
+    print('serving on %s'%(path))
+    sys.stdout.flush()
+    sys.stdout=server.out
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout=server.out.out
+        server.server_close()
+        os.unlink(path)
+
+def client(path,lines):
+    """
+        The client of the daemon. Send subcmds to the daemon on path and
+        print their output.
+        args:
+            lines: subcmds, eg. "caller -n 5 tcp_sendmsg"
+        return: 0, or 1 if any subcmd failed
+    """
+    def error(msg=None,*args):
+        raise ValueError(msg)
+    parser,help=cmdparser(error)
+    s=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error as e:
+        print('%s: %s'%(path,e))
+        return 1
+    rfile=s.makefile('rb')
+    wfile=s.makefile('wb')
+    status=0
+    for line in lines:
+        argv=line.split()
+        if not argv:
+            continue
+        try:
+            args1,unknown=parser.parse_known_args(argv)
+            if unknown:
+                raise ValueError('%s unknown'%(unknown))
+        except (ValueError,SystemExit) as e:
+            print('%s: %s'%(line.strip(),e))
+            status=1
+            continue
+        if args1.func=='quit':
+            break
+        req=dict((k,v) for k,v in vars(args1).iteritems()
+            if k!='func' and v is not None)
+        req['cmd']=args1.func
+        wfile.write(json.dumps(req)+'\n')
+        wfile.flush()
+        resp=rfile.readline()
+        if not resp:
+            print('connection closed by the daemon!!')
+            return 1
+        resp=json.loads(resp)
+        if resp['ok']:
+            print(utf8(resp['output']),end='')
+        else:
+            print('%s: %s'%(line.strip(),utf8(resp['error'])))
+            status=1
+    s.close()
+    return status
+
+def runquery(kp,out,args1):
+    """
+        Run one subcmd of --batch, keeping what it prints and the rows of
+        its tables.
+        args:
+            kp: the opened files /doit
+            out: sys.stdout of the batch /tlsout
+            args1: the subcmd parsed by cmdparser()
+        return: result of the subcmd /dict
+    """
+    kp.rows=[]
+    kp.failed=[]
+    out.tls.buf=StringIO.StringIO()
+    start=time.time()
+    error=None
+    try:
+        kp.run(args1)
+    except refused as e:
+        error=str(e)
+    except Exception:
+        error=traceback.format_exc()
+    finally:
+        output=out.tls.buf.getvalue()
+        out.tls.buf=None
+    res={'output':output,'rows':kp.rows,'failed':kp.failed,
+        'error':error,'secs':time.time()-start}
+    kp.rows=None
+    kp.failed=None
+    return res
+
+# The opened files and sys.stdout of a --batch worker process, given to it
+# by batchinit() when it is forked.
+batchfiles=None
+
+def batchinit(kp,out):
+    """Initializer of the --batch worker processes, see batch()"""
+    global batchfiles
+    batchfiles=(kp,out)
+
+def batchquery(args1):
+    """Worker of batch(). Run a query on a copy of the files it is given"""
+    kp,out=batchfiles
+    return runquery(copy.copy(kp),out,args1)
+
+def batch(kp,script,report):
+    """
+        Run the subcmds of a script on the opened files, --batch. Each query
+        runs on the files as the script opened them so far, -f of a query
+        doesn't change the active files of the next ones. The queries
+        between two subcmds which change the opened files(see writecmds)
+        are independent, and are run by a pool of worker processes, each
+        on its own copy of doit. The pool is forked once all the files are
+        loaded and the background loader is gone, so no lock is held by a
+        thread the workers don't have, and it is kept until the opened
+        files change. The results are printed in the order of the script
+        once all are done.
+        args:
+            kp: the opened files /doit
+            script: lines of subcmds, '#' starts a comment
+            report: 'json' for a json document, 'csv' for query, key,
+                column and value lines
+        return: 0, 1 if a --fail threshold is crossed, 2 if a subcmd is
+            not right, is refused(see doit.refuse()) or raised
+    """
+    def error(msg=None,*args):
+        raise ValueError(msg)
+    parser,help=cmdparser(error)
+    results=[]
+    pending=[]
+    out=tlsout(sys.stdout)
+    # the worker processes, forked with the files as they are opened now
+    pool=[None]
+    def query(args1):
+        return runquery(copy.copy(kp),out,args1)
+    def flush():
+        if not pending:
+            return
+        kp.wait()
+        args=[a for r,a in pending]
+        if kp.jobs>1 and len(pending)>1:
+            if pool[0] is None:
+                q=kp.loadq
+                with q.cv:
+                    loader=q.thread
+                if loader is not None:
+                    loader.join()
+                pool[0]=multiprocessing.Pool(kp.jobs,batchinit,(kp,out))
+            res=pool[0].map(batchquery,args)
+        else:
+            res=map(query,args)
+        for (r,a),x in zip(pending,res):
+            r.update(x)
+        del pending[:]
+    def drop():
+        if pool[0] is not None:
+            pool[0].close()
+            pool[0].join()
+            pool[0]=None
+    sys.stdout=out
+    try:
+        for n,line in enumerate(script):
+            line=line.split('#')[0].strip()
+            if not line:
+                continue
+            r={'line':n+1,'query':line,'output':'','rows':[],'failed':[],
+                'error':None,'secs':0.0}
+            results.append(r)
+            try:
+                args1,unknown=parser.parse_known_args(line.split())
+                if unknown:
+                    raise ValueError('%s unknown'%(unknown))
+                if args1.func in jobcmds:
+                    raise ValueError('no jobs in --batch')
+            except (ValueError,SystemExit) as e:
+                r['error']=str(e)
+                continue
+            if args1.func=='quit':
+                results.pop()
+                break
+            if args1.func=='help':
+                r['output']=help
+            elif args1.func in writecmds:
+                flush()
+                drop()
+                r.update(runquery(kp,out,args1))
+            else:
+                pending.append((r,args1))
+        flush()
+    finally:
+        sys.stdout=out.out
+        drop()
+    errors=sum(1 for r in results if r['error'])
+    failed=sum(len(r['failed']) for r in results)
+    if report=='json':
+        json.dump({'files':sorted(kp.fmap,key=lambda k:kp.files.index(
+            kp.fmap[k])),'queries':results,'failed':failed,'errors':errors},
+            sys.stdout,indent=1,sort_keys=True)
+        print()
+    else:
+        out=csv.writer(sys.stdout)
+        out.writerow(['query','key','column','value'])
+        for r in results:
+            for row in r['rows']:
+                for c in sorted(row):
+                    if c!='key':
+                        out.writerow([r['query'],row['key'],c,
+                            '' if row[c] is None else row[c]])
+            for row in r['failed']:
+                out.writerow([r['query'],row['key'],'fail',row['diff']])
+            if not r['rows']:
+                for l in r['output'].splitlines():
+                    out.writerow([r['query'],'','output',l])
+            if r['error']:
+                out.writerow([r['query'],'','error',r['error']])
+    return 2 if errors else 1 if failed else 0
+
 def main():
     """Top levelry of execution"""
     desc=textwrap.dedent('''\
@@ -641,6 +5860,9 @@ def main():
             4. post-kp.py file1 file2
                 list the inclusive difference of fuctions in sorted order 
                 between file1 and file2.
+            5. post-kp.py -d spread file1 file2 file3
+                list the inclusive of functions in file1, file2 and file3,
+                sorted by the largest difference between any 2 of them.
             6. post-kp.py -i file1 file2 file3
                 open all files, then wait for subcommand.
             7. post-kp.py -C fn file1
@@ -652,6 +5874,97 @@ def main():
                 list all functions fn calls
             10. post-kp.py -f fn file1
                 list all expensive instructions in fn
+            11. perf script | post-kp.py -
+                read perf script output from the standard input. Files
+                of perf script output can be opened as they are too.
+            12. post-kp.py -e folded -o file.folded file1
+                convert file1 to collapsed stacks('root;...;leaf count'
+                lines, as FlameGraph's stackcollapse makes), or to a
+                gzipped pprof profile with -e pprof. Both are read as
+                profiling files too.
+            13. post-kp.py --pid 1234 file1, post-kp.py --by cpu file1
+                list the inclusive of the samples of pid 1234 only, or
+                of each cpu. --cpu, --pid and --comm select samples by
+                where they were taken, --by breaks them down by that.
+                perf script output has the cpu, pid and comm of each
+                sample, and so does the output of profile.ebpf.
+            14. post-kp.py --merge fleet.folded hosts/
+                merge all the files in hosts/, eg. the same capture of
+                hundreds of hosts, into one profile, write it to
+                fleet.folded(or a pprof with -e pprof), and list its
+                inclusive. -w 1,2,... weights the samples of each file.
+
+        The first time a profiling file is opened, its pre-parsed data is
+        saved to file.kpidx next to it, and later opens load that index
+        instead of scanning the file again. The index is rebuilt when the
+        file changes. --noindex disables it.
+
+        When there is a lot to scan, files are split at stack boundaries and
+        scanned by worker processes, up to one per cpu. -j caps the number
+        of workers, -j 1 scans in this process only.
+
+        --sketch N loads files approximately, for those too big to hold.
+        Only about N functions, instructions and stacks with the most
+        samples are kept per file, so the memory stays flat however long
+        the file is. The counts shown may be over by the 'err<' of a row,
+        and caller/callee tell how far off they may be at most. Files
+        loaded so have no index and no time buckets.
+
+        Files are loaded in the background, the active ones first, then the
+        others opened, so -i and open give the prompt right away, and a
+        subcmd only waits for the files it works on. ls tells how far each
+        file is loaded.
+
+        The reload subcmd adds what the opened files have grown by since
+        they were loaded, eg. a profile still being written, scanning only
+        the new bytes. A file written again from the start, eg. dumped
+        again during a soak test, is loaded again. --follow SECS does it
+        every SECS seconds and prints the subcmd again if any file changed,
+        until interrupted,
+            post-kp.py --follow 5 -n 10 file1
+        With -i or --serve, the changed files are reloaded before each
+        subcmd. A file which grew since its index was written has only the
+        new bytes scanned too.
+
+        --merge scans the files by worker processes, each into a partial
+        profile of the stacks of its files only, and merges the partial
+        profiles in pairs, level by level, by the workers too. So it takes
+        less time with more cores, and memory for the unique stacks rather
+        than for the files. Only the stacks are merged, the samples of
+        different hosts have no common time or cpus. The merge subcmd does
+        the same.
+
+        --drop, --keep, --skip, --fold, --norecurse and --maxdepth shape
+        the stacks while they are loaded, so noisy kernel profiles take
+        less memory and the subcmds less time. The frames of the functions
+        --drop matches are left out, eg. interrupt entries or the
+        ret_from_fork at the bottom. --keep only loads the stacks with a
+        function it matches, --skip not those, eg. --skip cpu_idle. --fold
+        NAME=REGEX makes each run of frames it matches a single frame
+        NAME. --norecurse collapses a function calling itself into one
+        frame, and --maxdepth N keeps the top N frames of a stack only.
+        They apply in that order, the regexes to function names, and to
+        open, reload, --merge and the indexes too(an index made with
+        other ones is not used). eg.
+            post-kp.py --drop '^ret_from_fork$' --skip '^cpu_idle'
+                --fold 'irq=^(do_IRQ|irq_exit|__do_softirq)$' file1
+        The samples of the stacks not loaded are not counted either.
+
+        --timings prints how long loading each file and each subcmd took.
+        The stats subcmd tells more: how fast each file was loaded, its
+        unique stacks and symbols and the memory they take, and the time
+        spent so far in scanning, building the indexes, diffing and
+        sorting, and how often the memos were hit.
+
+        --serve runs post-kp.py as a daemon. It keeps the files loaded and
+        answers subcmds on a unix domain socket, so scripts, dashboards or
+        other users can query them without loading them again. --connect is
+        its client,
+            post-kp.py --serve /tmp/kp.sock file1 file2
+            post-kp.py --connect /tmp/kp.sock -q 'caller -n 5 fn' -q 'ls'
+            echo 'in -f 1' | post-kp.py --connect /tmp/kp.sock
+        The protocol is a line of json per request and response, refer to
+        kpserver.
         ''')
     help=textwrap.dedent('''\
         Usage:
@@ -659,6 +5972,9 @@ def main():
             post-kp.py [-v]
             post-kp.py [-t type] [-n lines] [-i] file1,file2...,filen
             post-kp.py [-Ccf fn] [-s depth] [-n lines] file1, file2
+            post-kp.py --merge output [-w weights] [-e type] file1|dir1...
+            post-kp.py --serve socket file1,file2...,filen
+            post-kp.py --connect socket [-q subcmd]...
         ''')
 
     parser=argparse.ArgumentParser(description=desc, epilog=help,
@@ -675,25 +5991,199 @@ def main():
                         default=20)
     parser.add_argument("-s","--depth", help="print first n lines", type=int,
                         default=1)
+    parser.add_argument("-b","--baseline", help="index of the file the others "
+                        "are compared to", type=int, default=0)
+    parser.add_argument("-d","--delta", help="diff column of N files",
+                        choices=['last','max','spread'], default='last')
+    parser.add_argument("--from", help="only count samples from this many "
+                        "seconds after the start of the file", type=float)
+    parser.add_argument("--to", help="only count samples until this many "
+                        "seconds after the start of the file", type=float)
+    parser.add_argument("-A","--annotate", help="print expensive "
+                        "instructions in func with disassembly and source",
+                        type=str, metavar="func")
+    parser.add_argument("-k","--vmlinux", help="vmlinux, or ELF file, to "
+                        "annotate with")
+    parser.add_argument("-e","--export", help="write the stacks of the first "
+                        "file in this format", choices=['folded','pprof'])
+    parser.add_argument("-o","--output", help="output file of --export")
+    parser.add_argument("--merge", help="merge the files, or the files in "
+                        "directories, into one profile written to this file "
+                        "in the format of -e(default folded), then run the "
+                        "subcmd on it", metavar="output")
+    parser.add_argument("-w","--weights", help="comma separated weight of "
+                        "each file of --merge, its samples are multiplied by")
     parser.add_argument("-i","--interactive", help="interactive mode",
                         action="store_true")
     parser.add_argument("-v","--version", help="version", action="store_const",
                         const=version)
+    parser.add_argument("-j","--jobs", help="max number of worker processes "
+                        "to load files and run --batch queries(capped at the "
+                        "CPUs), files under %dMB are loaded serially" % (
+                        parallelmin>>20), type=int,
+                        default=multiprocessing.cpu_count())
+    adddimargs(parser)
+    parser.add_argument("--timings", help="print the wall time of each "
+                        "load and subcmd", action="store_true")
+    parser.add_argument("--noperiod", help="count perf script samples instead "
+                        "of weighting them by their period",
+                        action="store_true")
+    parser.add_argument("--noindex", help="don't read or write the file.kpidx "
+                        "index sidecar", action="store_true")
+    parser.add_argument("--follow", help="check every SECS seconds if the "
+                        "files grew, and print the subcmd again with what "
+                        "they grew by. Or reload them before each subcmd "
+                        "with -i or --serve", type=float, metavar="SECS")
+    parser.add_argument("--sketch", help="load files approximately in "
+                        "bounded memory, keeping about N functions, "
+                        "instructions and stacks per file, without index and "
+                        "time buckets", type=int, default=0, metavar="N")
+    parser.add_argument("--drop", help="drop the frames of the functions "
+                        "matching REGEX while loading", action="append",
+                        metavar="REGEX")
+    parser.add_argument("--keep", help="only load the stacks with a function "
+                        "matching REGEX", action="append", metavar="REGEX")
+    parser.add_argument("--skip", help="don't load the stacks with a "
+                        "function matching REGEX", action="append",
+                        metavar="REGEX")
+    parser.add_argument("--fold", help="fold each run of frames of the "
+                        "functions matching REGEX into one frame NAME",
+                        action="append", metavar="NAME=REGEX")
+    parser.add_argument("--norecurse", help="collapse a function calling "
+                        "itself into one frame", action="store_true")
+    parser.add_argument("--maxdepth", help="only load the N frames at the "
+                        "top of each stack", type=int, metavar="N")
+    parser.add_argument("--layout", help="layout map to bin the addresses "
+                        "of samples by page size and NUMA node, and print "
+                        "their histograms", metavar="MAP")
+    parser.add_argument("--mem-budget", help="keep the loaded files within "
+                        "MB megabytes, spilling the least recently used "
+                        "inactive ones to temporary files, which are loaded "
+                        "back when used", type=float, metavar="MB")
+    parser.add_argument("--batch", help="run the subcmds of SCRIPT('-' for "
+                        "the standard input) on the files, loaded once, and "
+                        "print the results. Exit with 1 if a --fail "
+                        "threshold is crossed, 2 if a subcmd failed",
+                        metavar="SCRIPT")
+    parser.add_argument("--report", help="output of --batch. Default json",
+                        choices=['json','csv'], default='json')
+    parser.add_argument("--serve", help="keep the files loaded and answer "
+                        "subcmds on the unix socket", metavar="socket")
+    parser.add_argument("--connect", help="send subcmds to the daemon on the "
+                        "unix socket", metavar="socket")
+    parser.add_argument("-q","--query", help="subcmd to send, eg. 'in -n 5'. "
+                        "Read from stdin if not given", action="append")
     args=parser.parse_args()
+    try:
+        args.filt=filterspec(args)
+    except ValueError as e:
+        parser.error(str(e))
     if args.version:
         print(args.version)
         return
+    if args.connect:
+        sys.exit(client(args.connect,args.query or sys.stdin))
+    if args.merge:
+        start=time.time()
+        try:
+            inputs=mergeinputs(args.files,args.weights)
+            total,n=mergefiles(inputs,args.merge,args.export or 'folded',
+                max(1,min(args.jobs,multiprocessing.cpu_count())),
+                not args.noperiod,args.filt)
+        except (IOError,OSError,ValueError) as e:
+            print('merge failed: %s!!'%(e))
+            sys.exit(1)
+        print('%d file(s) merged into %s: %d samples, %d unique stacks'%(
+            len(inputs),args.merge,total,n))
+        if args.timings:
+            print('(merge: %.3fs)'%(time.time()-start))
+        args.files=[args.merge]
+        args.export=None
     handle=doit(args)
-    if args.interactive or not args.files:
-        handle.go(args)
-    else:
-        if args.caller:
-            handle.cc("caller",args.caller)
-        elif args.callee:
-            handle.cc("callee",args.callee)
-        elif args.func:
-            handle.instruction(args.func)
+    try:
+        if args.serve:
+            serve(handle,args.serve)
+        elif args.batch:
+            try:
+                script=(sys.stdin if args.batch=='-' else
+                    open(args.batch)).readlines()
+            except IOError as e:
+                print('%s!!'%(e))
+                sys.exit(2)
+            handle.activate(sorted(handle.fmap,
+                key=lambda k:handle.files.index(handle.fmap[k])))
+            sys.exit(batch(handle,script,args.report))
+        elif args.interactive or not args.files:
+            handle.go(args)
         else:
-            handle.ie(args.type)
-        
-main()
+            handle.activate(sorted(handle.fmap,
+                key=lambda k:handle.files.index(handle.fmap[k])))
+            if not 0<=args.baseline<len(handle.handle):
+                print('baseline %d is not an active file!!'%(args.baseline))
+                return
+            cmd=("export" if args.export else "caller" if args.caller else
+                "callee" if args.callee else "func" if args.func else
+                "annotate" if args.annotate else "pages" if args.layout else
+                args.type)
+            start=time.time()
+            oneshot(handle,cmd,args)
+            if args.timings:
+                print('(%s: %.3fs)' % (cmd,time.time()-start))
+            if args.follow is not None:
+                follow(handle,cmd,args)
+    finally:
+        handle.stop()
+
+def follow(handle,cmd,args):
+    """
+        --follow of oneshot(). Every args.follow seconds, reload the files
+        which changed and run 'cmd' again, until interrupted.
+    """
+    try:
+        while 1:
+            sys.stdout.flush()
+            time.sleep(args.follow)
+            if not handle.refresh():
+                continue
+            print('==========%s=========='%(time.strftime('%H:%M:%S')))
+            start=time.time()
+            oneshot(handle,cmd,args)
+            if args.timings:
+                print('(%s: %.3fs)' % (cmd,time.time()-start))
+    except KeyboardInterrupt:
+        pass
+
+def oneshot(handle,cmd,args):
+    """
+        Run subcmd 'cmd' given by the options of the command line on the
+        files of it.
+    """
+    failed=handle.wait(handle.handle)
+    if failed:
+        print('%s failed to load!!'%(','.join(failed)))
+        return
+    if cmd=="pages":
+        handle.pages(None,args.layout)
+        return
+    sel=dimsel(args)
+    if args.by and cmd in dimcmds:
+        handle.groupby(cmd,args.by,getattr(args,'from'),args.to,sel,
+            args.caller or args.callee)
+        return
+    if getattr(args,'from') is not None or args.to is not None or sel:
+        handle=handle.window(getattr(args,'from'),args.to,sel)
+        if handle is None:
+            return
+    if cmd=="export":
+        handle.export(args.export,args.output)
+    elif cmd in ["caller","callee"]:
+        handle.cc(cmd,args.caller or args.callee)
+    elif cmd=="func":
+        handle.instruction(args.func)
+    elif cmd=="annotate":
+        handle.annotate(args.annotate,args.vmlinux)
+    else:
+        handle.ie(cmd)
+
+if __name__=='__main__':
+    main()